@@ -7,6 +7,7 @@ import collections
 import locale
 import logging
 import math
+import multiprocessing
 import sys
 
 from . import utils
@@ -21,6 +22,10 @@ else:
 
 _logger = logging.getLogger(__name__)
 
+# The sharded context calculation in progress,
+# inherited by the forked worker processes.
+_usage_shard_job = None
+
 
 class WordBoundary(object):
     """A special symbol for marking word boundaries.
@@ -254,10 +259,15 @@ class MorphUsageProperties(object):
 
     # Cache for memoized valid transitions
     _valid_transitions = None
+    # Cache for memoized context types of category pairs
+    _context_type_table = None
+    # Number of processes used for calculating the usage features
+    num_processes = 1
 
     def __init__(self, ppl_threshold=100, ppl_slope=None, length_threshold=3,
                  length_slope=2, type_perplexity=False,
-                 min_perplexity_length=4, pre_ppl_threshold=None):
+                 min_perplexity_length=4, pre_ppl_threshold=None,
+                 contexts_per_iter=50000, num_processes=1):
         """Initialize the model parameters describing morph usage.
 
         Arguments:
@@ -274,6 +284,11 @@ class MorphUsageProperties(object):
             min_perplexity_length :  Morphs shorter than this length are
                                      ignored when calculating perplexity.
             pre_ppl_threshold: Separte ppl thresh for prefixes.
+            contexts_per_iter :  Maximum number of morphs for which
+                                 contexts are collected simultaneously
+                                 (per process), to limit memory use.
+            num_processes :  Number of worker processes used for
+                             calculating the usage features.
         """
 
         if ppl_threshold is None:
@@ -301,8 +316,16 @@ class MorphUsageProperties(object):
         # Counts of different contexts in which a morph occurs
         self._contexts = utils.Sparse(default=MorphContext(0, 1.0, 1.0))
         self._context_builders = collections.defaultdict(MorphContextBuilder)
+        # Scratch overlay of estimated contexts for temporary morphs.
+        # Values are the (left, right) sources of the perplexities,
+        # either a seen parent morph or a fixed perplexity, until the
+        # context is needed and resolved into a MorphContext.
+        self._estimated = {}
 
-        self._contexts_per_iter = 50000  # FIXME customizable
+        self._contexts_per_iter = int(contexts_per_iter)
+        # Restored when a memory budget is removed
+        self._default_contexts_per_iter = self._contexts_per_iter
+        self.num_processes = int(num_processes)
 
         # Cache for memoized feature-based conditional class probabilities
         self._condprob_cache = collections.defaultdict(float)
@@ -368,6 +391,37 @@ class MorphUsageProperties(object):
         assert self._ppl_threshold is not None, msg
         if self._pre_ppl_threshold is None:
             self._pre_ppl_threshold = self._ppl_threshold
+        if self.num_processes > 1:
+            try:
+                self._collect_contexts_sharded(seg_func)
+                return
+            except ValueError:
+                _logger.warning('Worker processes can not be forked, '
+                                'calculating usage features serially')
+        self._collect_contexts(seg_func)
+
+    def update_usage_features(self, morphs, seg_func):
+        """Recalculate the usage features of some morphs, whose contexts
+        have changed since the features were calculated.
+
+        Arguments:
+            morphs :  The set of morphs to recalculate.
+            seg_func :  A function returning the segmentations
+                        of all words in which the morphs occur,
+                        in corpus order.
+        """
+        for morph in morphs:
+            if morph in self._contexts:
+                del self._contexts[morph]
+            if morph in self._condprob_cache:
+                del self._condprob_cache[morph]
+        self._collect_contexts(seg_func, morphs)
+        self._marginalizer = None
+        self._zlctc = None
+
+    def _collect_contexts(self, seg_func, morphs=None):
+        """Collect the contexts of the morphs (or all morphs if None)
+        occurring in the segmentations returned by seg_func."""
         while True:
             # If risk of running out of memory, perform calculations in
             # multiple loops over the data
@@ -381,6 +435,8 @@ class MorphUsageProperties(object):
                     pcount = 1
 
                 for (i, morph) in enumerate(segments):
+                    if morphs is not None and morph not in morphs:
+                        continue
                     # Collect information about the contexts in which
                     # the morphs occur.
                     if self._add_to_context(morph, pcount, rcount,
@@ -392,11 +448,69 @@ class MorphUsageProperties(object):
             if not conserving_memory:
                 break
 
+    def _collect_contexts_sharded(self, seg_func):
+        """Collect the contexts of all morphs using worker processes.
+        The morphs are divided into shards, each shard small enough to
+        fit in the memory budget. The workers collect the contexts
+        of one shard at a time in a single pass over the corpus,
+        and the perplexities are calculated when the results are
+        gathered. The contexts are stored in the same order as
+        when collected in a single process.
+        """
+        global _usage_shard_job
+        first_seen = collections.OrderedDict()
+        for (_, segments) in seg_func():
+            for morph in segments:
+                if morph not in first_seen:
+                    first_seen[morph] = len(first_seen)
+        num_shards = max(self.num_processes,
+                         -(-len(first_seen) // self._contexts_per_iter))
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 2 always forks on posix
+            context = multiprocessing
+        _usage_shard_job = (self, seg_func, first_seen, num_shards)
+        contexts = {}
+        pool = context.Pool(self.num_processes)
+        try:
+            for builders in pool.imap(_collect_shard, range(num_shards)):
+                for (morph, tmp) in builders.items():
+                    contexts[morph] = MorphContext(tmp.count,
+                                                   tmp.left_perplexity,
+                                                   tmp.right_perplexity)
+        finally:
+            pool.terminate()
+            _usage_shard_job = None
+        for morph in first_seen:
+            if morph in contexts:
+                self._contexts[morph] = contexts[morph]
+
+    def context_builder_size(self, sample_size=1000):
+        """Estimated size in bytes of the builder used for collecting
+        the contexts of one morph. The number of distinct neighbours
+        is estimated from the perplexities of a sample of the
+        current contexts."""
+        neighbours = 1.0
+        sample = [context for (_, context)
+                  in zip(range(sample_size), self._contexts.values())]
+        if len(sample) > 0:
+            neighbours = sum(context.left_perplexity +
+                             context.right_perplexity
+                             for context in sample) / (2.0 * len(sample))
+        builder = MorphContextBuilder()
+        for i in range(int(math.ceil(neighbours))):
+            builder.left[i] = 1
+            builder.right[i] = 1
+        return utils._sizeof(builder) + utils._dict_entry_overhead()
+
     def clear(self):
         """Resets the context variables.
         Use before fully reprocessing a segmented corpus."""
         self._contexts.clear()
         self._context_builders.clear()
+        self._estimated.clear()
         self._condprob_cache.clear()
         self._marginalizer = None
         self._zlctc = None
@@ -452,7 +566,7 @@ class MorphUsageProperties(object):
             morph :  A string representation of the morph type.
         """
         if morph not in self._condprob_cache:
-            context = self._contexts[morph]
+            context = self._context(morph)
 
             prelike = sigmoid(context.right_perplexity,
                               self._pre_ppl_threshold,
@@ -524,7 +638,7 @@ class MorphUsageProperties(object):
         The length in characters of the morph is also a feature, but it does
         not need to be encoded as it is available from the surface form.
         """
-        context = self._contexts[morph]
+        context = self._context(morph)
         return (universalprior(context.right_perplexity) +
                 universalprior(context.left_perplexity))
 
@@ -544,7 +658,16 @@ class MorphUsageProperties(object):
             A list of temporary morph contexts that have been estimated.
             These should be removed by the caller if no longer necessary.
             The removal is done using MorphContext.remove_temporaries.
+
+        The estimates are stored in a scratch overlay, and the
+        perplexities are only looked up when the context is needed.
         """
+        def source(parent, attr):
+            if parent in self:
+                # Real contexts are stable, the lookup can be delayed
+                return parent
+            return getattr(self._context(parent), attr)
+
         temporaries = []
         for (i, morph) in enumerate(new_morphs):
             if morph in self:
@@ -552,20 +675,39 @@ class MorphUsageProperties(object):
                 continue
             if i == 0:
                 # Prefix inherits left perplexity of leftmost parent
-                l_ppl = self._contexts[old_morphs[0]].left_perplexity
+                left = source(old_morphs[0], 'left_perplexity')
             else:
                 # Otherwise assume that the morph doesn't appear in any
                 # other contexts, which gives perplexity 1.0
-                l_ppl = 1.0
+                left = 1.0
             if i == len(new_morphs) - 1:
-                r_ppl = self._contexts[old_morphs[-1]].right_perplexity
+                right = source(old_morphs[-1], 'right_perplexity')
             else:
-                r_ppl = 1.0
-            count = 0   # estimating does not add instances of the morph
-            self._contexts[morph] = MorphContext(count, l_ppl, r_ppl)
+                right = 1.0
+            self._estimated[morph] = (left, right)
+            # Condprobs cached from an earlier estimate are stale
+            if morph in self._condprob_cache:
+                del self._condprob_cache[morph]
             temporaries.append(morph)
         return temporaries
 
+    def _context(self, morph):
+        """Returns the context of a morph, resolving an estimated
+        context from the overlay if necessary."""
+        if morph not in self._estimated:
+            return self._contexts[morph]
+        estimate = self._estimated[morph]
+        if not isinstance(estimate, MorphContext):
+            (l_ppl, r_ppl) = estimate
+            if utils._is_string(l_ppl):
+                l_ppl = self._contexts[l_ppl].left_perplexity
+            if utils._is_string(r_ppl):
+                r_ppl = self._contexts[r_ppl].right_perplexity
+            # estimating does not add instances of the morph
+            estimate = MorphContext(0, l_ppl, r_ppl)
+            self._estimated[morph] = estimate
+        return estimate
+
     @staticmethod
     def context_type(prev_morph, next_morph, prev_cat, next_cat):
         """Cluster certain types of context, to allow making context-dependant
@@ -579,6 +721,23 @@ class MorphUsageProperties(object):
             ctype += CONTEXT_FLAG_FINAL
         return ctype
 
+    @classmethod
+    def context_type_table(cls):
+        """Returns (and caches) the context types of all pairs
+        (prev_cat, next_cat) as a dict, for fast lookup when matching
+        transformation rules.
+        Only valid as long as context_type ignores the morphs.
+        """
+        if cls._context_type_table is None:
+            table = {}
+            categories = get_categories(wb=True)
+            for prev_cat in categories:
+                for next_cat in categories:
+                    table[(prev_cat, next_cat)] = cls.context_type(
+                        None, None, prev_cat, next_cat)
+            cls._context_type_table = table
+        return cls._context_type_table
+
     ### End of categorization-dependent code
     ########################################
     # But not the end of the class:
@@ -588,11 +747,13 @@ class MorphUsageProperties(object):
     def remove_temporaries(self, temporaries):
         """Remove estimated temporary morph contexts when no longer needed."""
         for morph in temporaries:
-            if morph not in self:
+            if morph in self._estimated:
+                del self._estimated[morph]
+            elif morph in self:
                 continue
-            msg = '{}: {}'.format(morph, self._contexts[morph].count)
-            assert self._contexts[morph].count == 0, msg
-            del self._contexts[morph]
+            elif morph in self._contexts:
+                # Was counted while evaluating, but later reverted
+                del self._contexts[morph]
             if morph in self._condprob_cache:
                 del self._condprob_cache[morph]
 
@@ -620,7 +781,7 @@ class MorphUsageProperties(object):
 
     def get_context_features(self, morph):
         """Returns the context features of a seen morph."""
-        return self._contexts[morph]
+        return self._context(morph)
 
     def count(self, morph):
         """The counts in the corpus of morphs with contexts."""
@@ -636,6 +797,12 @@ class MorphUsageProperties(object):
         if self._marginalizer is not None and self.count(morph) > 0:
             self._marginalizer.add(-self.count(morph),
                                    self.condprobs(morph))
+        if morph in self._estimated:
+            if new_count == 0:
+                return
+            # The estimate is needed for real
+            self._contexts[morph] = self._context(morph)
+            del self._estimated[morph]
         self._contexts[morph] = self._contexts[morph]._replace(count=new_count)
         assert self.count(morph) >= 0, '{} subzero count'.format(morph)
         if self._marginalizer is not None and self.count(morph) > 0:
@@ -661,6 +828,25 @@ class MorphUsageProperties(object):
         return cls._valid_transitions
 
 
+def _collect_shard(shard):
+    """Collects the contexts of the morphs in one shard of the
+    sharded context calculation. Runs in a worker process."""
+    (usage, seg_func, first_seen, num_shards) = _usage_shard_job
+    usage._context_builders.clear()
+    for rcount, segments in seg_func():
+        if not usage.type_perplexity:
+            pcount = rcount
+        else:
+            pcount = 1
+        for (i, morph) in enumerate(segments):
+            if first_seen[morph] % num_shards != shard:
+                continue
+            usage._add_to_context(morph, pcount, rcount, i, segments)
+    builders = dict(usage._context_builders)
+    usage._context_builders.clear()
+    return builders
+
+
 class MaximumLikelihoodMorphUsage(object):
     """This is a replacement for MorphUsageProperties,
     that uses ML-estimation to replace the property-based
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""
+Client library for the segmentation server (flatcat-serve)
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import collections
+import json
+import logging
+import socket
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import utils
+from .categorizationscheme import CategorizedMorph
+from .exception import SegmentationServerError
+
+_logger = logging.getLogger(__name__)
+
+
+def _batches(words, batch_size):
+    """Splits the distinct words into batches of at most batch_size."""
+    unique = list(collections.OrderedDict.fromkeys(words))
+    return [unique[i:(i + batch_size)]
+            for i in range(0, len(unique), batch_size)]
+
+
+def _parse_response(response):
+    if 'error' in response:
+        raise SegmentationServerError(response['error'])
+    return [(tuple(CategorizedMorph(morph, category)
+                   for (morph, category) in analysis), logp)
+            for (analysis, logp) in zip(response['analyses'],
+                                        response['logprobs'])]
+
+
+def _encode(request):
+    return json.dumps(request).encode('utf-8') + b'\n'
+
+
+class _Connection(object):
+    """A blocking connection to the server."""
+
+    def __init__(self, address, timeout):
+        if utils._is_string(address):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = tuple(address[:2])
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self._file = self.sock.makefile('rb')
+
+    def call(self, requests):
+        """Sends the requests pipelined, and returns the responses."""
+        self.sock.sendall(b''.join(_encode(request)
+                                   for request in requests))
+        responses = []
+        for _ in requests:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError('connection closed by server')
+            responses.append(json.loads(line.decode('utf-8')))
+        return responses
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+
+class SegmentationClient(object):
+    """Blocking client for the segmentation server, safe to share
+    between threads.
+
+    Persistent connections are kept in a pool of at most pool_size
+    connections. The distinct words of a call are sent in requests of
+    at most batch_size words, which are pipelined on one connection.
+    A call failing because the server closed the connection (e.g.
+    while reloading the model) is retried on a new connection, as
+    segmentation requests are safe to repeat.
+    """
+
+    def __init__(self, address, pool_size=4, timeout=10.0, batch_size=256,
+                 retries=1):
+        """Arguments:
+            address :  Path of a Unix socket, or a (host, port) pair.
+            pool_size :  Maximum number of open connections.
+            timeout :  Timeout in seconds for connecting, and for each
+                       send and receive. Exceeding it raises
+                       socket.timeout.
+            batch_size :  Maximum number of words in one request.
+            retries :  Number of times a call is retried after the
+                       connection is lost.
+        """
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.retries = retries
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._closed = False
+
+    def analyze(self, words):
+        """Returns a list of (analysis, logp) pairs for the words,
+        as given by FlatcatModel.viterbi_analyze."""
+        words = list(words)
+        batches = _batches(words, self.batch_size)
+        if len(batches) == 0:
+            return []
+        responses = self._call([{'id': i, 'words': batch}
+                                for (i, batch) in enumerate(batches)])
+        results = {}
+        for (batch, response) in zip(batches, responses):
+            results.update(zip(batch, _parse_response(response)))
+        return [results[word] for word in words]
+
+    def segment(self, words):
+        """Returns the analyses of the words,
+        as tuples of CategorizedMorph."""
+        return [analysis for (analysis, _) in self.analyze(words)]
+
+    def segment_word(self, word):
+        return self.segment([word])[0]
+
+    def stats(self):
+        """Statistics of the server (of one worker, if pre-forked)."""
+        return self._command('stats')['stats']
+
+    def reload(self):
+        """Asks the server to reload its model file."""
+        return self._command('reload')['reload']
+
+    def close(self):
+        """Closes the idle connections. Connections in use are closed
+        when they are returned to the pool."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _command(self, command):
+        response = self._call([{'command': command}])[0]
+        if 'error' in response:
+            raise SegmentationServerError(response['error'])
+        return response
+
+    def _call(self, requests):
+        for attempt in range(self.retries + 1):
+            connection = self._acquire()
+            try:
+                responses = connection.call(requests)
+            except socket.timeout:
+                self._discard(connection)
+                raise
+            except (ConnectionError, OSError):
+                self._discard(connection)
+                if attempt == self.retries:
+                    raise
+                _logger.debug('Connection lost, retrying')
+                continue
+            except BaseException:
+                self._discard(connection)
+                raise
+            self._release(connection)
+            return responses
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise socket.timeout('no free connection in the pool')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _Connection(self.address, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, connection):
+        if self._closed:
+            connection.close()
+        else:
+            self._idle.put(connection)
+        self._slots.release()
+
+    def _discard(self, connection):
+        connection.close()
+        self._slots.release()
+
+
+class _AsyncConnection(object):
+    """An asyncio connection to the server, on which any number
+    of requests can be pipelined."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        # Futures for the responses, in the order of the requests
+        self._pending = collections.deque()
+        self._read_task = asyncio.ensure_future(self._read_loop())
+        self.closed = False
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    async def request(self, request):
+        if self.closed:
+            raise ConnectionError('connection closed')
+        future = asyncio.get_event_loop().create_future()
+        # The write is not interleaved with other requests
+        self._pending.append(future)
+        self._writer.write(_encode(request))
+        await self._writer.drain()
+        return (await future)
+
+    async def close(self):
+        self.closed = True
+        self._writer.close()
+        self._read_task.cancel()
+        await asyncio.gather(self._read_task, return_exceptions=True)
+        self._fail(ConnectionError('connection closed'))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                future = self._pending.popleft()
+                if not future.done():
+                    # Not if the caller has timed out
+                    future.set_result(json.loads(line.decode('utf-8')))
+        except (ConnectionError, ValueError, IndexError) as e:
+            _logger.debug('Connection failed: {}'.format(e))
+        self.closed = True
+        self._fail(ConnectionError('connection closed by server'))
+
+    def _fail(self, exception):
+        while len(self._pending) > 0:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exception)
+
+
+class AsyncSegmentationClient(object):
+    """Asyncio client for the segmentation server.
+
+    Requests are pipelined on at most pool_size persistent
+    connections, a new connection being opened only when all open
+    connections have requests waiting. Words requested one at a time
+    with analyze_word or segment_word by concurrent tasks are
+    collected into shared requests, waiting at most batch_delay
+    seconds for the batch to fill. Lost connections are retried as
+    in SegmentationClient.
+    """
+
+    def __init__(self, address, pool_size=4, timeout=10.0, batch_size=256,
+                 batch_delay=0.001, retries=1):
+        """Arguments:
+            address :  Path of a Unix socket, or a (host, port) pair.
+            pool_size :  Maximum number of open connections.
+            timeout :  Timeout in seconds for each request. Exceeding
+                       it raises asyncio.TimeoutError.
+            batch_size :  Maximum number of words in one request.
+            batch_delay :  Time in seconds that single words wait
+                           for other words to join their request.
+            retries :  Number of times a request is retried after the
+                       connection is lost.
+        """
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self._connections = []
+        self._connecting = None
+        # Single words waiting for a batch, and their futures
+        self._waiting = collections.OrderedDict()
+        self._flush_handle = None
+
+    async def analyze(self, words):
+        """Returns a list of (analysis, logp) pairs for the words,
+        as given by FlatcatModel.viterbi_analyze."""
+        words = list(words)
+        batches = _batches(words, self.batch_size)
+        responses = await asyncio.gather(
+            *[self._call({'id': i, 'words': batch})
+              for (i, batch) in enumerate(batches)])
+        results = {}
+        for (batch, response) in zip(batches, responses):
+            results.update(zip(batch, _parse_response(response)))
+        return [results[word] for word in words]
+
+    async def segment(self, words):
+        """Returns the analyses of the words,
+        as tuples of CategorizedMorph."""
+        return [analysis for (analysis, _) in (await self.analyze(words))]
+
+    async def analyze_word(self, word):
+        """Returns the (analysis, logp) pair of one word. The words of
+        concurrent calls are sent in the same request."""
+        loop = asyncio.get_event_loop()
+        if word not in self._waiting:
+            self._waiting[word] = loop.create_future()
+        future = self._waiting[word]
+        if len(self._waiting) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_delay,
+                                                 self._flush)
+        return (await asyncio.shield(future))
+
+    async def segment_word(self, word):
+        return (await self.analyze_word(word))[0]
+
+    async def stats(self):
+        """Statistics of the server (of one worker, if pre-forked)."""
+        return (await self._command('stats'))['stats']
+
+    async def reload(self):
+        """Asks the server to reload its model file."""
+        return (await self._command('reload'))['reload']
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        connections = self._connections
+        self._connections = []
+        for connection in connections:
+            await connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        waiting = self._waiting
+        self._waiting = collections.OrderedDict()
+        if len(waiting) > 0:
+            asyncio.ensure_future(self._analyze_waiting(waiting))
+
+    async def _analyze_waiting(self, waiting):
+        try:
+            results = await self.analyze(list(waiting))
+        except Exception as e:
+            for future in waiting.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (future, result) in zip(waiting.values(), results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _command(self, command):
+        response = await self._call({'command': command})
+        if 'error' in response:
+            raise SegmentationServerError(response['error'])
+        return response
+
+    async def _call(self, request):
+        for attempt in range(self.retries + 1):
+            connection = await self._connection()
+            try:
+                return (await asyncio.wait_for(connection.request(request),
+                                               self.timeout))
+            except asyncio.TimeoutError:
+                raise
+            except (ConnectionError, OSError):
+                self._drop(connection)
+                if attempt == self.retries:
+                    raise
+                _logger.debug('Connection lost, retrying')
+
+    async def _connection(self):
+        """Returns the open connection with the fewest waiting requests,
+        opening a new one if all are busy and the pool is not full."""
+        self._connections = [connection
+                             for connection in self._connections
+                             if not connection.closed]
+        if len(self._connections) > 0:
+            best = min(self._connections,
+                       key=lambda connection: connection.num_pending)
+            if (best.num_pending == 0 or
+                    len(self._connections) >= self.pool_size):
+                return best
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        connecting = self._connecting
+        try:
+            connection = await asyncio.wait_for(asyncio.shield(connecting),
+                                                self.timeout)
+        finally:
+            if connecting.done() and self._connecting is connecting:
+                self._connecting = None
+        return connection
+
+    async def _connect(self):
+        if utils._is_string(self.address):
+            (reader, writer) = await asyncio.open_unix_connection(
+                self.address, limit=2 ** 24)
+        else:
+            (reader, writer) = await asyncio.open_connection(
+                *self.address[:2], limit=2 ** 24)
+        connection = _AsyncConnection(reader, writer)
+        self._connections.append(connection)
+        return connection
+
+    def _drop(self, connection):
+        connection.closed = True
+        if connection in self._connections:
+            self._connections.remove(connection)
+        asyncio.ensure_future(connection.close())
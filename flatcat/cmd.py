@@ -16,8 +16,9 @@ from . import get_version, _logger, flatcat, reduced
 from . import categorizationscheme
 from .diagnostics import IterationStatistics
 from .exception import ArgumentException
-from .io import FlatcatIO, TarGzModel, BINARY_ENDINGS, TARBALL_ENDINGS
-from .utils import _generator_progress
+from .io import FlatcatIO, TarGzModel, CheckpointWriter, SnapshotWriter
+from .io import BINARY_ENDINGS, TARBALL_ENDINGS, PACKED_ENDINGS
+from .utils import _generator_progress, parse_memory_size
 
 PY3 = sys.version_info.major == 3
 
@@ -102,7 +103,7 @@ Simple usage examples (training and testing):
 """,
         formatter_class=argparse.RawDescriptionHelpFormatter,
         add_help=False)
-    parser.add_argument('initfile',
+    parser.add_argument('initfile', nargs='?',
         metavar='<init file>',
         help='Initialize by loading model from file. '
                 'Supported formats: '
@@ -110,7 +111,9 @@ Simple usage examples (training and testing):
                 '(Morfessor Baseline; plaintext, ".gz" or ."bz2"), '
                 'Tagged analysis '
                 '(Morfessor FlatCat; plaintext, ".gz" or ".bz2"), '
-                'Binary FlatCat model (pickled in a ".pickled" file)')
+                'Binary FlatCat model (pickled in a ".pickled" file), '
+                'Packed FlatCat model (in a ".packed" file). '
+                'Not needed when resuming from a checkpoint.')
     groups = ArgumentGroups(parser)
     add_model_io_arguments(groups)
     add_common_io_arguments(groups)
@@ -133,11 +136,27 @@ def add_model_io_arguments(argument_groups):
                  'except that pickled binary models are not supported. '
                  'Untagged segmentations will be tagged with the current '
                  'model.')
+    add_arg('--resume', dest='resume', default=None, metavar='<file>',
+            help='Continue an interrupted batch training from a '
+                 'checkpoint, instead of initializing a new model. '
+                 'The training parameters of the interrupted run are used.')
     add_arg('-T', '--testdata', dest='testfiles', action='append',
             default=[], metavar='<file>',
             help='Input corpus file(s) to analyze (text or gzipped text;  '
                  'use "-" for standard input; add several times in order to '
                  'append multiple files).')
+    add_arg('--read-processes', dest='read_processes', type=int,
+            default=1, metavar='<int>',
+            help='Number of worker processes used for parsing the '
+                 'initial and extending segmentation files. '
+                 '(default %(default)s).')
+    add_arg('--segment-processes', dest='segment_processes', type=int,
+            default=None, metavar='<int>',
+            help='Segment the test data in a pipeline, with a reader '
+                 'thread, this many segmentation worker processes and '
+                 'a writer thread running concurrently. '
+                 '(default: read, segment and write each word in turn, '
+                 'as needed for interactive use).')
 
     # Options for output data files
     add_arg = argument_groups.get('output data files')
@@ -150,6 +169,31 @@ def add_model_io_arguments(argument_groups):
                  'Use of a filename ending in ".pickled" is recommended. '
                  'This format is suceptible to bit-rot, '
                  'and is not recommended for long-time storage.')
+    add_arg('--save-packed-model', dest='savepackedfile',
+            default=None, metavar='<file>',
+            help='Save a packed binary FlatCat model, which also stores '
+                 'the estimated parameters and loads without '
+                 'reinitialization. '
+                 'Use of a filename ending in ".packed" is required '
+                 'for loading.')
+    add_arg('--checkpoint', dest='checkpointfile', default=None,
+            metavar='<file>',
+            help='Periodically save a checkpoint during batch training, '
+                 'from which the training can be resumed with --resume. '
+                 'Written after each training operation.')
+    add_arg('--checkpoint-interval', dest='checkpoint_interval', type=int,
+            default=None, metavar='<int>',
+            help='Also write the checkpoint after this many experiments '
+                 'within an operation. (default: only between operations).')
+    add_arg('--background-checkpoints', dest='background_checkpoints',
+            default=False, action='store_true',
+            help='Write the checkpoints in a forked process, '
+                 'without pausing the training.')
+    add_arg('--background-saves', dest='background_saves',
+            default=False, action='store_true',
+            help='Write the final tarball, binary and packed models in '
+                 'forked processes, while continuing with the remaining '
+                 'output and the segmentation of the test data.')
     add_arg('--save-reduced', dest="savereduced", default=None,
             metavar='<file>',
             help="save final model to file in reduced form (pickled model "
@@ -297,6 +341,17 @@ def add_training_arguments(argument_groups):
             help='Morphs shorter than this length are '
                  'ignored when calculating perplexity. '
                  '(default %(default)s).')
+    add_arg('--usage-processes', dest='usage_processes', type=int,
+            default=1, metavar='<int>',
+            help='Number of worker processes used when calculating '
+                 'the usage features (contexts) of morphs. '
+                 '(default %(default)s).')
+    add_arg('--memory-budget', dest='memory_budget', type=parse_memory_size,
+            default=None, metavar='<size>',
+            help='Approximate number of bytes to use for caches and '
+                 'for collecting the usage features of morphs. '
+                 'Accepts the suffixes K, M and G. '
+                 '(default: use fixed cache sizes).')
     add_arg('-d', '--dampening', dest='dampening', type=str, default='none',
             metavar='<type>', choices=['none', 'log', 'ones'],
             help='Frequency dampening for training data. '
@@ -316,6 +371,13 @@ def add_training_arguments(argument_groups):
     add_arg('--skips', dest='skips', default=False, action='store_true',
             help='Use random skips for frequently seen words to speed up '
                  'online training. Has no effect on batch training.')
+    add_arg('--skips-memory', dest='skips_memory', type=parse_memory_size,
+            default=None, metavar='<size>',
+            help='Number of bytes used for counting the words for '
+                 'random skips approximately, in a count-min sketch. '
+                 'Only used with --skips. '
+                 'Accepts the suffixes K, M and G. '
+                 '(default: count every word of the epoch exactly).')
     add_arg('--batch-minfreq', dest='freqthreshold', type=int, default=1,
             metavar='<int>',
             help='Word frequency threshold (default %(default)s).')
@@ -369,6 +431,20 @@ def add_training_arguments(argument_groups):
             help='Stop training if cost reduction between iterations '
                  'is below this limit * #boundaries. '
                  '(default %(default)s).')
+    add_arg('--schedule-experiments', dest='schedule_experiments',
+            default=False, action='store_true',
+            help='Perform the experiments of each iteration in order of '
+                 'expected gain, estimated from the previous iteration '
+                 'and the frequency of the morphs.')
+    add_arg('--min-experiment-gain', dest='min_experiment_gain',
+            type=float, default=None, metavar='<float>',
+            help='Cut an iteration short if the cost reduction of the '
+                 'recent experiments is below this limit * #boundaries. '
+                 '(default %(default)s).')
+    add_arg('--experiment-window', dest='experiment_window',
+            type=int, default=100, metavar='<int>',
+            help='Number of recent experiments considered by '
+                 '--min-experiment-gain. (default %(default)s).')
     add_arg('--min-difference-proportion', dest='min_diff_prop', type=float,
             default=0.005, metavar='<float>',
             help='Stop HMM initialization when the proportion of '
@@ -386,6 +462,15 @@ def add_training_arguments(argument_groups):
     add_arg('--online-epochint', dest='epochinterval', type=int,
             default=10000, metavar='<int>',
             help='Epoch interval for online training (default %(default)s)')
+    add_arg('--online-batch-size', dest='online_batch_size', type=int,
+            default=1, metavar='<int>',
+            help='Number of tokens whose updates are applied together '
+                 'in online training (default %(default)s)')
+    add_arg('--online-prefetch', dest='online_prefetch', type=int,
+            default=10000, metavar='<int>',
+            help='Number of tokens read ahead from the input in a '
+                 'background thread in online training. '
+                 '0 reads synchronously (default %(default)s)')
 
 
 def add_semisupervised_arguments(argument_groups):
@@ -574,15 +659,26 @@ def flatcat_main(args):
     # Arguments needing processing
     training_ops = args.training_operations.split(',')
 
-    if (args.initfile is None):
+    if args.resume is not None:
+        if args.trainmode != 'batch':
+            raise ArgumentException(
+                'Only batch training can be resumed from a checkpoint.')
+        init_is_pickle = False
+        init_is_tarball = False
+        init_is_packed = False
+        init_is_complete = True
+    elif (args.initfile is None):
         raise ArgumentException(
             'An initial Baseline or FlatCat model must be given.')
-
-    init_is_pickle = any(args.initfile.endswith(ending)
-                         for ending in BINARY_ENDINGS)
-    init_is_tarball = any(args.initfile.endswith(ending)
-                          for ending in TARBALL_ENDINGS)
-    init_is_complete = (init_is_tarball or init_is_pickle)
+    else:
+        init_is_pickle = any(args.initfile.endswith(ending)
+                             for ending in BINARY_ENDINGS)
+        init_is_tarball = any(args.initfile.endswith(ending)
+                              for ending in TARBALL_ENDINGS)
+        init_is_packed = any(args.initfile.endswith(ending)
+                             for ending in PACKED_ENDINGS)
+        init_is_complete = (init_is_tarball or init_is_pickle or
+                            init_is_packed)
 
     io = FlatcatIO(encoding=args.encoding,
                    construction_separator=args.consseparator,
@@ -602,9 +698,16 @@ def flatcat_main(args):
 
     # Load exisiting model or create a new one
     must_train = False
-    if init_is_pickle:
+    if args.resume is not None:
+        _logger.info('Resuming from checkpoint...')
+        model = io.read_checkpoint_file(args.resume)
+        must_train = True
+    elif init_is_pickle:
         _logger.info('Initializing from binary model...')
         model = io.read_binary_model_file(args.initfile)
+    elif init_is_packed:
+        _logger.info('Initializing from packed model...')
+        model = io.read_packed_model_file(args.initfile)
     elif init_is_tarball:
         _logger.info('Initializing from tarball...')
         model = io.read_tarball_model_file(args.initfile)
@@ -616,7 +719,8 @@ def flatcat_main(args):
             length_slope=args.length_slope,
             type_perplexity=args.type_ppl,
             min_perplexity_length=args.min_ppl_length,
-            pre_ppl_threshold=args.pre_ppl_threshold)
+            pre_ppl_threshold=args.pre_ppl_threshold,
+            num_processes=args.usage_processes)
         if args.corpusweight is None:
             corpusweight = DEFAULT_CORPUSWEIGHT
         else:
@@ -631,46 +735,63 @@ def flatcat_main(args):
         _logger.info('Initializing from segmentation...')
         # Add the initial corpus data
         model.add_corpus_data(
-            io.read_segmentation_file(args.initfile),
+            io.read_segmentation_file(args.initfile,
+                                      num_processes=args.read_processes),
             count_modifier=dampfunc,
             freqthreshold=args.freqthreshold)
         model.training_operations = training_ops
 
-    # Load the hyperparameters
-    if not init_is_complete:
-        if args.loadparamsfile is not None:
-            _logger.info('Loading hyperparameters from {}'.format(
-                args.loadparamsfile))
-            model.set_params(
-                io.read_parameter_file(args.loadparamsfile))
-
-    # Add annotated data
-    for f in args.annofiles:
-        annotations = io.read_annotations_file(f)
-        model.add_annotations(annotations,
-                              args.annotationweight)
-
-    # Override loaded values with values specified on the commandline
-    if args.corpusweight is not None:
-        model.set_corpus_coding_weight(args.corpusweight)
-    if args.annotationweight is not None:
-        model.set_annotation_coding_weight(args.annotationweight)
-    if args.ppl_threshold is not None:
-        model._morph_usage.set_params({
-            'perplexity-threshold': args.ppl_threshold,
-            'perplexity-slope': args.ppl_slope,
-            'pre-perplexity-threshold': args.pre_ppl_threshold})
-
-    # Initialize the model
-    must_train = model.initialize_hmm(
-        min_difference_proportion=args.min_diff_prop)
-
-    # Extend the model with new unannotated data
-    for f in args.extendfiles:
-        model.add_corpus_data(io.read_segmentation_file(f),
-                              count_modifier=dampfunc,
-                              freqthreshold=args.freqthreshold)
-        must_train = True
+    model._morph_usage.num_processes = args.usage_processes
+    if args.memory_budget is not None:
+        model.set_memory_budget(args.memory_budget)
+
+    # A resumed model is used as is: reinitializing it,
+    # or changing its data or parameters, would change the training
+    if args.resume is None:
+        # Load the hyperparameters
+        if not init_is_complete:
+            if args.loadparamsfile is not None:
+                _logger.info('Loading hyperparameters from {}'.format(
+                    args.loadparamsfile))
+                model.set_params(
+                    io.read_parameter_file(args.loadparamsfile))
+
+        # Add annotated data
+        for f in args.annofiles:
+            annotations = io.read_annotations_file(f)
+            model.add_annotations(annotations,
+                                  args.annotationweight)
+
+        # Override loaded values with values specified on the commandline
+        if args.corpusweight is not None:
+            model.set_corpus_coding_weight(args.corpusweight)
+        if args.annotationweight is not None:
+            model.set_annotation_coding_weight(args.annotationweight)
+        if args.ppl_threshold is not None:
+            model._morph_usage.set_params({
+                'perplexity-threshold': args.ppl_threshold,
+                'perplexity-slope': args.ppl_slope,
+                'pre-perplexity-threshold': args.pre_ppl_threshold})
+
+        # Initialize the model.
+        # A packed model is ready to use, unless modified above
+        if (init_is_packed and len(args.annofiles) == 0 and
+                args.corpusweight is None and
+                args.annotationweight is None and
+                args.ppl_threshold is None):
+            must_train = False
+        else:
+            must_train = model.initialize_hmm(
+                min_difference_proportion=args.min_diff_prop)
+
+        # Extend the model with new unannotated data
+        for f in args.extendfiles:
+            model.add_corpus_data(
+                io.read_segmentation_file(
+                    f, num_processes=args.read_processes),
+                count_modifier=dampfunc,
+                freqthreshold=args.freqthreshold)
+            must_train = True
 
     # Set up statistics logging
     stats = None
@@ -739,8 +860,23 @@ def flatcat_main(args):
                                      analysis_sep=',')
         model.train_online(data, count_modifier=dampfunc,
                            epoch_interval=args.epochinterval,
-                           max_epochs=(args.max_iterations * args.max_epochs))
-    if args.trainmode in ('batch', 'online+batch'):
+                           max_epochs=(args.max_iterations * args.max_epochs),
+                           batch_size=args.online_batch_size,
+                           skip_memory=args.skips_memory,
+                           prefetch=args.online_prefetch)
+    checkpoints = None
+    if args.checkpointfile is not None:
+        checkpoints = CheckpointWriter(
+            io, args.checkpointfile, args.checkpoint_interval,
+            background=args.background_checkpoints)
+        checkpoints.register(model)
+    if args.resume is not None:
+        ts = time.time()
+        model.resume_batch_training()
+        _logger.info('Final cost: {}'.format(model.get_cost()))
+        te = time.time()
+        _logger.info('Training time: {:.3f}s'.format(te - ts))
+    elif args.trainmode in ('batch', 'online+batch'):
         ts = time.time()
         model.train_batch(
             min_iteration_cost_gain=args.min_iteration_cost_gain,
@@ -750,15 +886,30 @@ def flatcat_main(args):
             max_iterations=args.max_iterations,
             max_resegment_iterations=args.max_resegment_iterations,
             max_shift_distance=args.max_shift_distance,
-            min_shift_remainder=args.min_shift_remainder)
+            min_shift_remainder=args.min_shift_remainder,
+            schedule_experiments=args.schedule_experiments,
+            min_experiment_gain=args.min_experiment_gain,
+            experiment_window=args.experiment_window)
         _logger.info('Final cost: {}'.format(model.get_cost()))
         te = time.time()
         _logger.info('Training time: {:.3f}s'.format(te - ts))
+    if checkpoints is not None:
+        checkpoints.finish()
+
+    snapshots = []
+
+    def save_model(write_func, file_name):
+        if args.background_saves:
+            snapshot = SnapshotWriter(write_func)
+            snapshot.write(file_name, model)
+            snapshots.append(snapshot)
+        else:
+            write_func(file_name, model)
 
     #
     # Save tarball
     if args.savetarballfile is not None:
-        io.write_tarball_model_file(args.savetarballfile, model)
+        save_model(io.write_tarball_model_file, args.savetarballfile)
 
     # Old single-file saving formats (for hysterical raisins)
     # Save hyperparameters
@@ -789,8 +940,13 @@ def flatcat_main(args):
     if args.savepicklefile is not None:
         _logger.info("Saving binary model...")
         model.toggle_callbacks(None)
-        io.write_binary_model_file(args.savepicklefile, model)
-        _logger.info("Done.")
+        save_model(io.write_binary_model_file, args.savepicklefile)
+        if not args.background_saves:
+            _logger.info("Done.")
+
+    # Save packed model
+    if args.savepackedfile is not None:
+        save_model(io.write_packed_model_file, args.savepackedfile)
 
     # Segment test data
     if len(args.testfiles) > 0:
@@ -839,7 +995,8 @@ def flatcat_main(args):
             construction_sep=csep,
             category_sep=tsep,
             filter_tags=filter_tags,
-            filter_len=args.filter_len)
+            filter_len=args.filter_len,
+            num_processes=args.segment_processes)
 
         _logger.info("Done.")
 
@@ -851,6 +1008,11 @@ def flatcat_main(args):
         reduced_model = reduced.FlatcatSegmenter(model)
         io.write_binary_file(args.savereduced, reduced_model)
 
+    # Wait for the models written in the background
+    failed = [snapshot for snapshot in snapshots if not snapshot.wait()]
+    if len(failed) > 0:
+        raise IOError('Writing {} of the models failed'.format(len(failed)))
+
 
 def add_reformatting_arguments(argument_groups):
     # File format options
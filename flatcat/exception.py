@@ -14,6 +14,7 @@ class ArgumentException(Exception):
 class InvalidCategoryError(MorfessorException):
     """Attempt to load data using a different categorization scheme."""
     def __init__(self, category):
+        self.category = category
         super(InvalidCategoryError, self).__init__(
             self, 'This model does not recognize the category {}'.format(
                 category))
@@ -31,3 +32,18 @@ class UnsupportedConfigurationError(MorfessorException):
         super(UnsupportedConfigurationError, self).__init__(
             self, ('This operation is not supported in this program ' +
                    'configuration. Reason: {}.').format(reason))
+
+
+class InvalidModelFileError(MorfessorException):
+    def __init__(self, file_name, reason):
+        super(InvalidModelFileError, self).__init__(
+            self, 'Unable to load model from {}: {}'.format(
+                file_name, reason))
+
+
+class SegmentationServerError(MorfessorException):
+    """The segmentation server answered a request with an error."""
+    def __init__(self, message):
+        self.message = message
+        super(SegmentationServerError, self).__init__(
+            'The segmentation server returned an error: {}'.format(message))
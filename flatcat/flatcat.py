@@ -16,6 +16,7 @@ import math
 import random
 import re
 import sys
+import time
 
 from morfessor import baseline
 from . import utils
@@ -558,6 +559,11 @@ class FlatcatModel(AbstractSegmenter):
     # 'shift' is no longer included as 3rd op by default
     DEFAULT_TRAIN_OPS = ['split', 'join', 'resegment']
 
+    # Proportions of the memory budget given to the
+    # context builders and the emission probability caches
+    MEMORY_BUDGET_SHARES = {'context_builders': 0.5,
+                            'emission_cache': 0.5}
+
     def __init__(self, morph_usage=None, forcesplit=None, nosplit=None,
                  corpusweight=1.0, use_skips=False, ml_emissions_epoch=-1):
         # Morph usage properties
@@ -587,6 +593,12 @@ class FlatcatModel(AbstractSegmenter):
         # self.segmentations for words in which the morph occurs
         self.morph_backlinks = collections.defaultdict(set)
 
+        # Word backlinks
+        # A dict mapping the surface forms of the corpus words to their
+        # indices in self.segmentations. Built when first needed, and
+        # then kept up to date as words are added to the corpus.
+        self._word_backlinks = None
+
         # Cache for custom interning system
         self._interned_morphs = {}
 
@@ -605,6 +617,22 @@ class FlatcatModel(AbstractSegmenter):
         self._epoch_number = 0
         self._operation_number = 0
 
+        # Finer grained position within the epoch, stored in
+        # checkpoints to allow resuming training exactly:
+        # the index of the epoch within train_batch and the cost
+        # it started from, the iteration of the current operation
+        # (None between operations) and the cost it started from,
+        # and the keys of the experiments in the current iteration
+        # with the number of keys already consumed.
+        self._batch_epoch = 0
+        self._epoch_start_cost = None
+        self._iteration_number = None
+        self._iteration_start_cost = None
+        self._iteration_keys = None
+        self._iteration_position = 0
+        # True while continuing an iteration interrupted by a checkpoint
+        self._resuming = False
+
         # The sequence of training operations.
         # Valid training operations are strings for which FlatcatModel
         # has a function named _op_X_generator, where X is the string
@@ -629,9 +657,27 @@ class FlatcatModel(AbstractSegmenter):
         # Should take exactly one argument: the model.
         self.operation_callbacks = []
         self.iteration_callbacks = []
+        # Called after each experiment in batch training.
+        self.experiment_callbacks = []
         self._changed_segmentations = None
         self._changed_segmentations_op = None
 
+        # Orders the experiments of each iteration, or None
+        # to perform them in the order given by the operation.
+        self._experiment_scheduler = None
+
+        # Morphs occurring in the words changed by training operations
+        # since the last estimate, or None if the changes are unknown.
+        self._reestimate_changes = None
+        # Number of incremental estimates since the last full one,
+        # and the limit after which a full estimate is forced.
+        self._incremental_reestimates = 0
+        self._full_reestimate_interval = 10
+
+        # Divides a memory budget between the caches,
+        # or None to use the default cache sizes.
+        self._memory_budget = None
+
         # Force these atoms to be kept as separate morphs.
         # Calling morfessor baseline with the same forcesplit value ensures
         # that they are initially separate.
@@ -726,8 +772,7 @@ class FlatcatModel(AbstractSegmenter):
                     self._corpus_tagging_level = "partial"
             segmentation = WordAnalysis(count, analysis)
             self.segmentations.append(segmentation)
-            for morph in self.detag_word(segmentation.analysis):
-                self.morph_backlinks[morph].add(i)
+            self._add_backlinks(i)
             i += 1
             self._corpus_coding.boundaries += count
 
@@ -736,9 +781,7 @@ class FlatcatModel(AbstractSegmenter):
         self._supervised = True
         if self._annotations_tagged is None:
             self._annotations_tagged = True
-        word_backlinks = {
-            ''.join(self.detag_word(seg.analysis)): i
-            for (i, seg) in enumerate(self.segmentations)}
+        word_backlinks = self._get_word_backlinks()
         for (word, alternatives) in annotations.items():
             if alternatives[0][0].category is None:
                 self._annotations_tagged = False
@@ -750,9 +793,8 @@ class FlatcatModel(AbstractSegmenter):
                 i_unannot = len(self.segmentations)
                 self.segmentations.append(
                     WordAnalysis(1, alternatives[0]))
+                self._add_backlinks(i_unannot)
             self.annotations[word] = Annotation(alternatives, None, i_unannot)
-        del word_backlinks
-        self._calculate_morph_backlinks()
         self._annot_coding = FlatcatAnnotatedCorpusEncoding(
                                 self._corpus_coding,
                                 weight=annotatedcorpusweight)
@@ -823,7 +865,10 @@ class FlatcatModel(AbstractSegmenter):
                     max_iterations=1,
                     max_resegment_iterations=1,
                     max_shift_distance=2,
-                    min_shift_remainder=2):
+                    min_shift_remainder=2,
+                    schedule_experiments=False,
+                    min_experiment_gain=None,
+                    experiment_window=100):
         """Perform batch training.
 
         Arguments:
@@ -846,6 +891,14 @@ class FlatcatModel(AbstractSegmenter):
                                   that the shift operation can move a boundary.
             min_shift_remainder :  Limit on the shortest morph allowed to be
                                    produced by the shift operation.
+            schedule_experiments :  Perform the experiments of each
+                                    iteration in order of expected gain.
+            min_experiment_gain :  Cut an iteration short if the gain in
+                                   cost of the recent experiments was less
+                                   than this proportion.
+                                   Set to None to disable.
+            experiment_window :  Number of recent experiments whose gain
+                                 is compared to min_experiment_gain.
         """
         self._min_iteration_cost_gain = min_iteration_cost_gain
         self._min_epoch_cost_gain = min_epoch_cost_gain
@@ -856,18 +909,46 @@ class FlatcatModel(AbstractSegmenter):
         self._max_shift = max_shift_distance
         self._min_shift_remainder = min_shift_remainder
         self._online = False
+        if schedule_experiments or min_experiment_gain is not None:
+            self._experiment_scheduler = ExperimentScheduler(
+                order=schedule_experiments,
+                min_gain=self._cost_convergence_limit(min_experiment_gain),
+                window=experiment_window)
+        else:
+            self._experiment_scheduler = None
 
         msg = 'Must initialize model and tag corpus before training'
         assert self._corpus_tagging_level == "full", msg
+        # The corpus may have been modified without tracking the changes
+        self._reestimate_changes = None
         self._epoch_update(no_increment=True)
-        previous_cost = self.get_cost()
+        self._iteration_number = None
+        self._iteration_keys = None
+        self._train_epochs(0, self.get_cost())
+
+    def resume_batch_training(self):
+        """Continues batch training from the point where a checkpoint
+        was written, using the training parameters of the interrupted
+        call to train_batch."""
+        msg = 'Must initialize model and tag corpus before training'
+        assert self._corpus_tagging_level == "full", msg
+        self._online = False
+        self._resuming = self._iteration_number is not None
+        _logger.info('Resuming training at epoch {}, operation {}'.format(
+            self._epoch_number, self._operation_number))
+        self._train_epochs(self._batch_epoch, self._epoch_start_cost)
+
+    def _train_epochs(self, first_epoch, previous_cost):
+        """The epoch loop of batch training."""
         wl_force_another = False
         u_force_another = False
         if self._ml_emissions_epoch > 0:
             ml_epochs = self._ml_emissions_epoch
         else:
             ml_epochs = 0
-        for epoch in range(self._max_epochs + ml_epochs):
+        for epoch in range(first_epoch, self._max_epochs + ml_epochs):
+            self._batch_epoch = epoch
+            self._epoch_start_cost = previous_cost
             self._train_epoch()
 
             cost = self.get_cost()
@@ -907,94 +988,216 @@ class FlatcatModel(AbstractSegmenter):
         self.reestimate_probabilities()
 
     def train_online(self, data, count_modifier=None, epoch_interval=10000,
-                     max_epochs=None, result_callback=None):
-        """Adapt the model in online fashion."""
+                     max_epochs=None, result_callback=None, batch_size=1,
+                     skip_memory=None, prefetch=0, background_results=False):
+        """Adapt the model in online fashion.
+
+        Arguments:
+            data :  iterator of (is_annotation, count, word, analysis)
+                    tuples, as given by FlatcatIO.read_combined_file.
+            count_modifier :  function for adjusting the word counts.
+            epoch_interval :  number of tokens between resegmenting
+                              the whole corpus.
+            max_epochs :  maximum number of epochs.
+            result_callback :  called with (token_num, word, analysis,
+                               detagged analysis) for each token.
+                               The analysis is that of the word in the
+                               corpus after training on the token.
+            batch_size :  number of unannotated tokens whose count
+                          updates are applied together, followed by
+                          one focused pass of the training operations
+                          over the affected words.
+                          With the default of 1, each token is
+                          trained on separately.
+            skip_memory :  if given, the word counts used for random
+                           skips are approximated by a count-min
+                           sketch of this many bytes, instead of
+                           counting every word seen in the epoch.
+                           Ignored unless the model uses skips.
+            prefetch :  if above zero, the data is read in a background
+                        thread, keeping up to this many tokens ready.
+            background_results :  call result_callback in a background
+                                  thread, so that slow output does not
+                                  stall training. The callback must not
+                                  access the model.
+        """
 
         self._online = True
-        self._skipcounter = collections.Counter()
+        self._experiment_scheduler = None
+        if skip_memory is not None and not self._use_skips:
+            _logger.warning('Random skips are not used, '
+                            'ignoring the memory limit of the skip counts')
+            skip_memory = None
+        if skip_memory is None:
+            self._skipcounter = collections.Counter()
+        else:
+            self._skipcounter = utils.CountMinSketch.from_memory(
+                skip_memory)
+            _logger.info(
+                'Counting words for skips in a {}x{} count-min sketch '
+                '({}): counts are overestimated by at most {:.2g} times '
+                'the tokens of the epoch, with probability {:.3f}'.format(
+                    self._skipcounter.depth, self._skipcounter.width,
+                    utils._format_memory_size(
+                        self._skipcounter.memory_size),
+                    self._skipcounter.epsilon,
+                    1 - self._skipcounter.delta))
         if count_modifier is not None:
             counts = {}
-        word_backlinks = self._online_backlinks()
+        word_backlinks = self._get_word_backlinks()
 
         _logger.info("Starting online training")
+        if batch_size > 1:
+            _logger.info("Using mini-batches of {} tokens".format(batch_size))
+
+        if prefetch > 0:
+            data = utils.Prefetcher(data, chunk_size=1,
+                                    queue_chunks=prefetch)
+        writer = None
+        callback = result_callback
+        if result_callback is not None and background_results:
+            writer = utils.BackgroundWriter(result_callback, chunk_size=1,
+                                            queue_chunks=max(1, prefetch))
+            callback = writer.write
+        log_tokens = _logger.isEnabledFor(logging.DEBUG)
+        # Time the training loop spent waiting for input and output
+        io_wait = {'input': 0., 'output': 0.}
+
+        def emit(token_num, w, segments):
+            if log_tokens:
+                _logger.debug("#%s: %s -> %s" %
+                              (token_num, w, segments))
+            if callback is not None:
+                start = time.time()
+                callback(token_num,
+                         w,
+                         segments,
+                         self.detag_word(segments))
+                io_wait['output'] += time.time() - start
+
+        # Tokens of the current mini-batch, and the total added count
+        # and number of tokens of each word in it
+        batch = []
+        batch_words = collections.OrderedDict()
+
+        def corpus_analysis(w, i_word):
+            if i_word is None:
+                # Not added to the corpus
+                (segments, _) = self.viterbi_analyze(w)
+                return segments
+            return self.segmentations[i_word].analysis
+
+        def flush():
+            self._online_unlabeled_batch(batch_words)
+            for (token_num, w) in batch:
+                emit(token_num, w,
+                     corpus_analysis(w, word_backlinks.get(w, None)))
+            del batch[:]
+            batch_words.clear()
 
         epochs = 0
         token_num = 0
         more_tokens = True
         self.reestimate_probabilities()
-        while more_tokens:
-            newcost = self.get_cost()
-            _logger.info(
-                "Tokens processed: %s\tCost: %s" % (token_num, newcost))
-
-            for _ in utils._progress(range(epoch_interval)):
-                try:
-                    is_anno, _, w, atoms = next(data)
-                except StopIteration:
-                    more_tokens = False
-                    break
-
-                if count_modifier is not None:
-                    if not w in counts:
-                        c = 0
-                        counts[w] = 1
-                        add_count = 1
+        try:
+            while more_tokens:
+                newcost = self.get_cost()
+                _logger.info(
+                    "Tokens processed: %s\tCost: %s" % (token_num, newcost))
+                epoch_start = time.time()
+                epoch_tokens = token_num
+                io_wait['input'] = io_wait['output'] = 0.
+                self._num_skipped = 0
+
+                for _ in utils._progress(range(epoch_interval)):
+                    start = time.time()
+                    try:
+                        is_anno, _, w, atoms = next(data)
+                    except StopIteration:
+                        more_tokens = False
+                        break
+                    finally:
+                        io_wait['input'] += time.time() - start
+
+                    if count_modifier is not None:
+                        if not w in counts:
+                            c = 0
+                            counts[w] = 1
+                            add_count = 1
+                        else:
+                            c = counts[w]
+                            counts[w] = c + 1
+                            add_count = (count_modifier(c + 1) -
+                                         count_modifier(c))
                     else:
-                        c = counts[w]
-                        counts[w] = c + 1
-                        add_count = count_modifier(c + 1) - count_modifier(c)
-                else:
-                    add_count = 1
+                        add_count = 1
 
-                i_word = word_backlinks.get(w, None)
-                if add_count > 0:
-                    if is_anno:
-                        (i_word, recalculate) = self._online_labeled_token(
+                    if batch_size > 1 and not is_anno:
+                        batch.append((token_num, w))
+                        if add_count > 0:
+                            (total, num_tokens) = batch_words.get(w,
+                                                                  (0, 0))
+                            batch_words[w] = (total + add_count,
+                                              num_tokens + 1)
+                        if len(batch) >= batch_size:
+                            flush()
+                        token_num += 1
+                        continue
+                    if len(batch) > 0:
+                        # Annotations are trained on in order
+                        flush()
+
+                    i_word = word_backlinks.get(w, None)
+                    if add_count > 0:
+                        if is_anno:
+                            i_word = self._online_labeled_token(
                                 w, atoms, i_word)
-                        if recalculate:
-                            word_backlinks = self._online_backlinks()
-                    else:
-                        i_word = self._online_unlabeled_token(w, add_count,
-                                                              i_word)
-                    assert i_word is not None
-                    word_backlinks[w] = i_word
-                (segments, _) = self.viterbi_analyze(w)
-
-                _logger.debug("#%s: %s -> %s" %
-                              (token_num, w, segments))
-                if result_callback is not None:
-                    result_callback(token_num,
-                                    w,
-                                    segments,
-                                    self.detag_word(segments))
-                token_num += 1
-
-            # also reestimates the probabilities
-            _logger.info("Epoch reached, resegmenting corpus")
-            self._viterbi_analyze_corpus()
-            if self._supervised:
-                self._update_annotation_choices()
-
-            self._skipcounter = collections.Counter()
-            epochs += 1
-            if max_epochs is not None and epochs >= max_epochs:
-                _logger.info("Max number of epochs reached, stop training")
-                break
+                        else:
+                            i_word = self._online_unlabeled_token(
+                                w, add_count, i_word)
+                        assert i_word is not None
+                    emit(token_num, w, corpus_analysis(w, i_word))
+                    token_num += 1
+
+                if len(batch) > 0:
+                    flush()
+                self._log_online_throughput(token_num - epoch_tokens,
+                                            time.time() - epoch_start,
+                                            io_wait)
+
+                # also reestimates the probabilities
+                _logger.info("Epoch reached, resegmenting corpus")
+                self._viterbi_analyze_corpus()
+                if self._supervised:
+                    self._update_annotation_choices()
+
+                if skip_memory is not None:
+                    _logger.info(
+                        'Skip counts: {}'.format(self._skipcounter))
+                self._skipcounter.clear()
+                self._log_memory_usage()
+                epochs += 1
+                if max_epochs is not None and epochs >= max_epochs:
+                    _logger.info(
+                        "Max number of epochs reached, stop training")
+                    break
+        finally:
+            if prefetch > 0:
+                data.close()
+            if writer is not None:
+                writer.close()
 
         self.reestimate_probabilities()
         newcost = self.get_cost()
         _logger.info("Tokens processed: %s\tCost: %s" % (token_num, newcost))
         return epochs, newcost
 
-    def _online_backlinks(self):
-        self.morph_backlinks.clear()
-        word_backlinks = {}
-        for (i, seg) in enumerate(self.segmentations):
-            for morph in self.detag_word(seg.analysis):
-                self.morph_backlinks[morph].add(i)
-            joined = ''.join(self.detag_word(seg.analysis))
-            word_backlinks[joined] = i
-        return word_backlinks
+    def _log_online_throughput(self, num_tokens, elapsed, io_wait):
+        _logger.info(
+            '{} tokens in {:.1f}s ({:.1f} tokens/s), {} skipped. '
+            'Waited {:.1f}s for input, {:.1f}s for output'.format(
+                num_tokens, elapsed, num_tokens / max(elapsed, 1e-6),
+                self._num_skipped, io_wait['input'], io_wait['output']))
 
     def _online_labeled_token(self, word, segments, i_word=None):
         if not self._supervised:
@@ -1034,7 +1237,7 @@ class FlatcatModel(AbstractSegmenter):
                     WordAnalysis(1, tuple(new_analysis)))
                 for morph in self.detag_word(segments):
                     self._modify_morph_count(morph, 1)
-                self._calculate_morph_backlinks()
+                self._add_backlinks(i_word)
             self.annotations[word] = Annotation((segments,),
                                                 tuple(new_analysis),
                                                 i_word)
@@ -1060,7 +1263,7 @@ class FlatcatModel(AbstractSegmenter):
                 break
             self._single_iteration_epoch()
 
-        return (i_word, add_annotation_entry)
+        return i_word
 
     def _online_unlabeled_token(self, word, add_count, i_word=None):
         skip_this = False
@@ -1072,6 +1275,7 @@ class FlatcatModel(AbstractSegmenter):
 
         if skip_this:
             segments = self.segmentations[i_word].analysis
+            self._num_skipped += 1
         else:
             segments, _ = self.viterbi_analyze(word)
 
@@ -1105,6 +1309,69 @@ class FlatcatModel(AbstractSegmenter):
         assert i_word is not None
         return i_word
 
+    def _online_unlabeled_batch(self, word_counts):
+        """Adds a mini-batch of unannotated tokens to the corpus.
+
+        The words are analyzed with the parameters at the start of the
+        batch, their count updates are applied together, and the
+        training operations are performed once, focused on the
+        analyzed words.
+
+        Arguments:
+            word_counts :  dict mapping each word of the batch to
+                           a (added count, number of tokens) pair.
+        """
+        word_backlinks = self._get_word_backlinks()
+        analyses = []
+        for (word, (add_count, num_tokens)) in word_counts.items():
+            i_word = word_backlinks.get(word, None)
+            skip_this = (self._use_skips and
+                         i_word is not None and
+                         all([self._test_skip(word)
+                              for _ in range(num_tokens)]))
+            if skip_this:
+                # Only increase the word count, don't analyze
+                segments = None
+                self._num_skipped += num_tokens
+            else:
+                segments, _ = self.viterbi_analyze(word)
+            analyses.append((word, i_word, add_count, segments))
+
+        change_counts = ChangeCounts()
+        focus = set()
+        for (word, i_word, add_count, segments) in analyses:
+            if i_word is not None:
+                # The word is already in the corpus
+                old_seg = self.segmentations[i_word]
+                if segments is None:
+                    segments = old_seg.analysis
+                else:
+                    focus.add(i_word)
+                change_counts.update(old_seg.analysis,
+                                     -old_seg.count,
+                                     corpus_index=i_word)
+                for morph in self.detag_word(old_seg.analysis):
+                    self._modify_morph_count(morph, -old_seg.count)
+                self.segmentations[i_word] = WordAnalysis(
+                    old_seg.count + add_count,
+                    segments)
+                self._corpus_coding.boundaries += add_count
+            else:
+                self.add_corpus_data([WordAnalysis(add_count, segments)])
+                i_word = len(self.segmentations) - 1
+                focus.add(i_word)
+            new_count = self.segmentations[i_word].count
+            change_counts.update(self.segmentations[i_word].analysis,
+                                 new_count, corpus_index=i_word)
+            for morph in self.detag_word(segments):
+                self._modify_morph_count(morph, new_count)
+
+        self._update_counts(change_counts, 1)
+
+        if len(focus) > 0:
+            self.training_focus = focus
+            self._single_iteration_epoch()
+
     def viterbi_tag_corpus(self):
         """(Re)tags the corpus segmentations using viterbi_tag"""
         num_changed_words = 0
@@ -1127,11 +1394,29 @@ class FlatcatModel(AbstractSegmenter):
         assert cost >= 0
         return cost
 
-    def reestimate_probabilities(self):
+    def reestimate_probabilities(self, incremental=False):
         """Re-estimates model parameters from a segmented, tagged corpus.
 
         theta(t) = arg min { L( theta, Y(t), D ) }
+
+        Arguments:
+            incremental :  Only update the parameters affected by the
+                           words changed by the training operations
+                           since the last estimate, if possible.
+                           A full recomputation is still performed
+                           periodically, and whenever the changes
+                           have not been tracked.
         """
+        if (incremental and
+                self._reestimate_changes is not None and
+                self._incremental_reestimates <
+                    self._full_reestimate_interval and
+                not isinstance(self._morph_usage,
+                               MaximumLikelihoodMorphUsage)):
+            if self._reestimate_incremental():
+                self._incremental_reestimates += 1
+                self._reestimate_changes = set()
+                return
         self._intern_corpus()
         self._calculate_usage_features()
         self._calculate_transition_counts()
@@ -1139,6 +1424,8 @@ class FlatcatModel(AbstractSegmenter):
         if self._supervised:
             self._annot_coding.reset_contributions()
         self._initialized = True
+        self._incremental_reestimates = 0
+        self._reestimate_changes = set()
 
     def get_params(self):
         """Returns a dict of hyperparameters."""
@@ -1176,6 +1463,26 @@ class FlatcatModel(AbstractSegmenter):
         self._annot_coding.do_update_weight = False
         _logger.info('Setting annotation weight to {}'.format(weight))
 
+    def set_memory_budget(self, budget):
+        """Limits the memory used by the caches and the context builders.
+        The number of entries allowed in each of them is determined
+        by measuring the size of a typical entry.
+
+        Arguments:
+            budget :  The budget in bytes, or None to restore
+                      the default sizes.
+        """
+        if budget is None:
+            self._memory_budget = None
+            self._morph_usage._contexts_per_iter = (
+                self._morph_usage._default_contexts_per_iter)
+            self._corpus_coding.set_emission_cache_size(
+                FlatcatEncoding.DEFAULT_CACHE_SIZE)
+            return
+        self._memory_budget = utils.MemoryBudget(budget,
+                                                 self.MEMORY_BUDGET_SHARES)
+        self._apply_memory_budget()
+
     def get_lexicon(self):
         """Returns morphs in lexicon, with emission counts"""
         assert self._initialized
@@ -1222,14 +1529,43 @@ class FlatcatModel(AbstractSegmenter):
         unable to restore instance methods. If you need callbacks in a loaded
         model, you have to readd them after loading.
         """
-        out = (self.operation_callbacks, self.iteration_callbacks)
+        out = (self.operation_callbacks, self.iteration_callbacks,
+               self.experiment_callbacks)
         if callbacks is None:
             self.operation_callbacks = []
             self.iteration_callbacks = []
+            self.experiment_callbacks = []
         else:
-            (self.operation_callbacks, self.iteration_callbacks) = callbacks
+            (self.operation_callbacks, self.iteration_callbacks,
+             self.experiment_callbacks) = callbacks
         return out
 
+    def get_checkpoint_state(self):
+        """Returns the complete state of the model for a checkpoint.
+
+        Unlike pickling the model, this keeps all derived state and the
+        position within the current training iteration, and does not
+        modify the model. Training continued from the checkpoint with
+        resume_batch_training is identical to uninterrupted training.
+        Callbacks are not included.
+        """
+        state = self.__dict__.copy()
+        state['operation_callbacks'] = []
+        state['iteration_callbacks'] = []
+        state['experiment_callbacks'] = []
+        state['_random_state'] = random.getstate()
+        return state
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        """Creates a model from a state returned by get_checkpoint_state.
+        Also restores the state of the random number generator."""
+        state = dict(state)
+        random.setstate(state.pop('_random_state'))
+        model = cls.__new__(cls)
+        model.__dict__.update(state)
+        return model
+
     def __getstate__(self):
         # clear caches of owned objects
         self._corpus_coding.clear_transition_cache()
@@ -1239,6 +1575,7 @@ class FlatcatModel(AbstractSegmenter):
         # These will be restored
         out = self.__dict__.copy()
         del out['morph_backlinks']
+        out['_word_backlinks'] = None
         del out['_interned_morphs']
         del out['_skipcounter']
 
@@ -1248,6 +1585,21 @@ class FlatcatModel(AbstractSegmenter):
         return out
 
     def __setstate__(self, d):
+        # attributes missing from models pickled by earlier versions
+        d.setdefault('_experiment_scheduler', None)
+        d.setdefault('_reestimate_changes', None)
+        d.setdefault('_incremental_reestimates', 0)
+        d.setdefault('_full_reestimate_interval', 10)
+        d.setdefault('_memory_budget', None)
+        d.setdefault('experiment_callbacks', [])
+        d.setdefault('_batch_epoch', 0)
+        d.setdefault('_epoch_start_cost', None)
+        d.setdefault('_iteration_number', None)
+        d.setdefault('_iteration_start_cost', None)
+        d.setdefault('_iteration_keys', None)
+        d.setdefault('_iteration_position', 0)
+        d.setdefault('_resuming', False)
+        d.setdefault('_word_backlinks', None)
         self.__dict__ = d
         # recreate deleted fields
         self.morph_backlinks = collections.defaultdict(set)
@@ -1369,7 +1721,7 @@ class FlatcatModel(AbstractSegmenter):
 
     ### Training operations
     #
-    def _generic_bimorph_generator(self, result_func):
+    def _generic_bimorph_generator(self, result_func, operation=None):
         """The common parts of operation generators that operate on
         context-sensitive bimorphs. Don't call this directly.
 
@@ -1377,6 +1729,7 @@ class FlatcatModel(AbstractSegmenter):
             result_func :  A function that takes the prefix an suffix
                            as arguments, and returns all the proposed results
                            as tuples of CategorizedMorphs.
+            operation :  Name of the operation, for scheduling.
         """
 
         bigram_freqs = collections.Counter()
@@ -1393,7 +1746,11 @@ class FlatcatModel(AbstractSegmenter):
                     prev_morph.category, next_morph.category)
                 bigram_freqs[(prefix, suffix, context_type)] += count
 
-        for (bigram, count) in bigram_freqs.most_common():
+        bigrams = self._scheduled(
+            operation,
+            [bigram for (bigram, _) in bigram_freqs.most_common()],
+            lambda bigram: bigram_freqs[bigram])
+        for bigram in bigrams:
             prefix, suffix, context_type = bigram
             # Require both morphs, tags and context to match
             rule = TransformationRule((prefix, suffix),
@@ -1426,7 +1783,9 @@ class FlatcatModel(AbstractSegmenter):
             for (_, segmentation) in self._training_focus_filter():
                 for morph in self.detag_word(segmentation):
                     unsorted.add(morph)
-        iteration_morphs = sorted(unsorted, key=len)
+        iteration_morphs = self._scheduled(
+            'split', sorted(unsorted, key=len),
+            lambda morph: self._morph_usage.count(morph) * (len(morph) - 1))
         for morph in iteration_morphs:
             if len(morph) == 1:
                 continue
@@ -1471,7 +1830,7 @@ class FlatcatModel(AbstractSegmenter):
             joined = self._interned_morph(joined)
             return ((CategorizedMorph(joined, None),),)
 
-        return self._generic_bimorph_generator(join_helper)
+        return self._generic_bimorph_generator(join_helper, 'join')
 
     def _op_shift_generator(self):
         """Generates operations that shift the split point in a bigram.
@@ -1507,7 +1866,7 @@ class FlatcatModel(AbstractSegmenter):
                                         CategorizedMorph(new_suf, None)))
             return results
 
-        return self._generic_bimorph_generator(shift_helper)
+        return self._generic_bimorph_generator(shift_helper, 'shift')
 
     def _op_resegment_generator(self):
         """Generates special transformations that resegment and tag
@@ -1520,7 +1879,10 @@ class FlatcatModel(AbstractSegmenter):
             source = self.training_focus
         # Sort by count, ascending
         source = sorted([(self.segmentations[i].count, i) for i in source])
-        for (_, i) in source:
+        source = self._scheduled(
+            'resegment', [i for (_, i) in source],
+            lambda i: self.segmentations[i].count)
+        for i in source:
             word = self.segmentations[i]
             changed_morphs = set(self.detag_word(word.analysis))
             vrt = ViterbiResegmentTransformation(word, self)
@@ -1531,6 +1893,44 @@ class FlatcatModel(AbstractSegmenter):
 
     ### Private: reestimation
     #
+    def _reestimate_incremental(self):
+        """Updates the usage features of the morphs occurring in the
+        words changed since the last estimate.
+        The emission and transition counts are kept up to date by the
+        training operations, only the contributions depending on the
+        usage features need to be recalculated.
+        Returns False without changing anything, if so many words
+        have changed that a full recomputation is cheaper.
+        """
+        morphs = self._reestimate_changes
+        if len(morphs) == 0:
+            return True
+        targets = set()
+        for morph in morphs:
+            targets.update(self.morph_backlinks[morph])
+        if len(targets) > len(self.segmentations) // 2:
+            return False
+        segs = list(self.filter_untagged(
+            self.segmentations[i] for i in sorted(targets)))
+
+        old_counts = {morph: self._morph_usage.count(morph)
+                      for morph in morphs}
+        # Remove the contributions of the old features
+        for morph in morphs:
+            if old_counts[morph] > 0:
+                self._lexicon_coding.remove(morph)
+            self._corpus_coding.modify_condprob_contribution(morph, -1)
+        self._morph_usage.update_usage_features(
+            morphs, lambda: self.detag_list(segs))
+        for morph in morphs:
+            if self._morph_usage.count(morph) > 0:
+                self._lexicon_coding.add(morph)
+            self._corpus_coding.modify_condprob_contribution(morph, 1)
+        self._corpus_coding.clear_emission_cache()
+        if self._supervised:
+            self._annot_coding.reset_contributions()
+        return True
+
     def _calculate_usage_features(self):
         """Recalculates the morph usage features (perplexities).
         """
@@ -1550,6 +1950,10 @@ class FlatcatModel(AbstractSegmenter):
         for morph in self._morph_usage.seen_morphs():
             self._lexicon_coding.add(morph)
 
+        if self._memory_budget is not None:
+            # Entry sizes depend on the contexts just calculated
+            self._apply_memory_budget()
+
     def _unigram_transition_probs(self):
         """Initial transition probabilities based on unigram distribution.
 
@@ -1627,6 +2031,25 @@ class FlatcatModel(AbstractSegmenter):
             for morph in self.detag_word(segmentation.analysis):
                 self.morph_backlinks[morph].add(i)
 
+    def _add_backlinks(self, i_word):
+        """Adds the backlinks of the corpus word with index i_word,
+        when it has been appended to the corpus."""
+        detagged = self.detag_word(self.segmentations[i_word].analysis)
+        for morph in detagged:
+            self.morph_backlinks[morph].add(i_word)
+        if getattr(self, '_word_backlinks', None) is not None:
+            self._word_backlinks[''.join(detagged)] = i_word
+
+    def _get_word_backlinks(self):
+        """Returns the mapping from corpus words to their indices.
+        The training operations do not change the surface forms of the
+        words, so the mapping only needs updating as words are added."""
+        if getattr(self, '_word_backlinks', None) is None:
+            self._word_backlinks = {
+                ''.join(self.detag_word(seg.analysis)): i
+                for (i, seg) in enumerate(self.segmentations)}
+        return self._word_backlinks
+
     def _epoch_update(self, no_increment=False):
         """Updates performed between training epochs.
         Set the no_increment flag to suppress incrementing
@@ -1660,6 +2083,7 @@ class FlatcatModel(AbstractSegmenter):
             self._morph_usage = MaximumLikelihoodMorphUsage(
                 self._corpus_coding, self._morph_usage.get_params())
             self._calculate_usage_features()
+            self._reestimate_changes = None
             self.training_operations = ['resegment']
             return True
         return force_another
@@ -1736,6 +2160,84 @@ class FlatcatModel(AbstractSegmenter):
         elif old_count > 0 and new_count == 0:
             self._lexicon_coding.remove(morph)
 
+    def _transform_bound_terms(self, transform, targets):
+        """Returns the terms of _transform_cost_lower_bound that are
+        shared by all transforms with the same rule, or None if no
+        bound can be given for the transform.
+        Must be called before the transform is applied to the corpus.
+
+        The terms are the emissions of the morphs matched by the rule
+        in the targets, and the transitions into, within and out of
+        the matches, as a ChangeCounts object with positive counts,
+        together with the transition terms of the corpus cost after
+        removing them.
+
+        Arguments:
+            transform :  A transform of the group to evaluate.
+            targets :  The indices of the words matching the rule.
+        """
+        if not isinstance(transform, Transformation):
+            # Resegmentation replaces whole words
+            return None
+        if isinstance(self._morph_usage, MaximumLikelihoodMorphUsage):
+            # Conditional probabilities depend on the emission counts
+            return None
+        rule = transform.rule
+        removed = ChangeCounts()
+        for target in targets:
+            word = self.segmentations[target]
+            analysis = word.analysis
+            # Transition i goes into morph i, the last one out of the word
+            boundaries = set()
+            for i in rule.matches(analysis):
+                for cmorph in analysis[i:(i + len(rule))]:
+                    removed.emissions[cmorph] += word.count
+                boundaries.update(range(i, i + len(rule) + 1))
+            for i in boundaries:
+                if i == 0:
+                    prev_cat = WORD_BOUNDARY
+                else:
+                    prev_cat = analysis[i - 1].category
+                if i == len(analysis):
+                    next_cat = WORD_BOUNDARY
+                else:
+                    next_cat = analysis[i].category
+                removed.transitions[(prev_cat, next_cat)] += word.count
+        return (removed,
+                self._corpus_coding.transition_bound_terms(
+                    removed.transitions))
+
+    def _transform_cost_lower_bound(self, transform, num_matches,
+                                    bound_terms):
+        """Returns a lower bound for the model cost after applying the
+        transform, or None if no bound can be given.
+        Must be called after the morph counts have been modified,
+        but before the transform is applied to the corpus.
+
+        Arguments:
+            transform :  The Transformation to evaluate.
+            num_matches :  The number of times the rule matches
+                           in the corpus, weighted by word count.
+            bound_terms :  The terms shared by the transforms of the
+                           group, from _transform_bound_terms.
+        """
+        if bound_terms is None:
+            return None
+        (removed, transition_terms) = bound_terms
+        morph_deltas = collections.Counter()
+        for morph in self.detag_word(transform.rule):
+            morph_deltas[morph] -= num_matches
+        for morph in self.detag_word(transform.result):
+            morph_deltas[morph] += num_matches
+        # Each match adds at most the transitions into, within
+        # and out of the morphs of the result.
+        bound = self._corpus_coding.cost_lower_bound(
+            morph_deltas, removed.emissions, transition_terms,
+            num_matches * (len(transform.result) + 1))
+        # The lexicon already reflects the change,
+        # the annotation cost is bounded by zero.
+        return bound + self._lexicon_coding.get_cost()
+
     def _update_counts(self, change_counts, multiplier):
         """Updates the model counts according to the pre-calculated
         ChangeCounts object (e.g. calculated in Transformation).
@@ -1756,19 +2258,14 @@ class FlatcatModel(AbstractSegmenter):
                 change_counts.transitions[(prev_cat, next_cat)] * multiplier)
         self._corpus_coding.clear_transition_cache()
 
-        if multiplier > 0:
-            bl_rm = change_counts.backlinks_remove
-            bl_add = change_counts.backlinks_add
-        else:
-            bl_rm = change_counts.backlinks_add
-            bl_add = change_counts.backlinks_remove
+        (bl_rm, bl_add) = change_counts.resolved_backlinks()
+        if multiplier < 0:
+            (bl_rm, bl_add) = (bl_add, bl_rm)
 
         for morph in bl_rm:
-            self.morph_backlinks[morph].difference_update(
-                change_counts.backlinks_remove[morph])
+            self.morph_backlinks[morph].difference_update(bl_rm[morph])
         for morph in bl_add:
-            self.morph_backlinks[morph].update(
-                change_counts.backlinks_add[morph])
+            self.morph_backlinks[morph].update(bl_add[morph])
 
     ### Private: iteration structure
     #
@@ -1798,8 +2295,14 @@ class FlatcatModel(AbstractSegmenter):
             max_iterations :  Maximum number of iterations. Default 5.
         """
 
+        first_iteration = 0
         previous_cost = self.get_cost()
-        for iteration in range(max_iterations):
+        if self._resuming:
+            first_iteration = self._iteration_number
+            previous_cost = self._iteration_start_cost
+        for iteration in range(first_iteration, max_iterations):
+            self._iteration_number = iteration
+            self._iteration_start_cost = previous_cost
             cost = self.get_cost()
             msg = ('{:9s} {:2d}/{:<2d}          Cost: {:' +
                    self._cost_field_fmt(cost) + 'f}.')
@@ -1953,7 +2456,8 @@ class FlatcatModel(AbstractSegmenter):
                 'min_iteration_cost_gain')
             max_iterations = self._training_params('max_iterations')
             if self._training_params('must_reestimate'):
-                update_func = self.reestimate_probabilities
+                update_func = lambda: self.reestimate_probabilities(
+                    incremental=True)
             else:
                 update_func = None
 
@@ -1967,10 +2471,16 @@ class FlatcatModel(AbstractSegmenter):
                 update_func=update_func,
                 min_cost_gain=min_iteration_cost_gain,
                 max_iterations=max_iterations)
-            self.reestimate_probabilities()
+            self._iteration_number = None
+            self.reestimate_probabilities(incremental=True)
             self._operation_number += 1
             for callback in self.operation_callbacks:
                 callback(self)
+        if isinstance(self._corpus_coding._emission_cache,
+                      utils.BoundedCache):
+            _logger.debug('Emission cache: {}'.format(
+                self._corpus_coding._emission_cache))
+        self._log_memory_usage()
 
     def _single_iteration_epoch(self):
         """One epoch of training, with exactly one iteration of each
@@ -2014,6 +2524,8 @@ class FlatcatModel(AbstractSegmenter):
                                                      'targets'])
         if self._changed_segmentations_op is not None:
             self._changed_segmentations_op.clear()
+        num_candidates = 0
+        num_pruned = 0
         if not self._online:
             transformation_generator = utils._generator_progress(
                 transformation_generator)
@@ -2021,6 +2533,7 @@ class FlatcatModel(AbstractSegmenter):
             (transform_group, targets,
              changed_morphs, temporaries) = experiment
             if len(transform_group) == 0:
+                self._report_gain(0)
                 continue
             # Cost of doing nothing
             old_cost = self.get_cost()
@@ -2031,8 +2544,11 @@ class FlatcatModel(AbstractSegmenter):
             matched_targets, num_matches = self._find_in_corpus(
                 transform_group[0].rule, targets)
             if num_matches == 0:
+                self._report_gain(0)
                 continue
 
+            bound_terms = self._transform_bound_terms(transform_group[0],
+                                                      matched_targets)
             detagged = self.detag_word(transform_group[0].rule)
             if self._supervised:
                 logemissionsum_initial = self._annot_coding.logemissionsum
@@ -2055,6 +2571,17 @@ class FlatcatModel(AbstractSegmenter):
                 for morph in detagged:
                     # Add the new representation to morph counts
                     self._modify_morph_count(morph, num_matches)
+                bound = self._transform_cost_lower_bound(
+                    transform, num_matches, bound_terms)
+                if bound is not None:
+                    num_candidates += 1
+                if bound is not None and bound > best.cost:
+                    # Can not improve on the current best,
+                    # no need to apply and cost it
+                    num_pruned += 1
+                    for morph in detagged:
+                        self._modify_morph_count(morph, -num_matches)
+                    continue
                 for target in matched_targets:
                     old_analysis = self.segmentations[target]
                     transform.apply(old_analysis, self)
@@ -2083,6 +2610,8 @@ class FlatcatModel(AbstractSegmenter):
                 self._update_counts(transform.change_counts, -1)
                 for morph in self.detag_word(transform.result):
                     self._modify_morph_count(morph, -num_matches)
+                # The counts are reused by the next application
+                transform.reset_counts()
 
             if best.transform is None:
                 # Best option was to do nothing. Revert morph count.
@@ -2100,6 +2629,12 @@ class FlatcatModel(AbstractSegmenter):
                     new_analysis = best.transform.apply(
                         self.segmentations[target],
                         self, corpus_index=target)
+                    if self._reestimate_changes is not None:
+                        # The contexts of all morphs in the word change
+                        self._reestimate_changes.update(self.detag_word(
+                            self.segmentations[target].analysis))
+                        self._reestimate_changes.update(
+                            self.detag_word(new_analysis.analysis))
                     self._intern_word(new_analysis.analysis)
                     self.segmentations[target] = new_analysis
                     # any morph used in the best segmentation
@@ -2117,9 +2652,47 @@ class FlatcatModel(AbstractSegmenter):
             self._morph_usage.remove_temporaries(temporaries)
             msg = 'Operation incresed the model cost'
             assert self.get_cost() < old_cost + 0.1, msg
+            self._report_gain(old_cost - best.cost)
+            if not self._online:
+                for callback in self.experiment_callbacks:
+                    callback(self)
+        if num_candidates > 0 and not self._online:
+            _logger.info('Pruned {} of {} candidate transforms'.format(
+                num_pruned, num_candidates))
 
     ### Private: secondary
     #
+    def _apply_memory_budget(self):
+        """Sizes the caches and context builders to fit in the
+        memory budget, based on the current size of their entries."""
+        budget = self._memory_budget
+        self._morph_usage._contexts_per_iter = budget.entries(
+            'context_builders', self._morph_usage.context_builder_size())
+        self._corpus_coding.set_emission_cache_size(budget.entries(
+            'emission_cache',
+            self._corpus_coding.emission_cache_entry_size(),
+            minimum=10))
+        _logger.debug(
+            'Memory budget {}: {} context builders, '
+            '{} cached emission rows'.format(
+                utils._format_memory_size(budget.budget),
+                self._morph_usage._contexts_per_iter,
+                self._corpus_coding._emission_cache.max_size))
+
+    def _log_memory_usage(self):
+        """Logs the memory used by the process, together with the
+        sizes chosen for the structures limited by the budget."""
+        budget = self._memory_budget
+        if budget is None:
+            return
+        _logger.info(
+            'Memory usage: {} resident. Budget {}: {} context builders, '
+            '{} cached emission rows.'.format(
+                utils._format_memory_size(utils._process_memory()),
+                utils._format_memory_size(budget.budget),
+                self._morph_usage._contexts_per_iter,
+                self._corpus_coding._emission_cache.max_size))
+
     def _interned_morph(self, morph, store=False):
         """A homebrew approximation of interning,
         to reduce memory footprint of unicode strings with same content.
@@ -2180,6 +2753,51 @@ class FlatcatModel(AbstractSegmenter):
                                 iteration_name, iteration + 1,
                                 max_iterations, conv_str))
 
+    def _scheduled(self, operation, keys, estimate):
+        """Returns the keys of the experiments in an operation,
+        possibly reordered and cut short by the experiment scheduler.
+
+        Arguments:
+            operation :  Name of the training operation.
+            keys :  Keys identifying the experiments, in default order.
+            estimate :  A function returning a cheap estimate
+                        of the expected gain for a key.
+        """
+        scheduler = self._experiment_scheduler
+        if scheduler is None or operation is None:
+            scheduler = None
+        start = 0
+        if self._resuming and self._iteration_keys is not None:
+            # Continue the iteration interrupted by a checkpoint
+            keys = self._iteration_keys
+            start = self._iteration_position
+        elif scheduler is not None:
+            keys = scheduler.ordered(operation, keys, estimate)
+        else:
+            keys = list(keys)
+        self._resuming = False
+        self._iteration_keys = keys
+        self._iteration_position = start
+        if scheduler is not None:
+            scheduled = scheduler.schedule(operation, keys, start)
+        else:
+            scheduled = keys[start:]
+        return self._track_position(scheduled, start)
+
+    def _track_position(self, keys, start):
+        """Keeps count of the keys consumed from the iteration,
+        for checkpoints."""
+        for (i, key) in enumerate(keys, start):
+            self._iteration_position = i + 1
+            yield key
+        self._iteration_keys = None
+
+    def _report_gain(self, gain):
+        """Informs the experiment scheduler of the gain in cost
+        of the latest experiment."""
+        if self._experiment_scheduler is not None:
+            self._experiment_scheduler.report(gain)
+
     def _cost_convergence_limit(self, min_cost_gain=0.005):
         if min_cost_gain is None:
             return None
@@ -2330,6 +2948,9 @@ class FlatcatEncoding(baseline.CorpusEncoding):
     boundaries: the number of word tokens observed.
     """
 
+    # Number of morphs for which emission probabilities are cached
+    DEFAULT_CACHE_SIZE = 75000
+
     def __init__(self, morph_usage, lexicon_encoding, weight=1.0):
         self._morph_usage = morph_usage
         super(FlatcatEncoding, self).__init__(lexicon_encoding, weight)
@@ -2352,16 +2973,23 @@ class FlatcatEncoding(baseline.CorpusEncoding):
         # Caches for transition and emission logprobs,
         # to avoid wasting effort recalculating.
         self._log_transitionprob_cache = dict()
-        self._log_emissionprob_cache = dict()
-        self._persistent_log_emissionprob_cache = dict()
-        # How frequent must a morph be to count as frequent
-        self._persistence_limit = 3
-        self._cache_size = 75000
+        self._emission_cache = utils.BoundedCache(self.DEFAULT_CACHE_SIZE)
         # Needed very often, reducing function calls
         self._categories = get_categories()
 
         self.logcondprobsum = 0.0
 
+    def __setstate__(self, d):
+        if '_emission_cache' not in d:
+            # replace the caches of models pickled by earlier versions
+            for key in ('_log_emissionprob_cache',
+                        '_persistent_log_emissionprob_cache',
+                        '_persistence_limit', '_cache_size'):
+                d.pop(key, None)
+            d['_emission_cache'] = utils.BoundedCache(
+                self.DEFAULT_CACHE_SIZE)
+        self.__dict__ = d
+
     # Transition count methods
 
     def get_transition_count(self, prev_cat, next_cat):
@@ -2438,10 +3066,9 @@ class FlatcatEncoding(baseline.CorpusEncoding):
         return value
 
     def _emission_helper(self, morph):
-        if morph in self._persistent_log_emissionprob_cache:
-            return self._persistent_log_emissionprob_cache[morph]
-        if morph in self._log_emissionprob_cache:
-            return self._log_emissionprob_cache[morph]
+        tmp = self._emission_cache.get(morph)
+        if tmp is not None:
+            return tmp
         count = self._morph_usage.count(morph)
         zlcount = zlog(count)
         zlctc = self._morph_usage.zlog_category_token_count()
@@ -2458,19 +3085,30 @@ class FlatcatEncoding(baseline.CorpusEncoding):
                          zlctc[cat_index])
             tmp.append(value)
         tmp = ByCategory(*tmp)
-        if count >= self._persistence_limit:
-            if len(self._persistent_log_emissionprob_cache) > self._cache_size:
-                # Dont let the cache grow too big
-                self._persistent_log_emissionprob_cache.clear()
-                self._persistence_limit += 1
-            self._persistent_log_emissionprob_cache[morph] = tmp
-            return tmp
-        if len(self._log_emissionprob_cache) > 10:
-            # Small cache regularly emptied
-            self._log_emissionprob_cache.clear()
-        self._log_emissionprob_cache[morph] = tmp
+        self._emission_cache[morph] = tmp
         return tmp
 
+    def set_emission_cache_size(self, max_size):
+        """Changes the number of morphs for which emission probabilities
+        are cached. An unbounded cache (max_size None) is a plain dict,
+        to avoid the bookkeeping of a BoundedCache on every lookup."""
+        cache = self._emission_cache
+        if max_size is None:
+            if isinstance(cache, utils.BoundedCache):
+                self._emission_cache = dict(cache.items())
+        elif isinstance(cache, utils.BoundedCache):
+            cache.resize(max_size)
+        else:
+            self._emission_cache = utils.BoundedCache(max_size)
+
+    def emission_cache_entry_size(self):
+        """Estimated size in bytes of one entry in the emission
+        probability caches. The morph itself is shared with the
+        corpus, and is not counted."""
+        row = ByCategory(*[float(i) + 0.5
+                           for i in range(len(self._categories))])
+        return utils._sizeof(row) + utils._dict_entry_overhead()
+
     def update_emission_count(self, category, morph, diff_count):
         """Updates the number of observed emissions of a single morph from a
         single category, and the logtokensum (which is category independent).
@@ -2499,6 +3137,18 @@ class FlatcatEncoding(baseline.CorpusEncoding):
         # cached probabilities no longer valid
         self.clear_emission_cache()
 
+    def modify_condprob_contribution(self, morph, direction):
+        """Removes or readds the contribution of a morph to
+        logcondprobsum. The contribution must be removed before
+        the conditional probabilities of the morph change, and
+        readded after.
+        """
+        counts = self._emission_counts[morph]
+        condprobs = self._morph_usage.condprobs(morph)
+        for (count, condprob) in zip(counts, condprobs):
+            if count > 0:
+                self.logcondprobsum -= direction * count * zlog(condprob)
+
     def _set_emission_counts(self, morph, new_counts):
         """Set the number of emissions of a morph from all categories
         simultaneously.
@@ -2532,14 +3182,12 @@ class FlatcatEncoding(baseline.CorpusEncoding):
         self.logtokensum = 0.0
         self.logcondprobsum = 0.0
         self._emission_counts.clear()
-        self._persistent_log_emissionprob_cache.clear()
-        self._log_emissionprob_cache.clear()
+        self._emission_cache.clear()
 
     def clear_emission_cache(self):
         """Clears the cache for emission probability values.
         Use if an incremental change invalidates cached values."""
-        self._persistent_log_emissionprob_cache.clear()
-        self._log_emissionprob_cache.clear()
+        self._emission_cache.clear()
 
     def clear_transition_cache(self):
         """Clears the cache for emission probability values.
@@ -2614,6 +3262,104 @@ class FlatcatEncoding(baseline.CorpusEncoding):
                  + self.frequency_distribution_cost()
                 )
 
+    def transition_bound_terms(self, removed):
+        """Returns the sum of t * log(t) over the transition counts t
+        remaining after removing the given transitions, and the
+        largest remaining count. Used by cost_lower_bound.
+
+        Arguments:
+            removed :  dict of the number of transitions removed,
+                       indexed by (prev_cat, next_cat).
+        """
+        forbidden = MorphUsageProperties.zero_transitions
+        logtransitionsum = 0.0
+        most = 0
+        for (pair, count) in self._transition_counts.items():
+            if pair in forbidden:
+                continue
+            count -= removed.get(pair, 0)
+            most = max(most, count)
+            if count > 1:
+                logtransitionsum += count * math.log(count)
+        return (logtransitionsum, most)
+
+    def cost_lower_bound(self, morph_deltas, removed_emissions,
+                         transition_terms, max_added):
+        """Lower bound for the cost after a local change of the
+        segmentation, which has not yet been applied to the counts.
+
+        The token counts of the morphs are known exactly,
+        and so are the emissions and transitions removed by the change.
+        Only the categories of the new occurrences and the transitions
+        surrounding them are unknown.
+        Each new occurrence of a morph is assumed to be emitted
+        from its cheapest category, and the added transitions are all
+        assumed to go to the most frequent remaining transition.
+        The conditional probabilities P(Category|Morph) must not depend
+        on the emission counts.
+
+        Arguments:
+            morph_deltas :  dict of the change in the number of
+                            occurrences, indexed by morph.
+            removed_emissions :  dict of the number of removed
+                                 emissions, indexed by CategorizedMorph.
+            transition_terms :  The transition terms after the removal,
+                                from transition_bound_terms.
+            max_added :  upper limit for the number of
+                         transitions added.
+        """
+        if self.boundaries == 0:
+            return 0.0
+        categories = get_categories()
+        tokens = self.tokens
+        logtokensum = self.logtokensum
+        condcost = -self.logcondprobsum
+        for (morph, delta) in morph_deltas.items():
+            counts = self._emission_counts[morph]
+            zlogprobs = [zlog(p) for p in self._morph_usage.condprobs(morph)]
+            old_total = sum(counts)
+            new_total = old_total + delta
+            tokens += delta
+            if old_total > 1:
+                logtokensum -= old_total * math.log(old_total)
+            if new_total > 1:
+                logtokensum += new_total * math.log(new_total)
+            # The occurrences outside the change keep their categories
+            kept = 0
+            for (cat, count, zlp) in zip(categories, counts, zlogprobs):
+                removed = removed_emissions.get(CategorizedMorph(morph, cat),
+                                                0)
+                condcost -= removed * zlp
+                kept += count - removed
+            condcost += (new_total - kept) * min(zlogprobs)
+        if tokens <= 0:
+            return 0.0
+
+        # Upper bound for the sum of t * log(t) over transitions.
+        # Adding to the most frequent transition increases it the most.
+        (logtransitionsum, most) = transition_terms
+        if max_added > 0:
+            logtransitionsum += ((most + max_added) *
+                                 math.log(most + max_added))
+            if most > 1:
+                logtransitionsum -= most * math.log(most)
+
+        n = tokens + self.boundaries
+        types = self.types
+        if types < 2:
+            freqdist = 0.0
+        else:
+            freqdist = (self._logfactorial(tokens - 1) -
+                        self._logfactorial(types - 2) -
+                        self._logfactorial(tokens - types + 1))
+        return ((tokens * math.log(tokens)
+                 - logtokensum
+                 + condcost
+                 - logtransitionsum
+                 + n * math.log(n)
+                ) * self.weight
+                + freqdist)
+
 
 class FlatcatAnnotatedCorpusEncoding(object):
     """Class for calculating the cost of encoding the annotated corpus"""
@@ -2742,6 +3488,9 @@ class ChangeCounts(object):
     emission and transition counts and morph backlinks.
     Used to reduce the number of model updates and to make
     reverting changes easier.
+
+    The object can be reused by calling clear, which is cheaper than
+    allocating a new one for every candidate transformation.
     """
 
     __slots__ = ['emissions', 'transitions',
@@ -2771,22 +3520,50 @@ class ChangeCounts(object):
                             occur in will be updated. corpus_index is then
                             the index of the current occurence being updated.
         """
-
+        emissions = self.emissions
+        transitions = self.transitions
+        backlinks = None
+        if corpus_index is not None:
+            if count < 0:
+                backlinks = self.backlinks_remove
+            elif count > 0:
+                backlinks = self.backlinks_add
+
+        # Transitions are counted directly from the categories,
+        # with implicit word boundaries at both ends
+        prev_cat = WORD_BOUNDARY
         for cmorph in analysis:
-            self.emissions[cmorph] += count
-            if corpus_index is not None:
-                if count < 0:
-                    self.backlinks_remove[cmorph.morph].add(corpus_index)
-                elif count > 0:
-                    self.backlinks_add[cmorph.morph].add(corpus_index)
-        wb_extended = _wb_wrap(analysis)
-        for (prefix, suffix) in utils.ngrams(wb_extended, n=2):
-            self.transitions[(prefix.category, suffix.category)] += count
-        # Make sure that backlinks_remove and backlinks_add are disjoint
-        # Removal followed by readding is the same as just adding
-        for morph in self.backlinks_add:
-            self.backlinks_remove[morph].difference_update(
-                self.backlinks_add[morph])
+            emissions[cmorph] = emissions.get(cmorph, 0) + count
+            pair = (prev_cat, cmorph.category)
+            transitions[pair] = transitions.get(pair, 0) + count
+            prev_cat = cmorph.category
+            if backlinks is not None:
+                backlinks[cmorph.morph].add(corpus_index)
+        pair = (prev_cat, WORD_BOUNDARY)
+        transitions[pair] = transitions.get(pair, 0) + count
+
+    def resolved_backlinks(self):
+        """Returns the backlink changes as a pair of dicts
+        (removals, additions), mapping morphs to sets of corpus indices.
+
+        Removal followed by readding is the same as just adding,
+        so any index that is both removed and added is only added.
+        The conflicts are resolved here once, instead of on every update.
+        """
+        removals = {}
+        for (morph, indices) in self.backlinks_remove.items():
+            if morph in self.backlinks_add:
+                indices = indices.difference(self.backlinks_add[morph])
+            if len(indices) > 0:
+                removals[morph] = indices
+        return (removals, self.backlinks_add)
+
+    def clear(self):
+        """Resets all accumulated changes, for reuse of the object."""
+        self.emissions.clear()
+        self.transitions.clear()
+        self.backlinks_remove.clear()
+        self.backlinks_add.clear()
 
 
 class TransformationRule(object):
@@ -2801,6 +3578,27 @@ class TransformationRule(object):
             categorized_morphs = (categorized_morphs,)
         self._rule = categorized_morphs
         self._context_type = context_type
+        self._matcher = self._compile()
+
+    def _compile(self):
+        """Selects a matcher specialised for the type of rule.
+        The rules generated by the training operations have simple
+        forms, that can be matched without the generic comparison loop.
+        """
+        rule = self._rule
+        if (len(rule) == 1 and
+                self._context_type is None and
+                rule[0].morph is not None and
+                rule[0].category is None):
+            # Single morph with any category (split)
+            return self._match_morph
+        if (len(rule) == 2 and
+                self._context_type is not None and
+                all(cmorph.morph is not None and cmorph.category is not None
+                    for cmorph in rule)):
+            # Tagged bimorph in context (join, shift)
+            return self._match_bimorph
+        return self._match_generic
 
     def __len__(self):
         return len(self._rule)
@@ -2826,39 +3624,90 @@ class TransformationRule(object):
                     return False
         # Compare context type
         if self._context_type is not None:
-            if i <= 0:
-                prev_morph = WORD_BOUNDARY
-                prev_category = WORD_BOUNDARY
-            else:
-                prev_morph = analysis[i - 1].morph
-                prev_category = analysis[i - 1].category
-            if (i + len(self)) >= len(analysis):
-                next_morph = WORD_BOUNDARY
-                next_category = WORD_BOUNDARY
-            else:
-                next_morph = analysis[i + len(self)].morph
-                next_category = analysis[i + len(self)].category
-            context_type = MorphUsageProperties.context_type(
-                                prev_morph, next_morph,
-                                prev_category, next_category)
-            if self._context_type != context_type:
+            if self._context_type != self._context_at(analysis, i):
                 return False
 
         # No comparison failed
         return True
 
+    def _context_at(self, analysis, i):
+        """The context type of a match of this rule at the given index."""
+        if i <= 0:
+            prev_morph = WORD_BOUNDARY
+            prev_category = WORD_BOUNDARY
+        else:
+            prev_morph = analysis[i - 1].morph
+            prev_category = analysis[i - 1].category
+        if (i + len(self)) >= len(analysis):
+            next_morph = WORD_BOUNDARY
+            next_category = WORD_BOUNDARY
+        else:
+            next_morph = analysis[i + len(self)].morph
+            next_category = analysis[i + len(self)].category
+        return MorphUsageProperties.context_type(
+            prev_morph, next_morph, prev_category, next_category)
+
+    def matches(self, analysis):
+        """Returns the indices at which this rule matches the analysis.
+        Greedy application of the rule is used."""
+        return self._matcher(analysis)
+
     def num_matches(self, analysis):
         """Total number of matches of this rule in the analysis.
         Greedy application of the rule is used."""
+        return len(self._matcher(analysis))
+
+    def _match_morph(self, analysis):
+        morph = self._rule[0].morph
+        return [i for (i, cmorph) in enumerate(analysis)
+                if cmorph.morph == morph]
+
+    def _match_bimorph(self, analysis):
+        (first, second) = self._rule
+        table = MorphUsageProperties.context_type_table()
+        out = []
+        i = 0
+        last = len(analysis) - 1
+        while i < last:
+            cmorph = analysis[i]
+            if (cmorph.morph != first.morph or
+                    cmorph.category != first.category):
+                i += 1
+                continue
+            cmorph = analysis[i + 1]
+            if (cmorph.morph != second.morph or
+                    cmorph.category != second.category):
+                i += 1
+                continue
+            if i == 0:
+                prev_category = WORD_BOUNDARY
+            else:
+                prev_category = analysis[i - 1].category
+            if i + 1 == last:
+                next_category = WORD_BOUNDARY
+            else:
+                next_category = analysis[i + 2].category
+            context_type = table.get((prev_category, next_category), None)
+            if context_type is None:
+                # Untagged context
+                context_type = self._context_at(analysis, i)
+            if context_type != self._context_type:
+                i += 1
+                continue
+            out.append(i)
+            i += 2
+        return out
+
+    def _match_generic(self, analysis):
+        out = []
         i = 0
-        matches = 0
         while i + len(self) <= len(analysis):
             if self.match_at(analysis, i):
+                out.append(i)
                 i += len(self)
-                matches += 1
             else:
                 i += 1
-        return matches
+        return out
 
 
 class Transformation(object):
@@ -2894,22 +3743,16 @@ class Transformation(object):
                             the change is temporary and morph to word
                             backlinks don't need to be updated.
         """
-        i = 0
+        positions = self.rule.matches(word.analysis)
         out = []
-        matches = 0
-        while i + len(self.rule) <= len(word.analysis):
-            if self.rule.match_at(word.analysis, i):
-                out.extend(self.result)
-                i += len(self.rule)
-                matches += 1
-            else:
-                out.append(word.analysis[i])
-                i += 1
-        while i < len(word.analysis):
-            out.append(word.analysis[i])
-            i += 1
+        i = 0
+        for match in positions:
+            out.extend(word.analysis[i:match])
+            out.extend(self.result)
+            i = match + len(self.rule)
+        out.extend(word.analysis[i:])
 
-        if matches > 0:
+        if len(positions) > 0:
             # Only retag if the rule matched something
             out = model.fast_tag_gaps(out)
             #out = model.viterbi_tag(out)
@@ -2921,7 +3764,7 @@ class Transformation(object):
         return WordAnalysis(word.count, tuple(out))
 
     def reset_counts(self):
-        self.change_counts = ChangeCounts()
+        self.change_counts.clear()
 
 
 class ViterbiResegmentTransformation(object):
@@ -2953,7 +3796,90 @@ class ViterbiResegmentTransformation(object):
         return WordAnalysis(word.count, self.result)
 
     def reset_counts(self):
-        self.change_counts = ChangeCounts()
+        self.change_counts.clear()
+
+
+class ExperimentScheduler(object):
+    """Orders the experiments of a training iteration by expected gain,
+    and cuts the iteration short when the gains dry up.
+
+    Experiments that were accepted in the previous iteration of the
+    same operation are performed first (largest gain first),
+    followed by untried experiments and finally those that were
+    rejected, both ordered by a cheap estimate given by the operation.
+    """
+
+    def __init__(self, order=True, min_gain=None, window=100):
+        """
+        Arguments:
+            order :  Reorder the experiments by expected gain.
+            min_gain :  Stop the iteration when the total gain of the
+                        last window experiments is below this limit,
+                        or None to never stop early.
+            window :  Number of recent experiments to consider.
+        """
+        self.order = order
+        self.min_gain = min_gain
+        self.window = window
+        # (operation, key) -> gain in the latest experiment
+        self._history = {}
+        self._current = None
+        self._recent = collections.deque(maxlen=window)
+
+    def ordered(self, operation, keys, estimate):
+        """Returns a list of the keys identifying the experiments
+        of an iteration, in the order they should be performed.
+
+        Arguments:
+            operation :  Name of the training operation.
+            keys :  Keys identifying the experiments.
+            estimate :  A function returning a cheap estimate
+                        of the expected gain for a key.
+        """
+        keys = list(keys)
+        if self.order:
+            def priority(key):
+                gain = self._history.get((operation, key), None)
+                if gain is None:
+                    return (1, estimate(key))
+                if gain > 0:
+                    return (2, gain)
+                return (0, estimate(key))
+            keys.sort(key=priority, reverse=True)
+        return keys
+
+    def schedule(self, operation, keys, start=0):
+        """Yields the ordered keys, until the gains dry up.
+
+        Arguments:
+            operation :  Name of the training operation.
+            keys :  Keys returned by ordered.
+            start :  Index of the first key, when continuing
+                     an interrupted iteration.
+        """
+        if start == 0:
+            self._recent.clear()
+        for i in range(start, len(keys)):
+            key = keys[i]
+            if (self.min_gain is not None and
+                    len(self._recent) == self.window and
+                    sum(self._recent) < self.min_gain):
+                _logger.info(
+                    'Cut off {} iteration, skipped {} of {} '
+                    'experiments ({:.1%}).'.format(
+                        operation, len(keys) - i, len(keys),
+                        float(len(keys) - i) / len(keys)))
+                break
+            self._current = (operation, key)
+            yield key
+        self._current = None
+
+    def report(self, gain):
+        """Records the gain of the most recently scheduled experiment."""
+        if self._current is None:
+            return
+        self._history[self._current] = gain
+        self._recent.append(gain)
 
 
 class CostBreakdown(object):
@@ -1,25 +1,48 @@
-from __future__ import unicode_literals
+from __future__ import absolute_import, unicode_literals
 
 import collections
 import datetime
+import gc
+import io as iolib
 import logging
 import re
+import string
 import sys
+import threading
+import time
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import array
 import bz2
 import codecs
 import gzip
 import locale
+import multiprocessing
+import numbers
 import os
+import struct
 import tarfile
+import zlib
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import morfessor
 
 from . import get_version
+from . import utils
 from .categorizationscheme import get_categories, CategorizedMorph
-from .exception import InvalidCategoryError
-from .flatcat import FlatcatModel
+from .categorizationscheme import ByCategory
+from .exception import InvalidCategoryError, InvalidModelFileError
+from .flatcat import FlatcatModel, WordAnalysis
 from .utils import _generator_progress, _is_string
 
 PY3 = sys.version_info.major == 3
@@ -33,6 +56,15 @@ _logger = logging.getLogger(__name__)
 
 BINARY_ENDINGS = ('.pickled', '.pickle', '.bin')
 TARBALL_ENDINGS = ('.tar.gz', '.tgz')
+PACKED_ENDINGS = ('.packed',)
+
+# Categories accepted when reading in strict mode
+_CATEGORIES = frozenset(get_categories())
+
+PACKED_MAGIC = b'FLATCATP'
+PACKED_FORMAT_VERSION = 1
+# The categories of the morphs in the corpus are stored as indices
+PACKED_CATEGORIES = get_categories() + [None]
 
 
 class FlatcatIO(morfessor.MorfessorIO):
@@ -46,6 +78,23 @@ class FlatcatIO(morfessor.MorfessorIO):
     Extends Morfessor Baseline data file formats to include category tags.
     """
 
+    # Large files are read in blocks of this many bytes,
+    # or when reading from a stream, this many lines.
+    READ_BLOCK_SIZE = 4 * 1024 * 1024
+    READ_BLOCK_LINES = 10000
+    # Number of threads compressing gzip output (None: one per cpu)
+    COMPRESSION_THREADS = None
+    # Buffer sizes in bytes for reading and writing files
+    READ_BUFFER_SIZE = 1024 * 1024
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    # write_formatted_file writes this many lines at a time
+    WRITE_BATCH_LINES = 1000
+    # Compressed files are decompressed ahead of the reader
+    # in a background thread, which reads blocks of this many bytes.
+    READ_AHEAD_SIZE = 1024 * 1024
+    # Number of bytes used for detecting the encoding of a file
+    ENCODING_SNIFF_SIZE = 1024 * 1024
+
     def __init__(self,
                  encoding=None,
                  construction_separator=' + ',
@@ -109,6 +158,9 @@ class FlatcatIO(morfessor.MorfessorIO):
         """Read a complete model in either binary or tarball format.
            This method can NOT be used to initialize from a
            Morfessor 1.0 style segmentation"""
+        if any(file_name.endswith(ending) for ending in PACKED_ENDINGS):
+            # Packed models are ready to use
+            return self.read_packed_model_file(file_name)
         if any(file_name.endswith(ending) for ending in BINARY_ENDINGS):
             model = self.read_binary_model_file(file_name)
         elif any(file_name.endswith(ending) for ending in TARBALL_ENDINGS):
@@ -119,6 +171,69 @@ class FlatcatIO(morfessor.MorfessorIO):
         model.initialize_hmm()
         return model
 
+    def write_packed_model_file(self, file_name, model):
+        """Write the model in the packed binary format.
+
+        Unlike the pickled binary model, the packed model includes all
+        derived state (usage features, emission counts, backlinks),
+        so that the model read by read_packed_model_file is ready to use
+        without initialize_hmm or reestimate_probabilities.
+        The morphs, the corpus and the per-morph state are stored in
+        array sections, each protected by a checksum.
+        """
+        _logger.info("Saving packed model to '{}'...".format(file_name))
+        tmp_name = '{}.tmp'.format(file_name)
+        with open(tmp_name, 'wb') as fobj:
+            PackedModelWriter(fobj).write(model, self._version)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        _replace_file(tmp_name, file_name)
+        _logger.info("Done.")
+
+    def read_packed_model_file(self, file_name):
+        """Read a model written by write_packed_model_file."""
+        _logger.info("Loading packed model from '{}'...".format(file_name))
+        with open(file_name, 'rb') as fobj:
+            try:
+                (version, model) = PackedModelReader(fobj).read()
+            except (ValueError, struct.error, EOFError) as e:
+                raise InvalidModelFileError(file_name, e)
+        if version != self._version:
+            _logger.warning(
+                'Packed model written by version {}, this is {}'.format(
+                    version, self._version))
+        _logger.info("Done.")
+        return model
+
+    def write_checkpoint_file(self, file_name, model):
+        """Write a checkpoint for resuming training.
+        The file is replaced atomically, so that an interruption
+        while writing leaves the previous checkpoint intact."""
+        _logger.info("Writing checkpoint to '{}'...".format(file_name))
+        tmp_name = '{}.tmp'.format(file_name)
+        with open(tmp_name, 'wb') as fobj:
+            pickle.dump({'version': self._version,
+                         'state': model.get_checkpoint_state()},
+                        fobj, pickle.HIGHEST_PROTOCOL)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        _replace_file(tmp_name, file_name)
+        _logger.info("Done.")
+
+    def read_checkpoint_file(self, file_name):
+        """Read a model from a checkpoint.
+        Continue training with resume_batch_training."""
+        _logger.info("Loading checkpoint from '{}'...".format(file_name))
+        with open(file_name, 'rb') as fobj:
+            checkpoint = pickle.load(fobj)
+        if checkpoint['version'] != self._version:
+            _logger.warning(
+                'Checkpoint written by version {}, this is {}'.format(
+                    checkpoint['version'], self._version))
+        model = FlatcatModel.from_checkpoint_state(checkpoint['state'])
+        _logger.info("Done.")
+        return model
+
     def write_segmentation_file(self, file_name, segmentations,
                                 construction_sep=None,
                                 output_tags=True,
@@ -146,25 +261,30 @@ class FlatcatIO(morfessor.MorfessorIO):
                 file_obj.write('{} {}\n'.format(count, s))
         _logger.info("Done.")
 
-    def read_segmentation_file(self, file_name):
+    def read_segmentation_file(self, file_name, num_processes=1):
         """Read segmentation file.
         see docstring for write_segmentation_file for file format.
+
+        Arguments:
+            file_name :  The file to read.
+            num_processes :  Number of worker processes
+                             for parsing the blocks of the file.
         """
         _logger.info("Reading segmentations from '%s'..." % file_name)
-        re_space = re.compile(r'\s+')
-        for line in self._read_text_file(file_name):
-            count, analysis = re_space.split(line, 1)
-            try:
-                count = int(count)
-            except ValueError:
-                # first column was compound instead of count
-                count = 1
-            cmorphs = []
-            for morph_cat in analysis.split(self.construction_separator):
-                cmorphs.append(self._morph_or_cmorph(morph_cat))
-            yield(count, tuple(cmorphs))
+        for block in self.read_segmentation_blocks(file_name,
+                                                   num_processes):
+            for row in block:
+                yield row
         _logger.info("Done.")
 
+    def read_segmentation_blocks(self, file_name, num_processes=1):
+        """Read a segmentation file as lists of (count, analysis)
+        rows, one list per block of the file."""
+        parser = _SegmentationBlockParser(self)
+        for block in self._read_line_blocks(file_name, parser,
+                                            num_processes):
+            yield block
+
     def read_annotations_file(self, file_name, construction_sep=' ',
                               analysis_sep=None):
         """Read an annotations file.
@@ -179,12 +299,10 @@ class FlatcatIO(morfessor.MorfessorIO):
                         else self.analysis_separator)
         annotations = collections.defaultdict(list)
         _logger.info("Reading annotations from '%s'..." % file_name)
-        for line in self._read_text_file(file_name):
-            compound, analyses_line = line.split(None, 1)
-            analysis = self.read_annotation(analyses_line,
-                                             construction_sep,
-                                             analysis_sep)
-            annotations[compound].extend(analysis)
+        parser = _AnnotationBlockParser(self, construction_sep, analysis_sep)
+        for block in self._read_line_blocks(file_name, parser):
+            for (compound, analysis) in block:
+                annotations[compound].extend(analysis)
         _logger.info("Done.")
         return annotations
 
@@ -262,11 +380,18 @@ class FlatcatIO(morfessor.MorfessorIO):
                              analysis_sep=None,
                              category_sep=None,
                              filter_tags=None,
-                             filter_len=3):
+                             filter_len=3,
+                             num_processes=None):
         """Writes a file in the specified format.
 
         Formatting is flexible: even formats that cannot be read by
         FlatCat can be specified.
+
+        If num_processes is given, the data is read, processed and
+        written in the concurrent stages of a utils.Pipeline, with
+        data_func and the formatting applied in num_processes worker
+        processes. Otherwise each item is written before the next
+        is read, as needed for interactive use.
         """
         construction_sep = (construction_sep if construction_sep
                             else self.construction_separator)
@@ -275,46 +400,41 @@ class FlatcatIO(morfessor.MorfessorIO):
         category_sep = (category_sep if category_sep
                         else self.category_separator)
 
-        output_morph = _make_morph_formatter(category_sep, output_tags)
-
-        with self._open_text_file_write(file_name) as fobj:
-            for item in _generator_progress(data):
-                if newline_func is not None and newline_func(item):
-                    if output_newlines:
-                        fobj.write("\n")
-                    continue
-                (count, compound, alternatives, logp, clogp) = data_func(item)
-
-                analysis = []
-                if len(alternatives) == 1:
-                    constructions = alternatives[0]
-                    num_morphs = len(constructions)
-                    num_nonmorphemes = sum(1 for cmorph in constructions
-                                           if cmorph.category == 'ZZZ')
-                    num_letters = sum(len(cmorph.morph)
-                                      for cmorph in constructions)
-                else:
-                    num_morphs = None
-                    num_nonmorphemes = None
-                    num_letters = None
-                for constructions in alternatives:
-                    if filter_tags is not None:
-                        constructions = [cmorph for cmorph in constructions
-                                        if cmorph.category not in filter_tags
-                                            or len(cmorph) > filter_len]
-                    constructions = [output_morph(cmorph)
-                                     for cmorph in constructions]
-                    analysis.append(construction_sep.join(constructions))
-                analysis = analysis_sep.join(analysis)
-                fobj.write(line_format.format(
-                                analysis=analysis,
-                                compound=compound,
-                                count=count,
-                                logprob=logp,
-                                clogprob=clogp,
-                                num_morphs=num_morphs,
-                                num_nonmorphemes=num_nonmorphemes,
-                                num_letters=num_letters))
+        formatter = _LineFormatter(line_format,
+                                   construction_sep=construction_sep,
+                                   analysis_sep=analysis_sep,
+                                   category_sep=category_sep,
+                                   output_tags=output_tags,
+                                   filter_tags=filter_tags,
+                                   filter_len=filter_len)
+        if file_name == '-' and num_processes is None:
+            # Interactive use expects each line without delay
+            batch_lines = 1
+        else:
+            batch_lines = self.WRITE_BATCH_LINES
+
+        def format_item(item):
+            if newline_func is not None and newline_func(item):
+                if output_newlines:
+                    return '\n'
+                return ''
+            return formatter(*data_func(item))
+
+        def write_lines(formatted):
+            with self._open_text_file_write(file_name) as fobj:
+                lines = []
+                for line in formatted:
+                    lines.append(line)
+                    if len(lines) >= batch_lines:
+                        fobj.write(''.join(lines))
+                        lines = []
+                fobj.write(''.join(lines))
+
+        data = _generator_progress(data)
+        if num_processes is None:
+            write_lines(format_item(item) for item in data)
+        else:
+            utils.Pipeline(format_item, num_processes).run(data, write_lines)
 
     def read_annotation(self, line, construction_sep, analysis_sep=None):
         if analysis_sep is not None:
@@ -333,16 +453,63 @@ class FlatcatIO(morfessor.MorfessorIO):
         """Parses a string describing a morph, either tagged
         or not tagged, returing a CategorizedMorph.
         """
-        parts = morph_cat.rsplit(self.category_separator, 1)
-        morph = parts[0].strip()
-        if len(parts) == 1:
-            category = None
-        else:
-            category = parts[1]
-            if self._strict and category not in get_categories():
-                raise InvalidCategoryError(category)
-        cmorph = CategorizedMorph(morph, category)
-        return cmorph
+        (morph, category) = _parse_morph(
+            morph_cat, self.category_separator, self._strict)
+        return CategorizedMorph(morph, category)
+
+    def _read_line_blocks(self, file_name, parser, num_processes=1):
+        """Reads a text file in blocks, returning the result of
+        parsing the lines of each block with parser.
+
+        Files are read as blocks of raw bytes, which are decoded,
+        split into lines and parsed by the parser, optionally in
+        num_processes worker processes. Streams, and files in
+        encodings in which a newline byte may be part of another
+        character, are read line by line and parsed in blocks of lines.
+        """
+        if (_is_string(file_name) and file_name != '-' and
+                self.encoding is None):
+            self.encoding = self._sniff_encoding(file_name)
+        if (not _is_string(file_name) or file_name == '-' or
+                not _ascii_compatible(self.encoding)):
+            lines = []
+            for line in self._read_text_file(file_name):
+                lines.append(line)
+                if len(lines) >= self.READ_BLOCK_LINES:
+                    yield parser.finish(parser.parse_lines(lines))
+                    lines = []
+            if len(lines) > 0:
+                yield parser.finish(parser.parse_lines(lines))
+            return
+
+        parser.encoding = self.encoding
+        blocks = _read_byte_blocks(self._open_binary_file_read(file_name),
+                                   self.READ_BLOCK_SIZE)
+        if num_processes <= 1:
+            for data in blocks:
+                yield parser.finish(parser(data))
+            return
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 2 always forks on posix
+            context = multiprocessing
+        pool = context.Pool(num_processes)
+        try:
+            # At most two blocks per process are in flight,
+            # to bound the memory used for the read blocks
+            pending = collections.deque()
+            for data in blocks:
+                pending.append(pool.apply_async(_parse_block,
+                                                (parser, data)))
+                if len(pending) >= 2 * num_processes:
+                    yield parser.finish(
+                        _block_result(pending.popleft().get()))
+            while len(pending) > 0:
+                yield parser.finish(_block_result(pending.popleft().get()))
+        finally:
+            pool.terminate()
 
     #### This can be removed once it finds its way to Baseline ####
     #
@@ -355,18 +522,21 @@ class FlatcatIO(morfessor.MorfessorIO):
                 if PY3:
                     return file_obj
             elif file_name.endswith('.gz'):
-                file_obj = gzip.open(file_name, 'wb')
+                file_obj = ParallelGzipWriter(
+                    file_name, num_threads=self.COMPRESSION_THREADS)
             elif file_name.endswith('.bz2'):
                 file_obj = bz2.BZ2File(file_name, 'wb')
             else:
-                file_obj = open(file_name, 'wb')
+                file_obj = iolib.open(file_name, 'wb',
+                                      buffering=self.WRITE_BUFFER_SIZE)
         else:
             file_obj = file_name_or_obj
 
         if self.encoding is None:
             # Take encoding from locale if not set so far
             self.encoding = locale.getpreferredencoding()
-        return codecs.getwriter(self.encoding)(file_obj)
+        return _text_wrapper(file_obj, self.encoding,
+                             self.WRITE_BUFFER_SIZE, write=True)
 
     def _open_text_file_read(self, file_name_or_obj):
         """Open a file for reading with the appropriate compression/encoding"""
@@ -392,23 +562,55 @@ class FlatcatIO(morfessor.MorfessorIO):
                             return l.decode(self.encoding)
 
                     return StdinUnicodeReader(self.encoding)
-            else:
-                if file_name.endswith('.gz'):
-                    file_obj = gzip.open(file_name, 'rb')
-                elif file_name.endswith('.bz2'):
-                    file_obj = bz2.BZ2File(file_name, 'rb')
-                else:
-                    file_obj = open(file_name, 'rb')
+            if self.encoding is None:
+                # Try to determine encoding if not set so far
+                self.encoding = self._sniff_encoding(file_name)
+            file_obj = self._open_binary_file_read(file_name)
         else:
             file_obj = file_name_or_obj
             if self.encoding is None:
                 self.encoding = locale.getpreferredencoding()
 
-        if self.encoding is None:
-            # Try to determine encoding if not set so far
-            self.encoding = self._find_encoding(file_name)
-        inp = codecs.getreader(self.encoding)(file_obj)
-        return inp
+        return _text_wrapper(file_obj, self.encoding,
+                             self.READ_BUFFER_SIZE)
+
+    def _open_binary_file_read(self, file_name, read_ahead=True):
+        """Open a possibly compressed file for reading bytes.
+        Compressed files are decompressed by a read-ahead thread,
+        unless read_ahead is False."""
+        if file_name.endswith('.gz'):
+            file_obj = gzip.open(file_name, 'rb')
+        elif file_name.endswith('.bz2'):
+            file_obj = bz2.BZ2File(file_name, 'rb')
+        else:
+            return iolib.open(file_name, 'rb',
+                              buffering=self.READ_BUFFER_SIZE)
+        if not read_ahead:
+            return file_obj
+        return iolib.BufferedReader(
+            ReadAheadReader(file_obj, self.READ_AHEAD_SIZE),
+            self.READ_BUFFER_SIZE)
+
+    def _sniff_encoding(self, file_name):
+        """Determines the encoding of a file from its beginning.
+
+        Unlike _find_encoding, only the first ENCODING_SNIFF_SIZE bytes
+        of the file are read, instead of the whole file once for
+        each encoding tried.
+        """
+        with self._open_binary_file_read(file_name,
+                                         read_ahead=False) as file_obj:
+            prefix = file_obj.read(self.ENCODING_SNIFF_SIZE)
+        for encoding in ('utf-8', locale.getpreferredencoding()):
+            # The prefix may end in the middle of a character
+            decoder = codecs.getincrementaldecoder(encoding)()
+            try:
+                decoder.decode(prefix, final=False)
+            except UnicodeDecodeError:
+                continue
+            _logger.info("Detected %s encoding", encoding)
+            return encoding
+        raise UnicodeError("Can not determine encoding of input files")
 
     # straight copypasta
     def _read_text_file(self, file_name, raw=False):
@@ -452,6 +654,567 @@ class FlatcatIO(morfessor.MorfessorIO):
         return params
 
 
+class _LineBlockParser(object):
+    """Decodes a block of bytes into lines, and parses them.
+    The lines are filtered as by FlatcatIO._read_text_file.
+
+    Subclasses implement _parse_lines, returning a picklable result
+    which is converted into the parsed rows by finish. This allows
+    the parsing to be done in a worker process, and the rows to be
+    built in the main process.
+    """
+
+    def __init__(self, io):
+        self.encoding = io.encoding
+        self.comment_start = io.comment_start
+        self.lowercase = io.lowercase
+        self.category_separator = io.category_separator
+        self.strict = io._strict
+
+    def __call__(self, data):
+        lines = []
+        for line in _split_lines(data.decode(self.encoding)):
+            line = line.rstrip()
+            if len(line) == 0 or line.startswith(self.comment_start):
+                continue
+            if self.lowercase:
+                line = line.lower()
+            lines.append(line)
+        return self.parse_lines(lines)
+
+    def parse_lines(self, lines):
+        # The cyclic garbage collector is disabled while parsing,
+        # as it would repeatedly scan the many new objects
+        with _gc_disabled():
+            return self._parse_lines(lines)
+
+    def finish(self, result):
+        return result
+
+    def _parse_lines(self, lines):
+        raise NotImplementedError()
+
+    def _morph_parser(self):
+        """Returns a function parsing a morph string into an index
+        in a table of (morph, category) pairs. The table is returned
+        as the second value."""
+        indices = {}
+        table = []
+        category_sep = self.category_separator
+        strict = self.strict
+
+        def parse_morph(morph_cat):
+            try:
+                return indices[morph_cat]
+            except KeyError:
+                indices[morph_cat] = len(table)
+                table.append(_parse_morph(morph_cat, category_sep, strict))
+                return indices[morph_cat]
+        return (parse_morph, table)
+
+
+class _SegmentationBlockParser(_LineBlockParser):
+    """Parses the lines of a segmentation file into arrays
+    of word counts, analysis lengths and morph indices."""
+
+    def __init__(self, io):
+        super(_SegmentationBlockParser, self).__init__(io)
+        self.construction_separator = io.construction_separator
+
+    def _parse_lines(self, lines):
+        re_space = re.compile(r'\s+')
+        (parse_morph, table) = self._morph_parser()
+        construction_sep = self.construction_separator
+        counts = []
+        lengths = array.array(str('I'))
+        morphs = array.array(str('I'))
+        for line in lines:
+            if line[0].isspace():
+                count, analysis = re_space.split(line, 1)
+            else:
+                count, analysis = line.split(None, 1)
+            try:
+                count = int(count)
+            except ValueError:
+                # first column was compound instead of count
+                count = 1
+            counts.append(count)
+            analysis = analysis.split(construction_sep)
+            lengths.append(len(analysis))
+            morphs.extend([parse_morph(morph_cat) for morph_cat in analysis])
+        return (table, counts, lengths, morphs)
+
+    def finish(self, result):
+        (table, counts, lengths, morphs) = result
+        with _gc_disabled():
+            rows = []
+            start = 0
+            for (count, length) in zip(counts, lengths):
+                end = start + length
+                rows.append((count, tuple([CategorizedMorph(*table[i])
+                                           for i in morphs[start:end]])))
+                start = end
+        return rows
+
+
+class _AnnotationBlockParser(_LineBlockParser):
+    def __init__(self, io, construction_sep, analysis_sep):
+        super(_AnnotationBlockParser, self).__init__(io)
+        self.construction_sep = construction_sep
+        self.analysis_sep = analysis_sep
+
+    def _parse_lines(self, lines):
+        (parse_morph, table) = self._morph_parser()
+        rows = []
+        for line in lines:
+            compound, analyses_line = line.split(None, 1)
+            if self.analysis_sep is not None:
+                analyses = analyses_line.split(self.analysis_sep)
+            else:
+                analyses = [analyses_line]
+            rows.append((compound, [
+                tuple([CategorizedMorph(*table[parse_morph(morph_cat)])
+                       for morph_cat in
+                       analysis.strip().split(self.construction_sep)])
+                for analysis in analyses]))
+        return rows
+
+
+def _parse_morph(morph_cat, category_separator, strict):
+    """Parses a string describing a morph, either tagged
+    or not tagged, into the morph and the category (or None)."""
+    parts = morph_cat.rsplit(category_separator, 1)
+    morph = parts[0].strip()
+    if len(parts) == 1:
+        category = None
+    else:
+        category = parts[1]
+        if strict and category not in _CATEGORIES:
+            raise InvalidCategoryError(category)
+    return (morph, category)
+
+
+def _parse_block(parser, data):
+    """Parses a block in a worker process. An invalid category is
+    returned instead of raised, as the exception can not be pickled."""
+    try:
+        return (parser(data), None)
+    except InvalidCategoryError as e:
+        return (None, e.category)
+
+
+def _block_result(result):
+    (rows, invalid_category) = result
+    if invalid_category is not None:
+        raise InvalidCategoryError(invalid_category)
+    return rows
+
+
+def _split_lines(text):
+    """Splits text into lines, recognizing the same line endings
+    as a TextIOWrapper with universal newlines."""
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.split('\n')
+
+
+def _read_byte_blocks(file_obj, block_size):
+    """Reads a binary file object in blocks of about
+    block_size bytes, split after the last newline of the block."""
+    with file_obj:
+        remainder = b''
+        while True:
+            data = file_obj.read(block_size)
+            if len(data) == 0:
+                break
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                remainder += data
+                continue
+            yield remainder + data[:end]
+            remainder = data[end:]
+        if len(remainder) > 0:
+            yield remainder
+
+
+@contextmanager
+def _gc_disabled():
+    """Disables the cyclic garbage collector within the block."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _text_wrapper(file_obj, encoding, buffer_size, write=False):
+    """Wraps a binary file object for reading or writing text.
+    Newlines are translated when reading, but not when writing."""
+    try:
+        if write:
+            wrapper = iolib.TextIOWrapper(file_obj, encoding=encoding,
+                                          newline='')
+        else:
+            wrapper = iolib.TextIOWrapper(file_obj, encoding=encoding)
+    except AttributeError:
+        # Not (fully) compatible with the io module,
+        # e.g. the members of a tarfile read as a stream
+        if write:
+            return codecs.getwriter(encoding)(file_obj)
+        return codecs.getreader(encoding)(file_obj)
+    # Decode in larger chunks than the default 8 KiB
+    try:
+        wrapper._CHUNK_SIZE = buffer_size
+    except AttributeError:
+        pass
+    return wrapper
+
+
+class ReadAheadReader(iolib.RawIOBase):
+    """Reads a binary file object in a background thread, keeping
+    a few blocks ready for the reader. Used for compressed files,
+    so that decompression overlaps with processing the data.
+    """
+
+    def __init__(self, file_obj, block_size, max_blocks=4):
+        super(ReadAheadReader, self).__init__()
+        self._file_obj = file_obj
+        self._block_size = block_size
+        self._queue = queue.Queue(max_blocks)
+        self._block = b''
+        self._pos = 0
+        self._eof = False
+        self._stop = False
+        self._thread = threading.Thread(target=self._read_ahead)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._pos >= len(self._block):
+            if self._eof:
+                return 0
+            block = self._queue.get()
+            if isinstance(block, Exception):
+                self._eof = True
+                raise block
+            if len(block) == 0:
+                self._eof = True
+                return 0
+            self._block = block
+            self._pos = 0
+        n = min(len(buf), len(self._block) - self._pos)
+        buf[:n] = self._block[self._pos:(self._pos + n)]
+        self._pos += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self._stop = True
+        # Unblock the reading thread, if it is waiting for space
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._file_obj.close()
+        super(ReadAheadReader, self).close()
+
+    def _read_ahead(self):
+        try:
+            while not self._stop:
+                block = self._file_obj.read(self._block_size)
+                self._queue.put(block)
+                if len(block) == 0:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+
+
+def _ascii_compatible(encoding):
+    """True if the newline byte only occurs as a newline,
+    allowing the encoded text to be split at newline bytes."""
+    try:
+        return ('\n'.encode(encoding) == b'\n' and
+                'a'.encode(encoding) == b'a')
+    except (LookupError, UnicodeError):
+        return False
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints of a model during batch training,
+    after each training operation and optionally after
+    every interval experiments.
+
+    If background is True, the checkpoints are written
+    by a SnapshotWriter while training continues.
+    """
+
+    def __init__(self, io, file_name, interval=None, background=False):
+        self.io = io
+        self.file_name = file_name
+        self.interval = interval
+        self._experiments = 0
+        if background:
+            self._snapshots = SnapshotWriter(io.write_checkpoint_file)
+        else:
+            self._snapshots = None
+
+    def register(self, model):
+        """Adds the callbacks writing the checkpoints to the model."""
+        model.operation_callbacks.append(self.write)
+        if self.interval is not None:
+            model.experiment_callbacks.append(self.experiment_done)
+
+    def experiment_done(self, model):
+        self._experiments += 1
+        if self._experiments >= self.interval:
+            self.write(model)
+
+    def write(self, model):
+        self._experiments = 0
+        if self._snapshots is None:
+            self.io.write_checkpoint_file(self.file_name, model)
+        else:
+            self._snapshots.write(self.file_name, model)
+
+    def finish(self):
+        """Waits for a checkpoint being written in the background."""
+        if self._snapshots is not None:
+            self._snapshots.wait()
+
+
+class SnapshotWriter(object):
+    """Writes snapshots of a model in a forked child process, which
+    sees a copy-on-write image of the model as it was when forked.
+    Training can continue in the parent while the snapshot is written.
+
+    At most one snapshot is in flight at a time: a snapshot requested
+    while the previous one is still being written is skipped, unless
+    the caller chooses to wait for it. Completion is logged by a
+    thread waiting for the child process.
+    On platforms without fork, snapshots are written directly.
+    """
+
+    def __init__(self, write_func):
+        """Arguments:
+            write_func :  Function taking a file name and a model,
+                          e.g. FlatcatIO.write_checkpoint_file.
+        """
+        self.write_func = write_func
+        # Exit status of the latest finished snapshot
+        self.status = None
+        self._reaper = None
+
+    def write(self, file_name, model, skip=True):
+        """Starts writing a snapshot of the model.
+
+        Arguments:
+            file_name :  The file to write.
+            model :  The model to write.
+            skip :  If True, the snapshot is skipped if the previous
+                    one is still being written. Otherwise it is
+                    started after the previous one has been written.
+        Returns False if the snapshot was skipped.
+        """
+        if not hasattr(os, 'fork'):
+            self.write_func(file_name, model)
+            self.status = 0
+            return True
+        if not self.poll():
+            if skip:
+                _logger.info(
+                    'Previous snapshot still being written, skipping')
+                return False
+            self.wait()
+        # Flush buffered output, to avoid writing it twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                logging.disable(logging.INFO)
+                self.write_func(file_name, model)
+                status = 0
+            except Exception:
+                _logger.exception(
+                    'Writing snapshot to {} failed'.format(file_name))
+            finally:
+                os._exit(status)
+        self._reaper = threading.Thread(
+            target=self._reap, args=(pid, file_name, time.time()))
+        self._reaper.daemon = True
+        self._reaper.start()
+        return True
+
+    def poll(self):
+        """Returns True if no snapshot is in flight."""
+        return self._reaper is None or not self._reaper.is_alive()
+
+    def wait(self):
+        """Waits until the snapshot in flight has been written.
+        Returns False if writing the latest snapshot failed."""
+        if self._reaper is not None:
+            self._reaper.join()
+        return self.status in (None, 0)
+
+    def _reap(self, pid, file_name, started):
+        (_, status) = os.waitpid(pid, 0)
+        elapsed = time.time() - started
+        if status == 0:
+            _logger.info('Snapshot written to {} in {:.1f}s'.format(
+                file_name, elapsed))
+        else:
+            _logger.error('Writing snapshot to {} failed '
+                          '(exit status {})'.format(file_name, status))
+        self.status = status
+
+
+def _replace_file(src, dst):
+    """Atomically replaces dst with src."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2: rename is atomic on POSIX, but not on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class ParallelGzipWriter(object):
+    """Writes a gzip file, compressing blocks of the data in parallel
+    threads, in the manner of pigz.
+
+    The written data is collected into blocks, which are compressed
+    into raw deflate data ending on a byte boundary (Z_SYNC_FLUSH),
+    primed with the end of the previous block as dictionary when
+    supported. The compressed blocks are written in order, forming a
+    single deflate stream in a single gzip member, readable by any
+    gzip reader.
+    """
+
+    def __init__(self, file_name_or_obj, num_threads=None,
+                 block_size=1024 * 1024, compresslevel=9):
+        """Arguments:
+            file_name_or_obj :  The file to write, or a binary file object
+                                to which the compressed data is written.
+            num_threads :  Number of compressing threads
+                           (default: the number of cpus).
+            block_size :  Number of bytes compressed by each task.
+            compresslevel :  The zlib compression level.
+        """
+        if _is_string(file_name_or_obj):
+            self._fobj = open(file_name_or_obj, 'wb')
+            self._close_fobj = True
+        else:
+            self._fobj = file_name_or_obj
+            self._close_fobj = False
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+        self.num_threads = max(1, num_threads)
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self._pool = ThreadPool(self.num_threads)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._previous = b''
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+        # gzip header: deflate, no flags, modification time,
+        # no extra flags, unknown os
+        self._fobj.write(b'\x1f\x8b\x08\x00' +
+                         struct.pack('<I', int(time.time())) +
+                         b'\x00\xff')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, trace):
+        self.close()
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def flush(self):
+        """Writes the blocks compressed so far.
+        The data in the current block remains buffered."""
+        while len(self._pending) > 0 and self._pending[0].ready():
+            self._fobj.write(self._pending.popleft().get())
+        self._fobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit()
+            while len(self._pending) > 0:
+                self._fobj.write(self._pending.popleft().get())
+            # An empty final block ends the deflate stream
+            compressor = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self._fobj.write(compressor.flush(zlib.Z_FINISH))
+            self._fobj.write(struct.pack('<II', self._crc & 0xffffffff,
+                                         self._size & 0xffffffff))
+            self._fobj.flush()
+        finally:
+            self.closed = True
+            self._pool.terminate()
+            if self._close_fobj:
+                self._fobj.close()
+
+    def _submit(self):
+        if self._buffered == 0:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._pending.append(self._pool.apply_async(
+            _deflate_block,
+            (data, self._previous, self.compresslevel)))
+        # Deflate can refer back at most 32 KiB
+        self._previous = data[-32768:]
+        # Bound the number of blocks in memory
+        while len(self._pending) > 2 * self.num_threads:
+            self._fobj.write(self._pending.popleft().get())
+
+
+def _deflate_block(data, dictionary, compresslevel):
+    """Compresses a block into raw deflate data ending on a byte
+    boundary, without ending the deflate stream."""
+    if PY3 and len(dictionary) > 0:
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        # Python 2 does not support priming with a dictionary
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
 class TarGzMember(object):
     """File-like object that writes itself into the tarfile on closing"""
     def __init__(self, arcname, tarmodel):
@@ -476,8 +1239,24 @@ class TarGzMember(object):
         self.tarmodel.tarfobj.addfile(tarinfo=info, fileobj=self.strio)
         self.strio.close()
 
+    @property
+    def closed(self):
+        return self.strio.closed
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
     def write(self, *args, **kwargs):
-        self.strio.write(*args, **kwargs)
+        return self.strio.write(*args, **kwargs)
 
     def __repr__(self):
         return '{} in {}'.format(
@@ -498,13 +1277,22 @@ class TarGzModel(object):
         else:
             self.mode = 'r|gz'
         self.tarfobj = None
+        self._gzfobj = None
 
     def __enter__(self):
-        self.tarfobj = tarfile.open(self.filename, self.mode)
+        if 'w' in self.mode:
+            # Compressed in parallel, outside tarfile
+            self._gzfobj = ParallelGzipWriter(
+                self.filename, num_threads=FlatcatIO.COMPRESSION_THREADS)
+            self.tarfobj = tarfile.open(fileobj=self._gzfobj, mode='w|')
+        else:
+            self.tarfobj = tarfile.open(self.filename, self.mode)
         return self
 
     def __exit__(self, typ, value, trace):
         self.tarfobj.close()
+        if self._gzfobj is not None:
+            self._gzfobj.close()
 
     def newmember(self, arcname):
         """Receive a new member to the .tar.gz archive.
@@ -542,6 +1330,403 @@ class TarGzModel(object):
     #### End of stuff belonging in Baseline ####
 
 
+class PackedModelWriter(object):
+    """Writes a model in the packed binary format.
+
+    The file starts with a magic string and the format version,
+    followed by named sections. Each section has a type code, the length
+    and CRC-32 checksum of its payload, and the payload: either an array
+    of numbers in little-endian byte order, UTF-8 text or a pickle.
+
+    The large containers (the corpus, backlinks, usage features and
+    emission counts) are stored as arrays indexing a table of morphs.
+    The rest of the model state is pickled, with references to the
+    containers replaced by persistent ids.
+    """
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self._morph_ids = {}
+        self._morphs = []
+        self._sections = []
+
+    def write(self, model, version):
+        state = model.get_checkpoint_state()
+        del state['_random_state']
+        # Rebuilt from the corpus when needed
+        state['_word_backlinks'] = None
+        morph_usage = model._morph_usage
+        corpus_coding = model._corpus_coding
+
+        self._add_corpus(model.segmentations)
+        self._add_backlinks(model.morph_backlinks)
+        self._add_section('interned_morphs', array.array(
+            str('I'), [self._morph_id(morph)
+                       for morph in model._interned_morphs]))
+        (morphs, contexts) = self._items(morph_usage._contexts)
+        self._add_section('context_morphs', morphs)
+        self._add_numbers('context_counts',
+                          [context.count for context in contexts])
+        self._add_numbers('context_perplexities',
+                          [ppl for context in contexts
+                           for ppl in context[1:]])
+        (morphs, condprobs) = self._items(morph_usage._condprob_cache)
+        self._add_section('condprob_morphs', morphs)
+        self._add_numbers('condprobs',
+                          [x for probs in condprobs for x in probs])
+        (morphs, counts) = self._items(corpus_coding._emission_counts)
+        self._add_section('emission_morphs', morphs)
+        self._add_numbers('emission_counts',
+                          [x for bycat in counts for x in bycat])
+
+        cache = corpus_coding._emission_cache
+        if isinstance(cache, utils.BoundedCache):
+            cache_pid = ('emission_cache', cache.max_size,
+                         cache._probation_share)
+        else:
+            # unbounded
+            cache_pid = ('emission_cache', None, None)
+        persistent = {
+            id(model.segmentations): ('segmentations',),
+            id(model.morph_backlinks): ('backlinks',),
+            id(model._interned_morphs): ('interned_morphs',),
+            id(morph_usage._contexts): (
+                'contexts', morph_usage._contexts._default),
+            id(morph_usage._condprob_cache): ('condprobs',),
+            id(corpus_coding._emission_counts): (
+                'emissions', corpus_coding._emission_counts._default),
+            id(cache): cache_pid}
+        buf = StringIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda obj: persistent.get(id(obj), None)
+        pickler.dump(state)
+        self._add_section('state', buf.getvalue())
+
+        # The morph table is complete only after all other sections
+        lengths = array.array(str('I'),
+                              [len(morph) for morph in self._morphs])
+        self._sections[:0] = [
+            ('version', 's', version.encode('utf-8')),
+            ('morph_lengths', 'I', _array_bytes(lengths)),
+            ('morph_data', 's', ''.join(self._morphs).encode('utf-8'))]
+
+        self.fobj.write(PACKED_MAGIC)
+        self.fobj.write(struct.pack(
+            '<II', PACKED_FORMAT_VERSION, len(self._sections)))
+        for section in self._sections:
+            self._write_section(*section)
+
+    def _morph_id(self, morph):
+        try:
+            return self._morph_ids[morph]
+        except KeyError:
+            self._morph_ids[morph] = len(self._morphs)
+            self._morphs.append(morph)
+            return self._morph_ids[morph]
+
+    def _items(self, container):
+        morphs = array.array(str('I'))
+        values = []
+        for (morph, value) in container.items():
+            morphs.append(self._morph_id(morph))
+            values.append(value)
+        return (morphs, values)
+
+    def _add_corpus(self, segmentations):
+        categories = {cat: i for (i, cat) in enumerate(PACKED_CATEGORIES)}
+        lengths = array.array(str('I'))
+        morphs = array.array(str('I'))
+        cats = array.array(str('B'))
+        for word in segmentations:
+            lengths.append(len(word.analysis))
+            for cmorph in word.analysis:
+                morphs.append(self._morph_id(cmorph.morph))
+                cats.append(categories[cmorph.category])
+        self._add_numbers('word_counts',
+                          [word.count for word in segmentations])
+        self._add_section('word_lengths', lengths)
+        self._add_section('word_morphs', morphs)
+        self._add_section('word_categories', cats)
+
+    def _add_backlinks(self, backlinks):
+        morphs = array.array(str('I'))
+        sizes = array.array(str('I'))
+        words = array.array(str('I'))
+        for (morph, indices) in backlinks.items():
+            morphs.append(self._morph_id(morph))
+            sizes.append(len(indices))
+            words.extend(sorted(indices))
+        self._add_section('backlink_morphs', morphs)
+        self._add_section('backlink_sizes', sizes)
+        self._add_section('backlink_words', words)
+
+    def _add_numbers(self, name, values):
+        """Numbers are stored as doubles, which represent integers
+        exactly up to 2**53. If all the numbers are integers,
+        the section type 'n' converts them back when loading."""
+        if all(isinstance(x, numbers.Integral) for x in values):
+            typecode = 'n'
+        else:
+            typecode = 'd'
+        self._sections.append(
+            (name, typecode, _array_bytes(array.array(str('d'), values))))
+
+    def _add_section(self, name, payload):
+        if isinstance(payload, array.array):
+            self._sections.append(
+                (name, payload.typecode, _array_bytes(payload)))
+        else:
+            self._sections.append((name, 'p', payload))
+
+    def _write_section(self, name, typecode, payload):
+        name = name.encode('utf-8')
+        self.fobj.write(struct.pack('<H', len(name)))
+        self.fobj.write(name)
+        self.fobj.write(struct.pack(
+            '<cQI', typecode.encode('ascii'), len(payload),
+            zlib.crc32(payload) & 0xffffffff))
+        self.fobj.write(payload)
+
+
+class PackedModelReader(object):
+    """Reads a model written by PackedModelWriter."""
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self._sections = {}
+        self._morphs = None
+
+    def read(self):
+        """Returns the version of the writer and the model."""
+        magic = self.fobj.read(len(PACKED_MAGIC))
+        if magic != PACKED_MAGIC:
+            raise ValueError('not a packed model')
+        (format_version, num_sections) = self._unpack('<II')
+        if format_version > PACKED_FORMAT_VERSION:
+            raise ValueError(
+                'packed format version {} is newer than {}'.format(
+                    format_version, PACKED_FORMAT_VERSION))
+        for _ in range(num_sections):
+            self._read_section()
+
+        version = self._sections['version'].decode('utf-8')
+        text = self._sections['morph_data'].decode('utf-8')
+        self._morphs = []
+        start = 0
+        for length in self._sections['morph_lengths']:
+            self._morphs.append(text[start:(start + length)])
+            start += length
+
+        unpickler = pickle.Unpickler(StringIO(self._sections['state']))
+        unpickler.persistent_load = self._container
+        state = unpickler.load()
+        model = FlatcatModel.__new__(FlatcatModel)
+        model.__dict__.update(state)
+        return (version, model)
+
+    def _container(self, pid):
+        """Rebuilds a container replaced by a persistent id."""
+        kind = pid[0]
+        morphs = self._morphs
+        if kind == 'segmentations':
+            return self._corpus()
+        elif kind == 'backlinks':
+            backlinks = collections.defaultdict(set)
+            words = self._sections['backlink_words']
+            start = 0
+            for (i, size) in zip(self._sections['backlink_morphs'],
+                                 self._sections['backlink_sizes']):
+                backlinks[morphs[i]] = set(words[start:(start + size)])
+                start += size
+            return backlinks
+        elif kind == 'interned_morphs':
+            return {morphs[i]: morphs[i]
+                    for i in self._sections['interned_morphs']}
+        elif kind == 'contexts':
+            contexts = utils.Sparse(default=pid[1])
+            context_type = type(pid[1])
+            ppls = self._sections['context_perplexities']
+            for (j, (i, count)) in enumerate(zip(
+                    self._sections['context_morphs'],
+                    self._sections['context_counts'])):
+                contexts[morphs[i]] = context_type(
+                    count, ppls[2 * j], ppls[2 * j + 1])
+            return contexts
+        elif kind == 'condprobs':
+            return collections.defaultdict(float, self._by_category(
+                'condprob_morphs', 'condprobs'))
+        elif kind == 'emissions':
+            return utils.Sparse(self._by_category(
+                'emission_morphs', 'emission_counts'), default=pid[1])
+        elif kind == 'emission_cache':
+            if pid[1] is None:
+                return {}
+            return utils.BoundedCache(pid[1], probation=pid[2])
+        raise ValueError('unknown container {}'.format(kind))
+
+    def _corpus(self):
+        categories = PACKED_CATEGORIES
+        morphs = self._morphs
+        word_morphs = self._sections['word_morphs']
+        word_cats = self._sections['word_categories']
+        segmentations = []
+        start = 0
+        for (count, length) in zip(self._sections['word_counts'],
+                                   self._sections['word_lengths']):
+            end = start + length
+            segmentations.append(WordAnalysis(count, tuple(
+                CategorizedMorph(morphs[word_morphs[i]],
+                                 categories[word_cats[i]])
+                for i in range(start, end))))
+            start = end
+        return segmentations
+
+    def _by_category(self, morphs_name, values_name):
+        morphs = self._morphs
+        values = self._sections[values_name]
+        width = len(ByCategory._fields)
+        for (j, i) in enumerate(self._sections[morphs_name]):
+            yield (morphs[i], ByCategory(
+                *values[(width * j):(width * (j + 1))]))
+
+    def _read_section(self):
+        (name_length,) = self._unpack('<H')
+        name = self.fobj.read(name_length).decode('utf-8')
+        (typecode, length, checksum) = self._unpack('<cQI')
+        typecode = typecode.decode('ascii')
+        payload = self.fobj.read(length)
+        if len(payload) != length:
+            raise EOFError('truncated section {}'.format(name))
+        if zlib.crc32(payload) & 0xffffffff != checksum:
+            raise ValueError('checksum mismatch in section {}'.format(name))
+        if typecode in ('p', 's'):
+            value = payload
+        elif typecode == 'n':
+            value = [int(x) for x in _bytes_array('d', payload)]
+        else:
+            value = _bytes_array(typecode, payload)
+        self._sections[name] = value
+
+    def _unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.fobj.read(size)
+        if len(data) != size:
+            raise EOFError('truncated file')
+        return struct.unpack(fmt, data)
+
+
+def _array_bytes(values):
+    """Returns the contents of an array in little-endian byte order."""
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    if PY3:
+        return values.tobytes()
+    return values.tostring()
+
+
+def _bytes_array(typecode, data):
+    """Inverse of _array_bytes."""
+    values = array.array(str(typecode))
+    if PY3:
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class _LineFormatter(object):
+    """Formats the lines written by write_formatted_file.
+
+    The format string is analysed once, so that only the fields
+    it uses are computed for each line.
+    """
+
+    # Fields describing a single analysis (None for multiple analyses)
+    COUNT_FIELDS = frozenset(('num_morphs', 'num_nonmorphemes',
+                              'num_letters'))
+
+    def __init__(self, line_format, construction_sep, analysis_sep,
+                 category_sep, output_tags=False, filter_tags=None,
+                 filter_len=3):
+        self.fields = _format_fields(line_format)
+        self._format = line_format.format
+        self.construction_sep = construction_sep
+        self.analysis_sep = analysis_sep
+        self.category_sep = category_sep
+        self.output_tags = output_tags
+        self.filter_tags = filter_tags
+        self.filter_len = filter_len
+        self._output_morph = _make_morph_formatter(category_sep, output_tags)
+        self._count_fields = self.fields & self.COUNT_FIELDS
+
+    def __call__(self, count, compound, alternatives, logp, clogp):
+        fields = self.fields
+        values = {}
+        if 'analysis' in fields:
+            values['analysis'] = self.analysis_sep.join(
+                [self.construction_sep.join(self._morphs(constructions))
+                 for constructions in alternatives])
+        if 'compound' in fields:
+            values['compound'] = compound
+        if 'count' in fields:
+            values['count'] = count
+        if 'logprob' in fields:
+            values['logprob'] = logp
+        if 'clogprob' in fields:
+            values['clogprob'] = clogp
+        if self._count_fields:
+            self._add_counts(values, alternatives)
+        return self._format(**values)
+
+    def _morphs(self, constructions):
+        if self.filter_tags is not None:
+            constructions = [cmorph for cmorph in constructions
+                             if cmorph.category not in self.filter_tags
+                             or len(cmorph) > self.filter_len]
+        if self.output_tags:
+            category_sep = self.category_sep
+            return [cmorph.morph if cmorph.category is None
+                    else cmorph.morph + category_sep + cmorph.category
+                    for cmorph in constructions]
+        try:
+            return [cmorph.morph for cmorph in constructions]
+        except AttributeError:
+            # Some of the morphs are strings
+            return [self._output_morph(cmorph) for cmorph in constructions]
+
+    def _add_counts(self, values, alternatives):
+        fields = self._count_fields
+        if len(alternatives) != 1:
+            for field in fields:
+                values[field] = None
+            return
+        constructions = alternatives[0]
+        if 'num_morphs' in fields:
+            values['num_morphs'] = len(constructions)
+        if 'num_nonmorphemes' in fields:
+            values['num_nonmorphemes'] = sum(
+                1 for cmorph in constructions if cmorph.category == 'ZZZ')
+        if 'num_letters' in fields:
+            values['num_letters'] = sum(len(cmorph.morph)
+                                        for cmorph in constructions)
+
+
+def _format_fields(line_format):
+    """Returns the names of the keyword fields used in a format string,
+    including those nested in format specifications."""
+    fields = set()
+    for (_, field, spec, _) in string.Formatter().parse(line_format):
+        if field is None:
+            continue
+        fields.add(re.split(r'[.\[]', field, 1)[0])
+        if spec and '{' in spec:
+            fields.update(_format_fields(spec))
+    return frozenset(fields)
+
+
 def _make_morph_formatter(category_sep, output_tags):
     if output_tags:
         def output_morph(cmorph):
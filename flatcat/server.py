@@ -0,0 +1,984 @@
+#!/usr/bin/env python
+"""
+Segmentation server, answering requests from many concurrent clients
+over a local socket without reloading the model for each job.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import asyncio
+import concurrent.futures
+import gc
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from . import get_version
+from . import utils
+from .categorizationscheme import HeuristicPostprocessor
+from .exception import ArgumentException
+from .flatcat import FlatcatModel
+from .io import FlatcatIO, BINARY_ENDINGS
+from .reduced import FlatcatSegmenter
+
+_logger = logging.getLogger(__name__)
+
+
+def load_segmenter(io, file_name, reduce=False):
+    """Loads a model for segmentation. Binary files may contain either
+    a full model or a reduced FlatcatSegmenter.
+
+    Arguments:
+        io :  FlatcatIO instance used for reading.
+        file_name :  A tarball, binary, packed or reduced model.
+        reduce :  Convert a full model into a reduced FlatcatSegmenter,
+                  which uses less memory.
+    """
+    if any(file_name.endswith(ending) for ending in BINARY_ENDINGS):
+        model = io.read_binary_model_file(file_name)
+        if isinstance(model, FlatcatModel):
+            model.initialize_hmm()
+    else:
+        model = io.read_any_model(file_name)
+    if reduce and isinstance(model, FlatcatModel):
+        model = FlatcatSegmenter(model)
+    return model
+
+
+class SegmentationServer(object):
+    """Answers segmentation requests using a single loaded model.
+
+    The protocol is line delimited JSON. Each request is an object
+    on one line, e.g.
+        {"id": 1, "words": ["kahvikuppi", "kupit"]}
+    and is answered on the same connection, in the order of the
+    requests, by
+        {"id": 1, "analyses": [[["kahvi", "STM"], ["kuppi", "STM"]],
+                               [["kupi", "STM"], ["t", "SUF"]]],
+         "logprobs": [21.5, 14.2]}
+    The id is optional and returned as given. Invalid requests are
+    answered with {"id": ..., "error": "<message>"}. The request
+    {"command": "stats"} returns the statistics of the server, and
+    {"command": "reload"} reloads the model file.
+
+    The words of concurrent requests are collected into batches,
+    and segmented in a separate thread, so that the event loop keeps
+    serving clients. Segmentations are stored in a cache shared by
+    all clients.
+
+    When the model is reloaded, new batches switch to the new model
+    while the batch being segmented finishes with the old one, and
+    the cache is emptied. When the server is stopped, the requests
+    already read are answered before the connections are closed.
+    """
+
+    # Longest accepted request line, in bytes
+    MAX_LINE_LENGTH = 2 ** 20
+    # Number of requests read ahead of the responses on a connection
+    PIPELINE_DEPTH = 16
+
+    def __init__(self, model, remove_nonmorphemes=False, batch_size=256,
+                 batch_delay=0.002, cache_size=100000, model_file=None,
+                 loader=None, watch_interval=None):
+        """Arguments:
+            model :  A FlatcatModel or FlatcatSegmenter.
+            remove_nonmorphemes :  Use heuristic postprocessing to remove
+                                   nonmorphemes from the segmentations.
+            batch_size :  Maximum number of words segmented in a batch.
+            batch_delay :  Time in seconds to wait for more requests
+                           to fill a batch.
+            cache_size :  Maximum number of cached segmentations.
+            model_file :  The file the model was loaded from,
+                          for reloading.
+            loader :  Function loading a model from a file,
+                      for reloading.
+            watch_interval :  If given, the model file is checked for
+                              changes at this interval in seconds, and
+                              reloaded when changed.
+        """
+        self.model = model
+        if remove_nonmorphemes:
+            self.postprocessor = HeuristicPostprocessor()
+        else:
+            self.postprocessor = None
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.cache_size = cache_size
+        self.cache = utils.BoundedCache(max_size=cache_size)
+        self.model_file = model_file
+        self.loader = loader
+        self.watch_interval = watch_interval
+        self.fingerprint = None
+        self._file_state = None
+        if model_file is not None:
+            self._file_state = _file_state(model_file)
+            self.fingerprint = model_fingerprint(model_file)
+        self.num_reloads = 0
+        # If set, called instead of reloading for the reload command
+        self.reload_callback = None
+
+        self.num_requests = 0
+        self.num_words = 0
+        self.num_batches = 0
+        self.num_clients = 0
+        self._started = time.time()
+        self._loop = None
+        self._queue = None
+        self._batcher = None
+        self._watcher = None
+        self._reloading = None
+        self._servers = []
+        self._socket_paths = []
+        # Tasks handling the open connections, and their readers
+        self._connections = {}
+        # The model is only used from one thread at a time
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        # A new model is loaded while the old one is in use
+        self._reload_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def segment_words(self, words, model=None):
+        """Segments a list of words with the model (by default the
+        current model), without using the cache.
+        Returns a list of (analysis, logp) pairs."""
+        if model is None:
+            model = self.model
+        results = []
+        for word in words:
+            (analysis, logp) = model.viterbi_analyze(word)
+            if self.postprocessor is not None:
+                analysis = self.postprocessor.remove_nonmorphemes(
+                    analysis, model)
+            results.append((analysis, logp))
+        return results
+
+    def load_model(self, fingerprint=None):
+        """Loads the model file again. Returns the new model,
+        its fingerprint and a dict describing the reload,
+        without switching to the new model."""
+        if self.loader is None or self.model_file is None:
+            raise ValueError('the server has no model file to reload')
+        start = time.time()
+        memory = utils._process_memory()
+        file_state = _file_state(self.model_file)
+        if fingerprint is None:
+            fingerprint = model_fingerprint(self.model_file)
+        model = self.loader(self.model_file)
+        info = {'fingerprint': fingerprint,
+                'previous_fingerprint': self.fingerprint,
+                'seconds': time.time() - start,
+                'memory_before': memory,
+                'memory_after': utils._process_memory(),
+                'peak_memory': utils._peak_memory()}
+        if info['memory_after'] is not None and info['peak_memory']:
+            info['peak_memory'] = max(info['peak_memory'],
+                                      info['memory_after'])
+        self._file_state = file_state
+        return (model, fingerprint, info)
+
+    def switch_model(self, model, fingerprint):
+        """Switches new requests over to the model. Batches already
+        being segmented finish with the old model. The cache of the
+        old model is replaced by an empty one."""
+        self.model = model
+        self.fingerprint = fingerprint
+        self.cache = utils.BoundedCache(max_size=self.cache_size)
+        self.num_reloads += 1
+
+    async def reload(self):
+        """Loads the model file in the background and switches to it,
+        unless its contents are unchanged. Concurrent calls share
+        the same reload. Returns a dict describing the reload."""
+        if self._reloading is None:
+            self._reloading = asyncio.ensure_future(self._reload())
+        reloading = self._reloading
+        try:
+            return await asyncio.shield(reloading)
+        finally:
+            if reloading.done() and self._reloading is reloading:
+                self._reloading = None
+
+    async def _reload(self):
+        fingerprint = await self._loop.run_in_executor(
+            self._reload_executor, model_fingerprint, self.model_file)
+        if fingerprint == self.fingerprint:
+            self._file_state = _file_state(self.model_file)
+            return {'fingerprint': fingerprint, 'unchanged': True}
+        (model, fingerprint, info) = await self._loop.run_in_executor(
+            self._reload_executor, self.load_model, fingerprint)
+        self.switch_model(model, fingerprint)
+        _log_reload(info)
+        return info
+
+    async def segment(self, words):
+        """Segments a list of words, batched together with the words
+        of other concurrent requests. Returns a list of
+        (analysis, logp) pairs."""
+        future = self._loop.create_future()
+        await self._queue.put((words, future))
+        result = await future
+        return result
+
+    async def start(self, path=None, host=None, port=None, sock=None):
+        """Starts listening on a Unix socket at path, on a TCP socket
+        at host and port, or on an already listening socket."""
+        self._loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        if self.watch_interval is not None and self.model_file is not None:
+            self._watcher = asyncio.ensure_future(self._watch_loop())
+        if sock is not None:
+            if sock.family == getattr(socket, 'AF_UNIX', None):
+                server = await asyncio.start_unix_server(
+                    self._handle_connection, sock=sock,
+                    limit=self.MAX_LINE_LENGTH)
+            else:
+                server = await asyncio.start_server(
+                    self._handle_connection, sock=sock,
+                    limit=self.MAX_LINE_LENGTH)
+        elif path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(
+                self._handle_connection, path=path,
+                limit=self.MAX_LINE_LENGTH)
+            self._socket_paths.append(path)
+        else:
+            server = await asyncio.start_server(
+                self._handle_connection, host=host, port=port,
+                limit=self.MAX_LINE_LENGTH)
+        self._servers.append(server)
+        _logger.info('Listening on {}'.format(
+            ', '.join(str(sock.getsockname()) for sock in server.sockets)))
+        return server
+
+    async def stop(self):
+        """Stops listening and segmenting."""
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        # Only the socket files created by this server are removed
+        for path in self._socket_paths:
+            _remove_socket_file(path)
+        self._socket_paths = []
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        if len(self._connections) > 0:
+            # The open connections answer the requests already read
+            for reader in self._connections.values():
+                reader.feed_eof()
+            await asyncio.wait(list(self._connections))
+        if self._batcher is not None:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, return_exceptions=True)
+            self._batcher = None
+
+    def serve_forever(self, path=None, host=None, port=None, sock=None):
+        """Runs the server until interrupted, or until terminated
+        with SIGTERM."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+            # A worker leaves the reloading to its parent
+            if self.model_file is not None and self.reload_callback is None:
+                loop.add_signal_handler(
+                    signal.SIGHUP,
+                    lambda: asyncio.ensure_future(self._try_reload()))
+        except (NotImplementedError, AttributeError):
+            pass
+        loop.run_until_complete(self.start(path=path, host=host, port=port,
+                                           sock=sock))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.stop())
+            _logger.info(self._format_stats())
+            loop.close()
+
+    def stats(self):
+        """Statistics of the requests served so far."""
+        return {'requests': self.num_requests,
+                'words': self.num_words,
+                'batches': self.num_batches,
+                'clients': self.num_clients,
+                'cache_size': len(self.cache),
+                'cache_hit_rate': self.cache.hit_rate,
+                'fingerprint': self.fingerprint,
+                'reloads': self.num_reloads,
+                'uptime': time.time() - self._started,
+                'pid': os.getpid(),
+                'memory': utils._process_memory(),
+                'private_memory': utils._private_memory()}
+
+    async def _batch_loop(self):
+        while True:
+            batch = [(await self._queue.get())]
+            num_words = len(batch[0][0])
+            if num_words < self.batch_size and self.batch_delay > 0:
+                # Give concurrent requests a chance to join the batch
+                await asyncio.sleep(self.batch_delay)
+            while num_words < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                batch.append(item)
+                num_words += len(item[0])
+            try:
+                await self._segment_batch(batch)
+            except Exception as e:
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _segment_batch(self, batch):
+        # The whole batch is segmented with the same model,
+        # even if a reload switches to a new one meanwhile
+        model = self.model
+        cache = self.cache
+        found = {}
+        missing = []
+        for (words, _) in batch:
+            for word in words:
+                if word in found:
+                    continue
+                result = cache.get(word)
+                found[word] = result
+                if result is None:
+                    missing.append(word)
+        self.num_batches += 1
+        if len(missing) > 0:
+            results = await self._loop.run_in_executor(
+                self._executor, self.segment_words, missing, model)
+            for (word, result) in zip(missing, results):
+                cache[word] = result
+                found[word] = result
+        for (words, future) in batch:
+            if future.done():
+                # The client has gone away
+                continue
+            future.set_result([found[word] for word in words])
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            state = _file_state(self.model_file)
+            if state is None or state == self._file_state:
+                continue
+            # Wait until the file is no longer being written
+            await asyncio.sleep(self.watch_interval)
+            if _file_state(self.model_file) != state:
+                continue
+            await self._try_reload()
+
+    async def _try_reload(self):
+        try:
+            await self.reload()
+        except Exception:
+            _logger.exception('Reloading the model failed, '
+                              'keeping the old model')
+            # Not retried until the file changes again
+            self._file_state = _file_state(self.model_file)
+
+    async def _handle_connection(self, reader, writer):
+        self.num_clients += 1
+        connection = asyncio.current_task()
+        self._connections[connection] = reader
+        pending = asyncio.Queue(self.PIPELINE_DEPTH)
+        responder = asyncio.ensure_future(self._respond(pending, writer))
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await pending.put(_done_future(
+                        {'error': 'request line too long'}))
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                await pending.put(
+                    asyncio.ensure_future(self._handle_request(line)))
+            await pending.put(None)
+            await responder
+        finally:
+            writer.close()
+            self.num_clients -= 1
+            del self._connections[connection]
+
+    async def _respond(self, pending, writer):
+        connected = True
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            response = await task
+            if not connected:
+                # The remaining responses are discarded
+                continue
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    async def _handle_request(self, line):
+        request_id = None
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+            request_id = request.get('id')
+            response = await self._dispatch(request)
+        except (ValueError, TypeError) as e:
+            response = {'error': str(e)}
+        except Exception as e:
+            _logger.exception('Failed request')
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        response['id'] = request_id
+        return response
+
+    async def _dispatch(self, request):
+        if 'command' in request:
+            return (await self._command(request['command']))
+        if 'words' in request:
+            words = request['words']
+        elif 'word' in request:
+            words = [request['word']]
+        else:
+            raise ValueError('request must contain "words" or "command"')
+        if (not isinstance(words, list) or
+                not all(utils._is_string(word) for word in words)):
+            raise ValueError('"words" must be a list of strings')
+        self.num_requests += 1
+        self.num_words += len(words)
+        results = await self.segment(words)
+        return {'analyses': [[[cmorph.morph, cmorph.category]
+                              for cmorph in analysis]
+                             for (analysis, _) in results],
+                'logprobs': [logp for (_, logp) in results]}
+
+    async def _command(self, command):
+        if command == 'stats':
+            return {'stats': self.stats()}
+        if command == 'reload':
+            if self.reload_callback is not None:
+                # The reload is done elsewhere, e.g. by the parent
+                # of pre-forked workers
+                self.reload_callback()
+                return {'reload': {'requested': True}}
+            return {'reload': (await self.reload())}
+        raise ValueError('unknown command "{}"'.format(command))
+
+    def _format_stats(self):
+        stats = self.stats()
+        return ('Served {requests} requests ({words} words) in {batches} '
+                'batches, cache hit rate {cache_hit_rate:.1%}').format(
+                    **stats)
+
+
+class PreforkServer(object):
+    """Runs a SegmentationServer in several forked worker processes,
+    which share the pages of the model loaded by the parent
+    copy-on-write. The listening socket is created before forking,
+    and the kernel spreads the connections between the workers
+    accepting on it. The requests of one connection are answered
+    by the same worker. Workers that exit unexpectedly are replaced.
+
+    Each worker has its own batches and cache.
+
+    The model is reloaded by the parent on SIGHUP, on the reload
+    command, or when the model file changes if the server has a
+    watch_interval. New workers are then forked with the new model,
+    while the old workers stop accepting connections and exit after
+    answering the requests already received.
+    """
+
+    # Minimum time in seconds between starting replacements for
+    # a worker that exits right after starting
+    RESPAWN_DELAY = 1.0
+    # Time in seconds between checks for exited workers
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, server, num_workers):
+        """Arguments:
+            server :  The SegmentationServer run in each worker.
+            num_workers :  Number of worker processes.
+        """
+        if not hasattr(os, 'fork'):
+            raise ArgumentException(
+                'Worker processes require os.fork, which is '
+                'not available on this platform')
+        self.server = server
+        self.num_workers = num_workers
+        self._workers = {}
+        # Old workers finishing their requests after a reload
+        self._retired = set()
+        self._reload_requested = False
+        self._next_check = None
+        self._seen_state = None
+
+    def serve_forever(self, path=None, host=None, port=None):
+        """Starts the workers, and replaces them as needed until
+        interrupted or terminated with SIGTERM."""
+        sock = _listen(path=path, host=host, port=port)
+        _freeze()
+        previous = {signal.SIGTERM: signal.signal(signal.SIGTERM,
+                                                  _interrupt),
+                    signal.SIGHUP: signal.signal(signal.SIGHUP,
+                                                 self._request_reload)}
+        try:
+            for _ in range(self.num_workers):
+                self._spawn(sock)
+            _logger.info('Started {} workers, parent memory {}'.format(
+                self.num_workers,
+                utils._format_memory_size(utils._process_memory())))
+            while True:
+                if self._reload_requested or self._model_changed():
+                    self._reload_requested = False
+                    self._reload(sock)
+                (pid, status) = _reap()
+                if pid == 0:
+                    time.sleep(self.POLL_INTERVAL)
+                    continue
+                if pid not in self._workers:
+                    self._retired.discard(pid)
+                    continue
+                started = self._workers.pop(pid)
+                _logger.warning(
+                    'Worker {} exited with status {}, restarting'.format(
+                        pid, status))
+                elapsed = time.time() - started
+                if elapsed < self.RESPAWN_DELAY:
+                    time.sleep(self.RESPAWN_DELAY - elapsed)
+                self._spawn(sock)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for (signum, handler) in previous.items():
+                signal.signal(signum, handler)
+            self._stop_workers()
+            sock.close()
+            if path is not None:
+                _remove_socket_file(path)
+
+    def worker_memory(self):
+        """The private memory in bytes of each worker, by pid,
+        or None where it can not be determined."""
+        return dict((pid, utils._private_memory(pid))
+                    for pid in self._workers)
+
+    def _request_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def _model_changed(self):
+        """True if the model file has changed, and has stayed the same
+        since the previous check."""
+        server = self.server
+        if server.watch_interval is None or server.model_file is None:
+            return False
+        now = time.time()
+        if self._next_check is not None and now < self._next_check:
+            return False
+        self._next_check = now + server.watch_interval
+        state = _file_state(server.model_file)
+        if state is None or state == server._file_state:
+            self._seen_state = None
+            return False
+        if state != self._seen_state:
+            # Wait until the file is no longer being written
+            self._seen_state = state
+            return False
+        self._seen_state = None
+        return True
+
+    def _reload(self, sock):
+        server = self.server
+        try:
+            fingerprint = model_fingerprint(server.model_file)
+            if fingerprint == server.fingerprint:
+                server._file_state = _file_state(server.model_file)
+                _logger.info('Model {} unchanged'.format(fingerprint))
+                return
+            (model, fingerprint, info) = server.load_model(fingerprint)
+        except Exception:
+            _logger.exception('Reloading the model failed, '
+                              'keeping the old model')
+            server._file_state = _file_state(server.model_file)
+            return
+        # The old model can only be collected if unfrozen
+        _freeze(False)
+        server.switch_model(model, fingerprint)
+        _freeze()
+        info['memory_after'] = utils._process_memory()
+        retired = self._workers
+        self._workers = {}
+        for _ in range(self.num_workers):
+            self._spawn(sock)
+        for pid in retired:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self._retired.update(retired)
+        _log_reload(info)
+
+    def _spawn(self, sock):
+        parent = os.getpid()
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = time.time()
+            return
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Reloading is done by the parent, also when SIGHUP is
+            # sent to the whole process group
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.server.watch_interval = None
+            self.server.reload_callback = (
+                lambda: os.kill(parent, signal.SIGHUP))
+            self.server.serve_forever(sock=sock)
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except Exception:
+            _logger.exception('Worker {} failed'.format(os.getpid()))
+        finally:
+            os._exit(status)
+
+    def _stop_workers(self):
+        pids = list(self._workers) + list(self._retired)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._workers = {}
+        self._retired = set()
+
+
+def _freeze(freeze=True):
+    """Moves the objects surviving a collection out of reach of the
+    garbage collector, which would otherwise write to (and thus copy)
+    the pages of the model in every forked worker."""
+    if not hasattr(gc, 'freeze'):
+        return
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    else:
+        gc.unfreeze()
+
+
+def _reap():
+    """Returns the pid and status of an exited child process,
+    or (0, 0) if none has exited."""
+    try:
+        return os.waitpid(-1, os.WNOHANG)
+    except ChildProcessError:
+        return (0, 0)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def _listen(path=None, host=None, port=None):
+    """Returns a listening Unix socket at path,
+    or TCP socket at host and port."""
+    if path is not None:
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    else:
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        (family, socktype, proto, _, address) = info[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+
+def model_fingerprint(file_name):
+    """Returns a fingerprint of the contents of a model file."""
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as fobj:
+        while True:
+            block = fobj.read(2 ** 20)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def _file_state(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+def _log_reload(info):
+    _logger.info(
+        'Reloaded model {} (was {}) in {:.1f}s, memory {} -> {}, '
+        'peak {}'.format(
+            info['fingerprint'], info['previous_fingerprint'],
+            info['seconds'],
+            utils._format_memory_size(info['memory_before']),
+            utils._format_memory_size(info['memory_after']),
+            utils._format_memory_size(info['peak_memory'])))
+
+
+def _done_future(result):
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+def _remove_socket_file(path):
+    try:
+        os.unlink(path)
+    except (OSError, TypeError):
+        pass
+
+
+class ServerThread(object):
+    """Runs a SegmentationServer in a background thread with its
+    own event loop. Used for testing, and for embedding the server
+    in other programs.
+    """
+
+    def __init__(self, server, path=None, host='127.0.0.1', port=0):
+        """Arguments:
+            server :  The SegmentationServer to run.
+            path :  Unix socket to listen on. If not given,
+                    a TCP socket at host and port is used.
+            host :  TCP host name or address.
+            port :  TCP port. With 0, a free port is chosen.
+        """
+        self.server = server
+        self.path = path
+        self.host = host
+        self.port = port
+        self.address = None
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                server = self._loop.run_until_complete(self.server.start(
+                    path=self.path, host=self.host, port=self.port))
+                self.address = server.sockets[0].getsockname()
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.server.stop())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        if len(errors) > 0:
+            raise errors[0]
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class LineClient(object):
+    """Minimal blocking client for the segmentation server,
+    sending one request at a time. Used for testing.
+    """
+
+    def __init__(self, address, timeout=None):
+        """Arguments:
+            address :  Path of a Unix socket, or a (host, port) pair.
+            timeout :  Socket timeout in seconds.
+        """
+        if utils._is_string(address):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = tuple(address[:2])
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        self._file = self._sock.makefile('rb')
+        self._next_id = 0
+
+    def request(self, request):
+        """Sends a request object, and returns the response object."""
+        self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('connection closed by server')
+        return json.loads(line.decode('utf-8'))
+
+    def segment(self, words):
+        """Returns the analyses of the words as lists of
+        (morph, category) pairs."""
+        self._next_id += 1
+        response = self.request({'id': self._next_id, 'words': list(words)})
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return [[tuple(pair) for pair in analysis]
+                for analysis in response['analyses']]
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_serve_argparser():
+    parser = argparse.ArgumentParser(
+        prog='flatcat-serve',
+        description="""
+Morfessor {version} segmentation server
+
+Loads a model once, and answers segmentation requests
+in line delimited JSON over a Unix or TCP socket.
+""".format(version=get_version()),
+        epilog="""Simple usage example:
+
+  %(prog)s --socket /tmp/flatcat.sock analysis.tar.gz
+""",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+    add_arg = parser.add_argument_group('server options').add_argument
+    add_arg('model', metavar='<model>',
+            help='A model to segment with (tarball, binary, packed '
+                 'or reduced).')
+    add_arg('--socket', dest='socket', default=None, metavar='<path>',
+            help='Listen on a Unix socket at this path.')
+    add_arg('--host', dest='host', default='127.0.0.1', metavar='<host>',
+            help='Listen on a TCP socket at this address, '
+                 'if no --socket is given (default %(default)s).')
+    add_arg('--port', dest='port', type=int, default=7370, metavar='<int>',
+            help='TCP port (default %(default)s).')
+    add_arg('--workers', dest='num_workers', type=int, default=0,
+            metavar='<int>',
+            help='Number of forked worker processes, sharing the loaded '
+                 'model. Use of --reduce is recommended, to keep the '
+                 'shared model small (default: serve from a single '
+                 'process).')
+    add_arg('--watch-interval', dest='watch_interval', type=float,
+            default=None, metavar='<float>',
+            help='Check the model file for changes every this many '
+                 'seconds, and reload it when changed. The model is '
+                 'also reloaded on SIGHUP and on the reload command '
+                 '(default: do not watch).')
+    add_arg('--reduce', dest='reduce', default=False, action='store_true',
+            help='Convert a full model to the reduced form, '
+                 'which uses less memory.')
+    add_arg('--remove-nonmorphemes', dest='rm_nonmorph', default=False,
+            action='store_true',
+            help='Use heuristic postprocessing to remove nonmorphemes '
+                 'from output segmentations.')
+    add_arg('--batch-size', dest='batch_size', type=int, default=256,
+            metavar='<int>',
+            help='Maximum number of words segmented in one batch '
+                 '(default %(default)s).')
+    add_arg('--batch-delay', dest='batch_delay', type=float, default=2.0,
+            metavar='<float>',
+            help='Milliseconds to wait for concurrent requests to fill '
+                 'a batch (default %(default)s).')
+    add_arg('--cache-size', dest='cache_size', type=int, default=100000,
+            metavar='<int>',
+            help='Maximum number of cached segmentations '
+                 '(default %(default)s).')
+    add_arg('-e', '--encoding', dest='encoding', metavar='<encoding>',
+            help='Encoding of the model file (if none is given, '
+                 'both the local encoding and UTF-8 are tried).')
+
+    add_arg = parser.add_argument_group('logging options').add_argument
+    add_arg('-v', '--verbose', dest='verbose', type=int, default=1,
+            metavar='<int>',
+            help='Level of verbosity (default %(default)s).')
+    add_arg('--logfile', dest='log_file', metavar='<file>',
+            help='Write log messages to file in addition to standard '
+                 'error stream.')
+
+    add_arg = parser.add_argument_group('other options').add_argument
+    add_arg('-h', '--help', action='help',
+            help='Show this help message and exit.')
+    add_arg('--version', action='version',
+            version='%(prog)s ' + get_version(numeric=True),
+            help='Show version number and exit.')
+    return parser
+
+
+def serve_main(args):
+    """Runs the segmentation server with the arguments parsed by
+    get_serve_argparser()."""
+    if args.verbose >= 2:
+        loglevel = logging.DEBUG
+    elif args.verbose >= 1:
+        loglevel = logging.INFO
+    else:
+        loglevel = logging.WARNING
+    logging.basicConfig(level=loglevel, filename=args.log_file,
+                        format='%(asctime)s - %(message)s')
+    if args.batch_size < 1:
+        raise ArgumentException('--batch-size must be at least 1')
+
+    io = FlatcatIO(encoding=args.encoding)
+
+    def loader(file_name):
+        return load_segmenter(io, file_name, reduce=args.reduce)
+
+    server = SegmentationServer(loader(args.model),
+                                remove_nonmorphemes=args.rm_nonmorph,
+                                batch_size=args.batch_size,
+                                batch_delay=args.batch_delay / 1000.,
+                                cache_size=args.cache_size,
+                                model_file=args.model,
+                                loader=loader,
+                                watch_interval=args.watch_interval)
+    if args.num_workers > 0:
+        server = PreforkServer(server, args.num_workers)
+    server.serve_forever(path=args.socket, host=args.host, port=args.port)
@@ -0,0 +1,31 @@
+"""
+Coroutines for the tests of the asynchronous segmentation client.
+
+They are kept out of flatcat_test, so that the other tests can be run
+by interpreters without asyncio and the async syntax.
+"""
+
+import asyncio
+
+from flatcat import client as flatcat_client
+
+
+async def use_async_client(address, words):
+    """Analyzes the words with an AsyncSegmentationClient, first in a
+    single call and then concurrently one word at a time.
+
+    Returns a dict of both lists of analyses, the statistics of the
+    server and the error raised by an unknown command.
+    """
+    results = {}
+    async with flatcat_client.AsyncSegmentationClient(
+            address, pool_size=2, batch_size=2) as client:
+        results['analyze'] = await client.analyze(words)
+        results['analyze_word'] = await asyncio.gather(
+            *[client.analyze_word(word) for word in words])
+        results['stats'] = await client.stats()
+        try:
+            await client._command('unknown')
+        except flatcat_client.SegmentationServerError as e:
+            results['error'] = e
+    return results
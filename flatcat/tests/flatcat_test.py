@@ -5,17 +5,44 @@ Tests for Morfessor 2.0 FlatCat variant.
 """
 
 import collections
+import gzip
+import hashlib
+import io as iolib
+import json
+import locale
 import logging
 import math
+import multiprocessing
+import os
+import pickle
 import re
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
 
 import morfessor
 from flatcat import flatcat
+from flatcat import io as flatcat_io
+from flatcat import utils
 from flatcat import categorizationscheme as scheme
 from flatcat.categorizationscheme import CategorizedMorph
 from flatcat.utils import LOGPROB_ZERO
 
+try:
+    import asyncio
+    from flatcat import client as flatcat_client
+    from flatcat import server
+    from flatcat.tests import client_coroutines
+except (ImportError, SyntaxError):
+    # The server requires asyncio
+    flatcat_client = None
+    server = None
+
 
 # Directory for reference input and output files
 REFERENCE_DIR = 'reference_data/'
@@ -299,6 +326,841 @@ class TestOnline(unittest.TestCase):
                          self.model.segmentations[0])
 
 
+class TestOnlineTraining(unittest.TestCase):
+    def setUp(self):
+        self.model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        self.model.initialize_hmm()
+        self.words = ['AABBBBB', 'AAHHHH', 'CCCCEE', 'AAHHHH', 'HHHHEE',
+                      'AAHHHH', 'SSSSS']
+
+    def _train(self, **kwargs):
+        data = ((False, 1, word, tuple(word)) for word in self.words)
+        results = []
+        self.model.train_online(
+            data, epoch_interval=100, max_epochs=1,
+            result_callback=lambda i, w, a, d: results.append((i, w, d)),
+            **kwargs)
+        return results
+
+    def test_reported_analysis(self):
+        reported = []
+
+        def callback(token_num, word, analysis, detagged):
+            i_word = self.model._get_word_backlinks()[word]
+            reported.append(
+                (analysis, self.model.segmentations[i_word].analysis))
+        data = ((False, 1, word, tuple(word)) for word in self.words)
+        self.model.train_online(data, epoch_interval=100, max_epochs=1,
+                                result_callback=callback)
+        self.assertEqual(len(reported), len(self.words))
+        # The analysis of the word in the corpus after training
+        for (analysis, in_corpus) in reported:
+            self.assertEqual(tuple(analysis), tuple(in_corpus))
+
+    def test_minibatch(self):
+        num_words = len(self.model.segmentations)
+        tokens = sum(seg.count for seg in self.model.segmentations)
+        results = self._train(batch_size=3)
+        self.assertEqual([(i, w) for (i, w, _) in results],
+                         list(enumerate(self.words)))
+        for (_, word, detagged) in results:
+            self.assertEqual(''.join(detagged), word)
+        # the new words are added once
+        self.assertEqual(len(self.model.segmentations), num_words + 2)
+        self.assertEqual(sum(seg.count for seg in self.model.segmentations),
+                         tokens + len(self.words))
+        for (morph, counts) in self.model.get_lexicon():
+            self.assertAlmostEqual(
+                sum(counts),
+                sum(seg.count for seg in self.model.segmentations
+                    for cmorph in seg.analysis if cmorph.morph == morph))
+
+    def test_background_io(self):
+        expected = self._train()
+        self.setUp()
+        self.assertEqual(self._train(prefetch=2, background_results=True),
+                         expected)
+
+    def test_prefetch_blocked_source(self):
+        blocked = threading.Event()
+
+        def source():
+            for word in self.words[:3]:
+                yield (False, 1, word, tuple(word))
+            # like a terminal waiting for more input
+            blocked.wait()
+
+        thread = threading.Thread(
+            target=self.model.train_online,
+            args=(source(),),
+            kwargs={'epoch_interval': 3, 'max_epochs': 1, 'prefetch': 10})
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        stuck = thread.is_alive()
+        blocked.set()
+        self.assertFalse(stuck)
+
+    def test_skip_memory(self):
+        assert not self.model._use_skips
+        self._train(skip_memory=1000)
+        # no sketch without skips
+        self.assertIsInstance(self.model._skipcounter, collections.Counter)
+
+    def test_word_backlinks(self):
+        self.model.add_annotations(
+            {'AAHHHH': ((CategorizedMorph('AA', 'PRE'),
+                         CategorizedMorph('HHHH', 'STM')),)})
+        self.model._update_annotation_choices()
+        self.words.append('AAIIII')
+        self.model._get_word_backlinks()
+        data = [(False, 1, word, tuple(word)) for word in self.words]
+        data.append((True, 1, 'IIIIEE', (CategorizedMorph('IIII', None),
+                                         CategorizedMorph('EE', None))))
+        self.model.train_online(iter(data), epoch_interval=100,
+                                max_epochs=1, batch_size=2)
+        # kept up to date as words are added
+        word_backlinks = self.model._word_backlinks
+        morph_backlinks = dict(self.model.morph_backlinks)
+        self.model._word_backlinks = None
+        self.model._calculate_morph_backlinks()
+        self.assertEqual(word_backlinks, self.model._get_word_backlinks())
+        self.assertEqual(
+            {morph: words for (morph, words) in morph_backlinks.items()
+             if len(words) > 0},
+            dict(self.model.morph_backlinks))
+        for word in ('AAHHHH', 'AAIIII', 'IIIIEE'):
+            self.assertIn(word, word_backlinks)
+
+
+class TestChangeCounts(unittest.TestCase):
+    def setUp(self):
+        self.old = (CategorizedMorph('AA', 'PRE'),
+                    CategorizedMorph('BBBBB', 'STM'))
+        self.new = (CategorizedMorph('AABBBBB', 'STM'),)
+
+    def test_counts(self):
+        cc = flatcat.ChangeCounts()
+        cc.update(self.old, -3)
+        cc.update(self.new, 3)
+        self.assertEqual(_remove_zeros(cc.emissions),
+                         {self.old[0]: -3, self.old[1]: -3, self.new[0]: 3})
+        self.assertEqual(_remove_zeros(cc.transitions),
+                         {(flatcat.WORD_BOUNDARY, 'PRE'): -3,
+                          ('PRE', 'STM'): -3,
+                          (flatcat.WORD_BOUNDARY, 'STM'): 3})
+
+    def test_backlinks(self):
+        cc = flatcat.ChangeCounts()
+        cc.update(self.old, -1, corpus_index=1)
+        cc.update(self.new, 1, corpus_index=1)
+        # Removal followed by readding is the same as just adding
+        cc.update(self.old, -1, corpus_index=2)
+        cc.update(self.old, 1, corpus_index=2)
+        (removals, additions) = cc.resolved_backlinks()
+        self.assertEqual(removals, {'AA': set([1]), 'BBBBB': set([1])})
+        self.assertEqual(dict(additions), {'AA': set([2]),
+                                           'BBBBB': set([2]),
+                                           'AABBBBB': set([1])})
+
+        cc.clear()
+        self.assertEqual(len(cc.emissions), 0)
+        self.assertEqual(len(cc.transitions), 0)
+        self.assertEqual(cc.resolved_backlinks(), ({}, {}))
+
+
+class TestTransformationRule(unittest.TestCase):
+    analyses = (
+        (),
+        (CategorizedMorph('AA', 'PRE'),),
+        (CategorizedMorph('AA', 'PRE'), CategorizedMorph('BB', 'STM')),
+        (CategorizedMorph('AA', 'STM'), CategorizedMorph('BB', 'STM'),
+         CategorizedMorph('AA', 'STM'), CategorizedMorph('BB', 'STM')),
+        (CategorizedMorph('AA', 'PRE'), CategorizedMorph('AA', 'PRE'),
+         CategorizedMorph('BB', 'STM'), CategorizedMorph('CC', 'SUF')),
+        (CategorizedMorph('BB', 'STM'), CategorizedMorph('AA', 'STM'),
+         CategorizedMorph('BB', 'STM'), CategorizedMorph('BB', 'STM')))
+
+    def _assert_same_as_generic(self, rule):
+        for analysis in self.analyses:
+            self.assertEqual(rule.matches(analysis),
+                             rule._match_generic(analysis),
+                             msg='{} in {}'.format(rule, analysis))
+
+    def test_single_morph(self):
+        rule = flatcat.TransformationRule((CategorizedMorph('AA', None),))
+        self.assertEqual(rule._matcher, rule._match_morph)
+        self._assert_same_as_generic(rule)
+
+    def test_bimorph(self):
+        for context_type in range(4):
+            for (pre, suf) in (('AA/PRE', 'BB/STM'), ('AA/STM', 'BB/STM'),
+                               ('BB/STM', 'BB/STM')):
+                rule = flatcat.TransformationRule(
+                    (CategorizedMorph(*pre.split('/')),
+                     CategorizedMorph(*suf.split('/'))),
+                    context_type=context_type)
+                self.assertEqual(rule._matcher, rule._match_bimorph)
+                self._assert_same_as_generic(rule)
+
+
+class TestExperimentScheduler(unittest.TestCase):
+    estimates = {'a': 1, 'b': 5, 'c': 3, 'd': 2}
+
+    def _run(self, scheduler, gains):
+        keys = scheduler.ordered('op', sorted(self.estimates),
+                                 self.estimates.get)
+        performed = []
+        for key in scheduler.schedule('op', keys):
+            performed.append(key)
+            scheduler.report(gains.get(key, 0))
+        return performed
+
+    def test_order(self):
+        scheduler = flatcat.ExperimentScheduler()
+        self.assertEqual(self._run(scheduler, {'a': 2, 'd': 7}),
+                         ['b', 'c', 'd', 'a'])
+        # accepted by gain, then untried and rejected by estimate
+        scheduler._history.pop(('op', 'c'))
+        self.assertEqual(self._run(scheduler, {}), ['d', 'a', 'c', 'b'])
+        unordered = flatcat.ExperimentScheduler(order=False)
+        self.assertEqual(self._run(unordered, {}), ['a', 'b', 'c', 'd'])
+
+    def test_cut_off(self):
+        def run(gains):
+            scheduler = flatcat.ExperimentScheduler(min_gain=1.0, window=2)
+            return self._run(scheduler, gains)
+        self.assertEqual(run({'b': 0.5, 'c': 0.4}), ['b', 'c'])
+        self.assertEqual(run({'b': 0.5, 'c': 0.6}), ['b', 'c', 'd'])
+        self.assertEqual(run({'b': 0.5, 'c': 0.6, 'd': 0.5}),
+                         ['b', 'c', 'd', 'a'])
+        # the window is restarted with each iteration
+        scheduler = flatcat.ExperimentScheduler(order=False, min_gain=1.0,
+                                                window=2)
+        self.assertEqual(self._run(scheduler, {}), ['a', 'b'])
+        self.assertEqual(self._run(scheduler, {}), ['a', 'b'])
+
+    def test_report_gain(self):
+        model = flatcat.FlatcatModel()
+        scheduler = flatcat.ExperimentScheduler(window=2)
+        model._experiment_scheduler = scheduler
+        keys = model._scheduled('op', sorted(self.estimates),
+                                self.estimates.get)
+        for key in keys:
+            model._report_gain(10 * self.estimates[key])
+            if key == 'c':
+                break
+        self.assertEqual(scheduler._history,
+                         {('op', 'b'): 50, ('op', 'c'): 30})
+        self.assertEqual(list(scheduler._recent), [50, 30])
+        self.assertEqual(model._iteration_position, 2)
+        for key in keys:
+            model._report_gain(self.estimates[key])
+        self.assertEqual(list(scheduler._recent), [2, 1])
+        self.assertEqual(scheduler._history[('op', 'a')], 1)
+        # gains reported outside an iteration are ignored
+        model._report_gain(100)
+        self.assertEqual(list(scheduler._recent), [2, 1])
+
+
+class TestBoundedCache(unittest.TestCase):
+    def test_frequent_survive_scan(self):
+        cache = utils.BoundedCache(8)
+        for key in ('a', 'b'):
+            cache[key] = key
+            cache.get(key)
+        # A scan of keys used once only evicts from probation
+        for i in range(20):
+            cache[i] = i
+        self.assertEqual(cache.get('a'), 'a')
+        self.assertEqual(cache.get('b'), 'b')
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(len(cache), 8)
+        self.assertEqual(cache.evictions, 14)
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+    def test_size_func(self):
+        cache = utils.BoundedCache(10, size_func=len)
+        cache['x'] = 'xxxx'
+        cache.get('x')
+        cache['y'] = 'yyyy'
+        cache.get('y')
+        cache['x'] = 'xxxxxxx'
+        self.assertEqual(cache.size, 7)
+        self.assertNotIn('y', cache)
+        cache.resize(None)
+        cache['z'] = 'z' * 20
+        self.assertEqual(cache.size, 27)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_bounds(self):
+        sketch = utils.CountMinSketch.from_memory(4096)
+        self.assertEqual(sketch.memory_size, 4096)
+        counts = collections.Counter()
+        for i in range(2000):
+            word = 'w{}'.format(int(1000 / (1 + i % 97)))
+            counts[word] += 1
+            sketch[word] += 1
+        self.assertEqual(sketch.total, 2000)
+        # The error bound only holds with probability 1 - delta,
+        # but no count is ever underestimated
+        for (word, count) in counts.items():
+            self.assertGreaterEqual(sketch[word], count)
+        # The cells of a key do not depend on the hash seed
+        digest = hashlib.sha1(b'w1000').digest()
+        self.assertEqual(sketch._cells('w1000')[0],
+                         struct.unpack(str('<I'), digest[:4])[0] %
+                         sketch.width)
+        self.assertNotIn('unseen', sketch)
+        sketch.clear()
+        self.assertEqual((sketch.total, sketch['w1000']), (0, 0))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_ordered(self):
+        for num_processes in (1, 3):
+            out = []
+            pipeline = utils.Pipeline(lambda x: x * x, num_processes,
+                                      chunk_size=7, queue_chunks=2)
+            pipeline.run(range(1000), out.extend)
+            self.assertEqual(out, [x * x for x in range(1000)])
+            self.assertEqual(pipeline.stats['read'].items, 1000)
+            self.assertEqual(pipeline.stats['write'].items, 1000)
+
+    def test_errors(self):
+        def source():
+            for x in range(100):
+                yield x
+            raise ValueError('source')
+
+        def process(x):
+            if x == 50:
+                raise KeyError(x)
+            return x
+
+        pipeline = utils.Pipeline(lambda x: x, chunk_size=10)
+        self.assertRaises(ValueError, pipeline.run, source(), list)
+        for num_processes in (1, 2):
+            pipeline = utils.Pipeline(process, num_processes, chunk_size=10)
+            self.assertRaises(KeyError, pipeline.run, range(100), list)
+
+    def test_prefetcher(self):
+        prefetcher = utils.Prefetcher(iter(range(1000)), chunk_size=7,
+                                      queue_chunks=2)
+        self.assertEqual(list(prefetcher), list(range(1000)))
+
+        def source():
+            for x in range(10):
+                yield x
+            raise ValueError('source')
+
+        prefetcher = utils.Prefetcher(source(), chunk_size=3)
+        self.assertEqual([next(prefetcher) for _ in range(9)],
+                         list(range(9)))
+        self.assertRaises(ValueError, list, prefetcher)
+        # the reading thread is stopped before the end
+        prefetcher = utils.Prefetcher(iter(range(1000)), chunk_size=1,
+                                      queue_chunks=2)
+        self.assertEqual(next(prefetcher), 0)
+        prefetcher.close()
+        self.assertFalse(prefetcher._thread.is_alive())
+        # closing does not wait for a source blocked on input
+        blocked = threading.Event()
+
+        def blocking_source():
+            for x in range(3):
+                yield x
+            blocked.wait()
+            yield 3
+
+        prefetcher = utils.Prefetcher(blocking_source(), chunk_size=1)
+        self.assertEqual([next(prefetcher) for _ in range(3)], [0, 1, 2])
+        prefetcher.close(timeout=0.1)
+        self.assertTrue(prefetcher._thread.is_alive())
+        blocked.set()
+        prefetcher._thread.join()
+
+    def test_background_writer(self):
+        out = []
+        with utils.BackgroundWriter(lambda x, y: out.append(x * y),
+                                    chunk_size=7, queue_chunks=2) as writer:
+            for x in range(1000):
+                writer.write(x, 2)
+        self.assertEqual(out, [2 * x for x in range(1000)])
+
+        def fail(x):
+            if x == 5:
+                raise KeyError(x)
+
+        writer = utils.BackgroundWriter(fail, chunk_size=1)
+
+        def write_all():
+            for x in range(1000):
+                writer.write(x)
+            writer.close()
+        self.assertRaises(KeyError, write_all)
+
+
+class TestIO(unittest.TestCase):
+    def test_read_blocks(self):
+        io = flatcat_io.FlatcatIO(encoding='latin-1')
+        expected = list(io.read_segmentation_file(
+            REFERENCE_BASELINE_TAGGED))
+        # Small blocks, split between lines and parsed in workers
+        io.READ_BLOCK_SIZE = 1000
+        blocks = list(io.read_segmentation_blocks(
+            REFERENCE_BASELINE_TAGGED, num_processes=2))
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual([row for block in blocks for row in block],
+                         expected)
+        self.assertEqual(expected[0],
+                         (1, (CategorizedMorph('aamul', 'STM'),
+                              CategorizedMorph('ehti', 'STM'))))
+
+    def test_pipelined_write(self):
+        io = flatcat_io.FlatcatIO(encoding='latin-1')
+        data = list(io.read_segmentation_file(REFERENCE_BASELINE_TAGGED))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outputs = []
+            for num_processes in (None, 1, 2):
+                file_name = os.path.join(tmpdir, 'out.txt')
+                io.write_formatted_file(
+                    file_name, '{count} {analysis}\n', data,
+                    lambda item: (item[0], None, [item[1]], 0, 0),
+                    output_tags=True, num_processes=num_processes)
+                with open(file_name, 'rb') as fobj:
+                    outputs.append(fobj.read())
+            self.assertGreater(len(outputs[0]), 0)
+            self.assertEqual(outputs[1], outputs[0])
+            self.assertEqual(outputs[2], outputs[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parallel_gzip(self):
+        data = ''.join('{} {}\n'.format(i, 'abc' * (i % 7))
+                       for i in range(5000)).encode('ascii')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'out.gz')
+            with flatcat_io.ParallelGzipWriter(
+                    file_name, num_threads=2, block_size=1000) as fobj:
+                for i in range(0, len(data), 100):
+                    fobj.write(data[i:(i + 100)])
+            with gzip.open(file_name, 'rb') as fobj:
+                self.assertEqual(fobj.read(), data)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_line_formatter(self):
+        alternatives = (
+            [(CategorizedMorph('aa', 'PRE'), CategorizedMorph('bbb', 'STM'),
+              CategorizedMorph('c', 'ZZZ'))],
+            [(CategorizedMorph('aabbb', None),)],
+            [(CategorizedMorph('aa', 'PRE'), CategorizedMorph('bbb', 'STM')),
+             (CategorizedMorph('aab', 'STM'), CategorizedMorph('bb', 'SUF'))])
+
+        def old_format(line_format, count, compound, alternatives, logp,
+                       clogp, output_tags, filter_tags):
+            # The formatting done before _LineFormatter
+            output_morph = flatcat_io._make_morph_formatter('/', output_tags)
+            num_morphs = num_nonmorphemes = num_letters = None
+            if len(alternatives) == 1:
+                constructions = alternatives[0]
+                num_morphs = len(constructions)
+                num_nonmorphemes = sum(1 for cmorph in constructions
+                                       if cmorph.category == 'ZZZ')
+                num_letters = sum(len(cmorph.morph)
+                                  for cmorph in constructions)
+            analysis = []
+            for constructions in alternatives:
+                if filter_tags is not None:
+                    constructions = [cmorph for cmorph in constructions
+                                     if cmorph.category not in filter_tags
+                                     or len(cmorph) > 1]
+                analysis.append(' + '.join(
+                    output_morph(cmorph) for cmorph in constructions))
+            return line_format.format(
+                analysis=', '.join(analysis), compound=compound,
+                count=count, logprob=logp, clogprob=clogp,
+                num_morphs=num_morphs, num_nonmorphemes=num_nonmorphemes,
+                num_letters=num_letters)
+
+        formats = ('{count} {analysis}\n',
+                   '{compound}\t{analysis}\t{logprob:.3f}\t{clogprob}\n',
+                   '{num_morphs} {num_nonmorphemes} {num_letters}\n',
+                   '{analysis:>{count}}|{num_letters!r}\n')
+        for line_format in formats:
+            for output_tags in (False, True):
+                for filter_tags in (None, ['ZZZ', 'PRE']):
+                    formatter = flatcat_io._LineFormatter(
+                        line_format, ' + ', ', ', '/',
+                        output_tags=output_tags, filter_tags=filter_tags,
+                        filter_len=1)
+                    for alternative in alternatives:
+                        args = (3, 'aabbbc', alternative, 1.25, 0.5)
+                        self.assertEqual(
+                            formatter(*args),
+                            old_format(line_format, *args,
+                                       output_tags=output_tags,
+                                       filter_tags=filter_tags))
+        self.assertEqual(
+            flatcat_io._format_fields('{count} {analysis:>{num_letters}}'),
+            frozenset(['count', 'analysis', 'num_letters']))
+        formatter = flatcat_io._LineFormatter('{analysis} {unknown}\n',
+                                              ' + ', ', ', '/')
+        self.assertRaises(KeyError, formatter, *(3, 'aabbbc',
+                                                 alternatives[0], 1.0, 0.5))
+
+    def test_sniff_encoding(self):
+        io = flatcat_io.FlatcatIO()
+        io.ENCODING_SNIFF_SIZE = 5
+        # 'aaaa\xe4' ends in the middle of a character in utf-8
+        files = {'utf8.txt': 'aaaa\xe4\n'.encode('utf-8'),
+                 'utf8.gz': 'aaaa\xe4\n'.encode('utf-8'),
+                 'latin1.txt': 'aa\xe4aa\n'.encode('latin-1')}
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for (name, data) in files.items():
+                opener = gzip.open if name.endswith('.gz') else open
+                with opener(os.path.join(tmpdir, name), 'wb') as fobj:
+                    fobj.write(data)
+            for name in ('utf8.txt', 'utf8.gz'):
+                self.assertEqual(
+                    io._sniff_encoding(os.path.join(tmpdir, name)), 'utf-8')
+            # Falls back to the encoding of the locale
+            latin1 = os.path.join(tmpdir, 'latin1.txt')
+            preferred = locale.getpreferredencoding()
+            try:
+                files['latin1.txt'].decode(preferred)
+            except UnicodeDecodeError:
+                self.assertRaises(UnicodeError, io._sniff_encoding, latin1)
+            else:
+                self.assertEqual(io._sniff_encoding(latin1), preferred)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_ahead(self):
+        data = bytes(bytearray(range(256))) * 50
+        reader = flatcat_io.ReadAheadReader(iolib.BytesIO(data), 7)
+        with iolib.BufferedReader(reader, 10) as fobj:
+            self.assertEqual(fobj.read(), data)
+        # Closing before the end stops the reading thread
+        reader = flatcat_io.ReadAheadReader(iolib.BytesIO(data), 7,
+                                            max_blocks=1)
+        self.assertEqual(reader.read(3), data[:3])
+        reader.close()
+        self.assertFalse(reader._thread.is_alive())
+
+        class Failing(object):
+            def read(self, size):
+                raise IOError('read error')
+
+            def close(self):
+                pass
+        reader = flatcat_io.ReadAheadReader(Failing(), 7)
+        self.assertRaises(IOError, reader.read, 3)
+        reader.close()
+
+    def test_read_lines(self):
+        lines = ['1 \xe4\xe4 + bb', '2 cc', '3 \xe4 + \xe4\xe4\xe4']
+        io = flatcat_io.FlatcatIO(encoding='utf-8')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'clean.txt')
+            with open(file_name, 'wb') as fobj:
+                fobj.write(('\n'.join(lines * 20) + '\n').encode('utf-8'))
+            expected = list(io.read_segmentation_file(file_name))
+            self.assertEqual(len(expected), 60)
+            # Windows newlines, and stray carriage returns as newlines
+            data = ''.join(line + ending for (line, ending) in
+                           zip(lines * 20, ['\r\n', '\r', '\n'] * 20))
+            data = data.encode('utf-8')
+            for name in ('crlf.txt', 'crlf.gz'):
+                file_name = os.path.join(tmpdir, name)
+                opener = gzip.open if name.endswith('.gz') else open
+                with opener(file_name, 'wb') as fobj:
+                    fobj.write(data)
+                self.assertEqual(list(io._read_text_file(file_name)),
+                                 lines * 20)
+                # Blocks ending inside the two byte characters
+                for block_size in (3, 4, 5, 16):
+                    io.READ_BLOCK_SIZE = block_size
+                    io.READ_AHEAD_SIZE = block_size
+                    self.assertEqual(
+                        list(io.read_segmentation_file(file_name)),
+                        expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+@unittest.skipIf(server is None, 'asyncio not available')
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        self.model.initialize_hmm()
+        self.words = ['AABBBBB', 'CCCCEE', 'AAXXXXX', 'SSSSS']
+        self.expected = [
+            [(cmorph.morph, cmorph.category)
+             for cmorph in self.model.viterbi_analyze(word)[0]]
+            for word in self.words]
+
+    def test_segment(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'server.sock')
+            srv = server.SegmentationServer(self.model, batch_delay=0.01)
+            with server.ServerThread(srv, path=path) as thread:
+                with server.LineClient(thread.address, timeout=10) as client:
+                    self.assertEqual(client.segment(self.words),
+                                     self.expected)
+                    response = client.request({'id': 7, 'words': 'AA'})
+                    self.assertEqual(response['id'], 7)
+                    self.assertIn('error', response)
+                    # repeated words are answered from the cache
+                    client.segment(self.words)
+                    stats = client.request({'command': 'stats'})['stats']
+                    self.assertEqual(stats['words'], 8)
+                    self.assertEqual(stats['cache_size'], 4)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_small_cache(self):
+        srv = server.SegmentationServer(self.model, batch_delay=0.01,
+                                        cache_size=2)
+        with server.ServerThread(srv) as thread:
+            with server.LineClient(thread.address, timeout=10) as client:
+                self.assertEqual(client.segment(self.words[:2]),
+                                 self.expected[:2])
+                # Inserting the new words evicts the cached ones
+                self.assertEqual(client.segment(self.words),
+                                 self.expected)
+        # Each word is looked up once per request
+        self.assertEqual(srv.cache.hits + srv.cache.misses, 6)
+        self.assertEqual(srv.cache.misses, 4)
+
+    def test_concurrent_clients(self):
+        srv = server.SegmentationServer(self.model, batch_delay=0.01)
+        with server.ServerThread(srv) as thread:
+            clients = [server.LineClient(thread.address, timeout=10)
+                       for _ in range(4)]
+            try:
+                # Pipelined requests are answered in order
+                for (i, client) in enumerate(clients):
+                    for word in self.words:
+                        client._sock.sendall(json.dumps(
+                            {'id': i, 'word': word}).encode('utf-8') + b'\n')
+                for (i, client) in enumerate(clients):
+                    for expected in self.expected:
+                        response = json.loads(
+                            client._file.readline().decode('utf-8'))
+                        self.assertEqual(response['id'], i)
+                        self.assertEqual(
+                            [tuple(pair) for pair in response['analyses'][0]],
+                            expected)
+            finally:
+                for client in clients:
+                    client.close()
+        self.assertLess(srv.num_batches, srv.num_requests)
+
+    def test_reload(self):
+        io = flatcat_io.FlatcatIO()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'model.bin')
+            io.write_binary_model_file(file_name, self.model)
+            srv = server.SegmentationServer(
+                server.load_segmenter(io, file_name),
+                model_file=file_name,
+                loader=lambda f: server.load_segmenter(io, f))
+            with server.ServerThread(srv) as thread:
+                with server.LineClient(thread.address, timeout=10) as client:
+                    client.segment(self.words)
+                    old = client.request({'command': 'stats'})['stats']
+                    response = client.request({'command': 'reload'})
+                    self.assertTrue(response['reload']['unchanged'])
+
+                    self.model.train_batch(max_epochs=1)
+                    io.write_binary_model_file(file_name, self.model)
+                    response = client.request({'command': 'reload'})
+                    self.assertEqual(response['reload']['fingerprint'],
+                                     server.model_fingerprint(file_name))
+                    self.assertEqual(
+                        response['reload']['previous_fingerprint'],
+                        old['fingerprint'])
+                    new = client.request({'command': 'stats'})['stats']
+                    self.assertEqual(new['reloads'], 1)
+                    # the cache of the old model is dropped
+                    self.assertEqual(new['cache_size'], 0)
+                    self.assertEqual(
+                        client.segment(self.words),
+                        [[(cmorph.morph, cmorph.category)
+                          for cmorph in self.model.viterbi_analyze(word)[0]]
+                         for word in self.words])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prefork(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'server.sock')
+            prefork = server.PreforkServer(
+                server.SegmentationServer(self.model), 2)
+            process = multiprocessing.get_context('fork').Process(
+                target=prefork.serve_forever, kwargs={'path': path})
+            process.start()
+            try:
+                pids = set()
+                for _ in range(50):
+                    try:
+                        with server.LineClient(path, timeout=10) as client:
+                            self.assertEqual(client.segment(self.words),
+                                             self.expected)
+                            pids.add(client.request(
+                                {'command': 'stats'})['stats']['pid'])
+                        break
+                    except (IOError, OSError):
+                        # not listening yet
+                        time.sleep(0.1)
+                self.assertEqual(len(pids), 1)
+                # a killed worker is replaced
+                os.kill(pids.pop(), signal.SIGKILL)
+                with server.LineClient(path, timeout=10) as client:
+                    self.assertEqual(client.segment(self.words),
+                                     self.expected)
+            finally:
+                process.terminate()
+                process.join()
+            self.assertEqual(process.exitcode, 0)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prefork_hangup(self):
+        io = flatcat_io.FlatcatIO()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'server.sock')
+            file_name = os.path.join(tmpdir, 'model.bin')
+            io.write_binary_model_file(file_name, self.model)
+            prefork = server.PreforkServer(
+                server.SegmentationServer(
+                    server.load_segmenter(io, file_name),
+                    model_file=file_name,
+                    loader=lambda f: server.load_segmenter(io, f)),
+                1)
+            process = multiprocessing.get_context('fork').Process(
+                target=prefork.serve_forever, kwargs={'path': path})
+            process.start()
+
+            def stats():
+                for _ in range(50):
+                    try:
+                        with server.LineClient(path, timeout=10) as client:
+                            return client.request(
+                                {'command': 'stats'})['stats']
+                    except (IOError, OSError):
+                        # not listening yet
+                        time.sleep(0.1)
+
+            try:
+                old = stats()
+                self.model.train_batch(max_epochs=1)
+                io.write_binary_model_file(file_name, self.model)
+                # the worker does not reload a model of its own
+                os.kill(old['pid'], signal.SIGHUP)
+                time.sleep(0.5)
+                same = stats()
+                self.assertEqual(same['pid'], old['pid'])
+                self.assertEqual(same['reloads'], 0)
+                self.assertEqual(same['fingerprint'], old['fingerprint'])
+                # the parent forks a new worker with the new model
+                os.kill(process.pid, signal.SIGHUP)
+                for _ in range(50):
+                    new = stats()
+                    if new['pid'] != old['pid']:
+                        break
+                    time.sleep(0.1)
+                self.assertNotEqual(new['pid'], old['pid'])
+                self.assertEqual(new['fingerprint'],
+                                 server.model_fingerprint(file_name))
+            finally:
+                process.terminate()
+                process.join()
+            self.assertEqual(process.exitcode, 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+@unittest.skipIf(server is None, 'the server requires asyncio')
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        self.model.initialize_hmm()
+        self.words = ['AABBBBB', 'CCCCEE', 'AAXXXXX', 'SSSSS', 'AABBBBB']
+        self.expected = [self.model.viterbi_analyze(word)
+                         for word in self.words]
+
+    def _assert_analyses(self, analyses):
+        self.assertEqual([analysis for (analysis, _) in analyses],
+                         [tuple(analysis)
+                          for (analysis, _) in self.expected])
+        for ((_, logp), (_, expected)) in zip(analyses, self.expected):
+            self.assertAlmostEqual(logp, expected)
+
+    def test_sync(self):
+        srv = server.SegmentationServer(self.model, batch_delay=0.001)
+        with server.ServerThread(srv) as thread:
+            with flatcat_client.SegmentationClient(
+                    thread.address, pool_size=2, batch_size=2) as client:
+                self._assert_analyses(client.analyze(self.words))
+                self.assertEqual(client.segment_word('SSSSS'),
+                                 self.expected[3][0])
+                self.assertEqual(client.analyze([]), [])
+                self.assertRaises(flatcat_client.SegmentationServerError,
+                                  client._command, 'unknown')
+                self.assertEqual(client.stats()['cache_size'], 4)
+                # a connection closed by the server is retried
+                for connection in list(client._idle.queue):
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                self._assert_analyses(client.analyze(self.words))
+
+    def test_async(self):
+        srv = server.SegmentationServer(self.model, batch_delay=0.001)
+        with server.ServerThread(srv) as thread:
+            loop = asyncio.new_event_loop()
+            try:
+                results = loop.run_until_complete(
+                    client_coroutines.use_async_client(thread.address,
+                                                       self.words))
+            finally:
+                loop.close()
+        self._assert_analyses(results['analyze'])
+        self._assert_analyses(results['analyze_word'])
+        self.assertEqual(results['stats']['cache_size'], 4)
+        self.assertIsInstance(results.get('error'),
+                              flatcat_client.SegmentationServerError)
+        # the single words were sent in shared requests
+        self.assertLess(srv.num_requests, 2 + len(self.words))
+
+    def test_timeout(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            # never answers
+            client = flatcat_client.SegmentationClient(
+                listener.getsockname(), timeout=0.1)
+            self.assertRaises(socket.timeout, client.segment, self.words)
+            client.close()
+        finally:
+            listener.close()
+
+
 class TestModelConsistency(unittest.TestCase):
     dummy_segmentation = (
         (1, ('AA', 'BBBBB')),)
@@ -399,6 +1261,41 @@ class TestModelConsistency(unittest.TestCase):
                 None)
         self._destructive_backlink_check()
 
+    def test_transform_lower_bound(self):
+        self.model.add_corpus_data(
+            TestModelConsistency.one_split_segmentation)
+        self._presplit()
+
+        tmp = ((('AA', 'BBBBB'), ('AABBBBB',)),
+               (('AAXXXXX',), ('AA', 'XXXXX')),
+               (('BBBBB',), ('BB', 'B', 'BB')),
+               (('CCCC',), ('C', 'CCC')))
+
+        for a, b in tmp:
+            transformation = flatcat.Transformation(
+                flatcat.TransformationRule(
+                    [flatcat.CategorizedMorph(morph, None) for morph in a]),
+                [flatcat.CategorizedMorph(morph, None) for morph in b])
+            matched_targets, num_matches = self.model._find_in_corpus(
+                transformation.rule, None)
+            bound_terms = self.model._transform_bound_terms(
+                transformation, matched_targets)
+            for morph in self.model.detag_word(transformation.rule):
+                self.model._modify_morph_count(morph, -num_matches)
+            for morph in self.model.detag_word(transformation.result):
+                self.model._modify_morph_count(morph, num_matches)
+            bound = self.model._transform_cost_lower_bound(
+                transformation, num_matches, bound_terms)
+            for i in matched_targets:
+                transformation.apply(self.model.segmentations[i], self.model)
+            self.model._update_counts(transformation.change_counts, 1)
+            self.assertLessEqual(bound, self.model.get_cost() + 1e-6)
+            self.model._update_counts(transformation.change_counts, -1)
+            for morph in self.model.detag_word(transformation.result):
+                self.model._modify_morph_count(morph, -num_matches)
+            for morph in self.model.detag_word(transformation.rule):
+                self.model._modify_morph_count(morph, num_matches)
+
     def test_update_counts(self):
         self._presplit()
         # manual change to join the one occurence of AA BBBBB
@@ -539,6 +1436,219 @@ class TestModelConsistency(unittest.TestCase):
 
         self._initial_state_asserts()
 
+    def test_incremental_reestimate(self):
+        self.model.add_corpus_data(
+            TestModelConsistency.one_split_segmentation)
+        self._presplit()
+
+        # Perform only the first join experiment
+        experiments = self.model._op_join_generator()
+        self.model._operation_loop(iter([next(experiments)]))
+        self.assertEqual(self.model._reestimate_changes,
+                         set(('AA', 'BBBBB', 'AABBBBB')))
+
+        self.model.reestimate_probabilities(incremental=True)
+        self.assertEqual(self.model._incremental_reestimates, 1)
+        incremental_cost = self.model.get_cost()
+        self.model.reestimate_probabilities()
+        self.assertAlmostEqual(incremental_cost, self.model.get_cost())
+        self._general_consistency_asserts()
+
+    def test_estimate_lazy_contexts(self):
+        self.model.add_corpus_data(
+            TestModelConsistency.one_split_segmentation)
+        self._presplit()
+        morph_usage = self.model._morph_usage
+        left_parent = morph_usage.get_context_features('EE')
+        right_parent = morph_usage.get_context_features('AA')
+        self.assertNotEqual(left_parent.left_perplexity, 1.0)
+        self.assertNotEqual(right_parent.right_perplexity, 1.0)
+        contexts_before = dict(morph_usage._contexts)
+
+        # Shift the boundary between EE and AA
+        tmp = morph_usage.estimate_contexts(('EE', 'AA'), ('EEA', 'A'))
+        self.assertEqual(dict(morph_usage._contexts), contexts_before)
+        self.assertEqual(morph_usage.get_context_features('EEA'),
+                         (0, left_parent.left_perplexity, 1.0))
+        self.assertEqual(morph_usage.get_context_features('A'),
+                         (0, 1.0, right_parent.right_perplexity))
+
+        # Counting the morph moves the estimate into the real contexts
+        morph_usage.set_count('EEA', 1)
+        self.assertEqual(morph_usage._contexts['EEA'],
+                         (1, left_parent.left_perplexity, 1.0))
+        morph_usage.set_count('EEA', 0)
+        morph_usage.remove_temporaries(tmp)
+        self.assertEqual(dict(morph_usage._contexts), contexts_before)
+        self.assertEqual(morph_usage._estimated, {})
+
+    def test_reestimated_condprobs(self):
+        self.model.add_corpus_data(
+            TestModelConsistency.one_split_segmentation)
+        self._presplit()
+        morph_usage = self.model._morph_usage
+
+        # E is estimated for a boundary shift in EE AA
+        tmp = morph_usage.estimate_contexts(('EE', 'AA'), ('E', 'EAA'))
+        first = (morph_usage.get_context_features('E'),
+                 morph_usage.condprobs('E'))
+        morph_usage.remove_temporaries(tmp)
+        # and then for one in CCCC EE, with different perplexities
+        tmp = morph_usage.estimate_contexts(('CCCC', 'EE'), ('CCCCE', 'E'))
+        self.assertNotEqual(morph_usage.get_context_features('E'),
+                            first[0])
+        condprobs = morph_usage.condprobs('E')
+        self.assertNotEqual(condprobs, first[1])
+        morph_usage._condprob_cache.clear()
+        self.assertEqual(condprobs, morph_usage.condprobs('E'))
+        morph_usage.remove_temporaries(tmp)
+
+    def test_sharded_usage_features(self):
+        self._presplit()
+        morph_usage = self.model._morph_usage
+        self.model._calculate_usage_features()
+        serial = list(morph_usage._contexts.items())
+
+        morph_usage.num_processes = 2
+        morph_usage._contexts_per_iter = 3
+        self.model._calculate_usage_features()
+        self.assertEqual(list(morph_usage._contexts.items()), serial)
+
+    def test_memory_budget(self):
+        self._presplit()
+        self.assertEqual(utils.parse_memory_size('2k'), 2048)
+        self.assertEqual(utils.parse_memory_size('1.5M'),
+                         3 * 2 ** 19)
+        budget = utils.MemoryBudget(2 ** 20, {'table': 0.5})
+        self.assertEqual(budget.share('table'), 2 ** 19)
+        table = dict(('w{}'.format(i), ('w', str(i))) for i in range(100))
+        self.assertGreater(budget.dict_entries('table', table), 100)
+        self.assertLess(budget.dict_entries('table', table), 2 ** 19 // 50)
+        self.assertEqual(budget.dict_entries('table', {}, minimum=7), 7)
+        self.model.set_memory_budget(2 ** 20)
+        small = (self.model._morph_usage._contexts_per_iter,
+                 self.model._corpus_coding._emission_cache.max_size)
+        self.model.set_memory_budget(2 ** 24)
+        large = (self.model._morph_usage._contexts_per_iter,
+                 self.model._corpus_coding._emission_cache.max_size)
+        self.assertEqual(large[0] // small[0], 16)
+        self.assertEqual(large[1] // small[1], 16)
+        coding = self.model._corpus_coding
+        self.model.reestimate_probabilities()
+        self.assertEqual(coding._emission_cache.max_size, large[1])
+        self.model.set_memory_budget(None)
+        self.assertEqual(coding._emission_cache.max_size, 75000)
+        # An unbounded emission cache is a plain dict
+        cost = coding.log_emissionprob('STM', 'BBBBB')
+        coding.set_emission_cache_size(None)
+        self.assertIs(type(coding._emission_cache), dict)
+        self.assertEqual(coding.log_emissionprob('STM', 'BBBBB'), cost)
+        self.assertIn('BBBBB', coding._emission_cache)
+        coding.set_emission_cache_size(10)
+        self.assertEqual(coding._emission_cache.max_size, 10)
+
+        # Removing the budget restores the sizes given to the constructor
+        model = flatcat.FlatcatModel(
+            flatcat.MorphUsageProperties(contexts_per_iter=1000))
+        model.add_corpus_data(TestModelConsistency.one_split_segmentation)
+        model.initialize_hmm()
+        model.set_memory_budget(2 ** 24)
+        self.assertNotEqual(model._morph_usage._contexts_per_iter, 1000)
+        model.set_memory_budget(None)
+        self.assertEqual(model._morph_usage._contexts_per_iter, 1000)
+
+    def test_checkpoint_resume(self):
+        model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        model.initialize_hmm()
+        checkpoints = []
+
+        def checkpoint(model):
+            if len(checkpoints) == 0:
+                checkpoints.append(pickle.dumps(
+                    model.get_checkpoint_state()))
+        model.experiment_callbacks.append(checkpoint)
+        model.train_batch(max_epochs=2, max_iterations_first=2)
+        self.assertEqual(len(checkpoints), 1)
+
+        resumed = flatcat.FlatcatModel.from_checkpoint_state(
+            pickle.loads(checkpoints[0]))
+        self.assertIsNotNone(resumed._iteration_keys)
+        resumed.resume_batch_training()
+        self.assertEqual(resumed.get_cost(), model.get_cost())
+        self.assertEqual(resumed.segmentations, model.segmentations)
+
+    def test_background_checkpoint(self):
+        model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        model.initialize_hmm()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'checkpoint.bin')
+            checkpoints = flatcat_io.CheckpointWriter(
+                flatcat_io.FlatcatIO(), file_name, background=True)
+            checkpoints.write(model)
+            checkpoints.finish()
+            resumed = flatcat_io.FlatcatIO().read_checkpoint_file(file_name)
+            self.assertEqual(resumed.get_cost(), model.get_cost())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_snapshot_writer(self):
+        model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        model.initialize_hmm()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'model.tar.gz')
+            io = flatcat_io.FlatcatIO()
+            snapshots = flatcat_io.SnapshotWriter(io.write_tarball_model_file)
+            self.assertTrue(snapshots.write(file_name, model))
+            # The completion is noticed without polling
+            snapshots._reaper.join()
+            self.assertEqual(snapshots.status, 0)
+            self.assertTrue(snapshots.poll())
+            self.assertTrue(snapshots.write(file_name, model))
+            self.assertTrue(snapshots.write(file_name, model, skip=False))
+            self.assertTrue(snapshots.wait())
+            loaded = io.read_tarball_model_file(file_name)
+            self.assertEqual(loaded.segmentations, model.segmentations)
+
+            def fail(file_name, model):
+                raise IOError('disk full')
+            failing = flatcat_io.SnapshotWriter(fail)
+            failing.write(file_name, model)
+            self.assertFalse(failing.wait())
+            self.assertEqual(failing.status >> 8, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_packed_model(self):
+        model = _load_flatcat(TestModelConsistency.one_split_segmentation)
+        model.initialize_hmm()
+        model.train_batch(max_epochs=1)
+        io = flatcat_io.FlatcatIO()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmpdir, 'model.packed')
+            io.write_packed_model_file(file_name, model)
+            loaded = io.read_packed_model_file(file_name)
+            self.assertEqual(loaded.get_cost(), model.get_cost())
+            self.assertEqual(loaded.segmentations, model.segmentations)
+            self.assertEqual(loaded._morph_usage._contexts,
+                             model._morph_usage._contexts)
+            self.assertEqual(dict(loaded.morph_backlinks),
+                             dict(model.morph_backlinks))
+
+            # corruption is detected by the checksums
+            with open(file_name, 'rb') as fobj:
+                data = bytearray(fobj.read())
+            data[-1] ^= 1
+            with open(file_name, 'wb') as fobj:
+                fobj.write(bytes(data))
+            self.assertRaises(flatcat_io.InvalidModelFileError,
+                              io.read_packed_model_file, file_name)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def _presplit(self):
         self.model.viterbi_tag_corpus()
         self.model.reestimate_probabilities()
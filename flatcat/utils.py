@@ -2,12 +2,25 @@
 shared between different modules and variants of the software.
 """
 
+import array
+import collections
+import hashlib
 import logging
 import math
+import multiprocessing
+import os
 import random
+import struct
 import sys
+import threading
+import time
 import types
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 _logger = logging.getLogger(__name__)
 
@@ -224,3 +237,868 @@ def _is_string(obj):
         return isinstance(obj, basestring)
     except NameError:
         return isinstance(obj, str)
+
+
+_SIZE_SUFFIXES = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_memory_size(size):
+    """Parses a memory size in bytes, optionally with
+    one of the suffixes K, M, G or T (powers of 1024)."""
+    size = str(size).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    multiplier = 1
+    if size and size[-1] in _SIZE_SUFFIXES:
+        multiplier = _SIZE_SUFFIXES[size[-1]]
+        size = size[:-1]
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        raise ValueError('Invalid memory size "{}"'.format(size))
+
+
+def _format_memory_size(num_bytes):
+    """Human readable representation of a size in bytes."""
+    if num_bytes is None:
+        return 'unknown'
+    for suffix in ('', 'K', 'M', 'G'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.
+    else:
+        suffix = 'T'
+    return '{:.1f}{}B'.format(num_bytes, suffix)
+
+
+def _sizeof(obj, seen=None):
+    """Approximate size in bytes of an object, including the objects
+    it contains. Shared objects are only counted once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (key, value) in obj.items():
+            size += _sizeof(key, seen) + _sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _sizeof(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, seen)
+    return size
+
+
+def _dict_entry_overhead(num_entries=1000):
+    """Average number of bytes a dict uses per entry,
+    excluding the keys and values themselves."""
+    table = dict((i, None) for i in range(num_entries))
+    return float(sys.getsizeof(table) - sys.getsizeof({})) / num_entries
+
+
+def _process_memory():
+    """Resident set size of the current process in bytes,
+    or None if it can not be determined on this platform."""
+    try:
+        with open('/proc/self/statm') as fobj:
+            resident = int(fobj.read().split()[1])
+        return resident * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    # Peak instead of current usage
+    return _peak_memory()
+
+
+def _peak_memory(children=False):
+    """Peak resident set size of the current process in bytes,
+    or None if it can not be determined on this platform.
+    If children is True, the peak of the largest child process
+    that has been waited for is returned instead."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    if children:
+        who = resource.RUSAGE_CHILDREN
+    else:
+        who = resource.RUSAGE_SELF
+    # Reported in kilobytes on Linux, but in bytes on OS X.
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def _private_memory(pid='self'):
+    """Memory in bytes used only by the process, excluding the pages
+    shared with other processes (e.g. copy-on-write after forking),
+    or None if it can not be determined on this platform."""
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as fobj:
+            total = 0
+            for line in fobj:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    total += int(line.split()[1])
+        return total * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryBudget(object):
+    """Divides a memory budget in bytes between caches and other
+    growing data structures, which are then limited to a number
+    of entries based on the measured size of a typical entry.
+
+    The budget covers only the structures it is used to size,
+    not the model itself.
+    """
+
+    def __init__(self, budget, shares):
+        """Arguments:
+            budget :  The total budget in bytes.
+            shares :  A dict of the proportion of the budget given
+                      to each named structure. Should sum to at most 1.
+        """
+        self.budget = int(budget)
+        self.shares = dict(shares)
+
+    def share(self, name):
+        """Returns the number of bytes given to the named structure."""
+        return int(self.budget * self.shares[name])
+
+    def entries(self, name, entry_size, minimum=1):
+        """Returns the number of entries that fit in the share of
+        the named structure, when each entry takes entry_size bytes."""
+        entry_size = max(1, int(math.ceil(entry_size)))
+        return max(minimum, self.share(name) // entry_size)
+
+    def dict_entries(self, name, table, minimum=1):
+        """Returns the number of entries that fit in the share of
+        the named structure, when it is a dict whose entries are
+        the size of the average entry currently in table."""
+        if len(table) == 0:
+            return minimum
+        entry_size = _dict_entry_overhead() + (
+            float(sum(_sizeof(key) + _sizeof(value)
+                      for (key, value) in table.items())) / len(table))
+        return self.entries(name, entry_size, minimum)
+
+    def __repr__(self):
+        return 'MemoryBudget({})'.format(_format_memory_size(self.budget))
+
+
+# Marker for missing values, distinct from any cached value
+_MISSING = object()
+
+try:
+    _move_to_end = collections.OrderedDict.move_to_end
+except AttributeError:
+    # Python 2
+    def _move_to_end(odict, key):
+        odict[key] = odict.pop(key)
+
+
+class BoundedCache(object):
+    """A cache with a bounded total size, using a simplified 2Q
+    replacement policy. New entries are placed in a probationary
+    FIFO queue, and promoted to the main LRU queue if they are used
+    again while on probation. This prevents a burst of entries used
+    only once from flushing out the frequently used entries.
+
+    The size of each entry is given by size_func (by default 1,
+    making the size the number of entries). The numbers of hits,
+    misses and evictions are counted for tuning the size.
+    """
+
+    def __init__(self, max_size=None, size_func=None, probation=0.25):
+        """Arguments:
+            max_size :  The maximum total size of the entries,
+                        or None for an unbounded cache.
+            size_func :  Function returning the size of a value.
+            probation :  The proportion of max_size reserved for
+                         the probationary queue.
+        """
+        self.max_size = max_size
+        self._size_func = size_func
+        self._probation_share = probation
+        self._probation = collections.OrderedDict()
+        self._main = collections.OrderedDict()
+        self._sizes = {}
+        self._probation_size = 0
+        self._main_size = 0
+        self.reset_stats()
+
+    def get(self, key, default=None):
+        """Returns the cached value, or default if it is not cached."""
+        main = self._main
+        if key in main:
+            self.hits += 1
+            if self.max_size is not None:
+                # Move to the most recently used end
+                _move_to_end(main, key)
+            return main[key]
+        if key in self._probation:
+            # Used again while on probation: promote to main queue
+            value = self._probation.pop(key)
+            size = self._size(key)
+            self._probation_size -= size
+            self._main[key] = value
+            self._main_size += size
+            self._evict()
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        # Updated entries remain in the main queue
+        in_main = key in self._main
+        self.discard(key)
+        if self._size_func is None:
+            size = 1
+        else:
+            size = self._size_func(value)
+            self._sizes[key] = size
+        if in_main or self.max_size is None:
+            self._main[key] = value
+            self._main_size += size
+            self._evict()
+            return
+        self._probation[key] = value
+        self._probation_size += size
+        self._evict()
+
+    def __contains__(self, key):
+        return key in self._main or key in self._probation
+
+    def __len__(self):
+        return len(self._main) + len(self._probation)
+
+    def __iter__(self):
+        for key in self._main:
+            yield key
+        for key in self._probation:
+            yield key
+
+    def items(self):
+        for (key, value) in self._main.items():
+            yield (key, value)
+        for (key, value) in self._probation.items():
+            yield (key, value)
+
+    def discard(self, key):
+        """Removes the key from the cache, if present."""
+        size = self._size(key)
+        if key in self._main:
+            del self._main[key]
+            self._main_size -= size
+        elif key in self._probation:
+            del self._probation[key]
+            self._probation_size -= size
+        else:
+            return
+        self._sizes.pop(key, None)
+
+    def clear(self):
+        """Empties the cache. The statistics are not reset."""
+        if not (self._main or self._probation):
+            return
+        self._probation.clear()
+        self._main.clear()
+        self._sizes.clear()
+        self._probation_size = 0
+        self._main_size = 0
+
+    def resize(self, max_size):
+        """Changes the maximum size, evicting entries if necessary."""
+        self.max_size = max_size
+        if max_size is None:
+            for (key, value) in self._probation.items():
+                self._main[key] = value
+            self._main_size += self._probation_size
+            self._probation.clear()
+            self._probation_size = 0
+        self._evict()
+
+    @property
+    def size(self):
+        """The total size of the cached entries."""
+        return self._main_size + self._probation_size
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _size(self, key):
+        if self._size_func is None:
+            return 1
+        return self._sizes.get(key, 0)
+
+    def _evict(self):
+        if (self.max_size is None or
+                self._main_size + self._probation_size <= self.max_size):
+            return
+        max_probation = max(1, int(self.max_size * self._probation_share))
+        while self.size > self.max_size and len(self) > 0:
+            if (len(self._probation) > 0 and
+                    (self._probation_size > max_probation or
+                     len(self._main) == 0)):
+                (key, _) = self._probation.popitem(last=False)
+                self._probation_size -= self._size(key)
+            else:
+                (key, _) = self._main.popitem(last=False)
+                self._main_size -= self._size(key)
+            self._sizes.pop(key, None)
+            self.evictions += 1
+
+    def __repr__(self):
+        return ('BoundedCache({} entries, size {} of {}, '
+                '{} hits, {} misses ({:.1%}), {} evictions)').format(
+                    len(self), self.size, self.max_size,
+                    self.hits, self.misses, self.hit_rate,
+                    self.evictions)
+
+
+class CountMinSketch(object):
+    """Approximate counts of keys in a fixed amount of memory.
+
+    Each key is counted in one cell of each of depth rows of width
+    counters, and its count is estimated as the minimum of its cells.
+    The estimates never undercount. With probability 1 - delta, an
+    estimate exceeds the true count by at most epsilon times the
+    total count, where epsilon = e / width and delta = exp(-depth).
+    Counts are raised using conservative update, which only
+    increments the cells holding the minimum.
+
+    Supports the subset of the Counter interface needed for counting
+    with sketch[key] += 1. Keys are strings, hashed with a digest of
+    their UTF-8 encoding, so the cells of a key are the same in every
+    run, unlike with the randomized built-in hash.
+    """
+
+    def __init__(self, width, depth=4):
+        """Arguments:
+            width :  The number of counters in each row.
+            depth :  The number of rows.
+        """
+        self.width = int(width)
+        self.depth = int(depth)
+        self.clear()
+
+    @classmethod
+    def from_memory(cls, num_bytes, depth=4):
+        """Creates a sketch whose counters take num_bytes bytes."""
+        itemsize = array.array(str('I')).itemsize
+        return cls(max(1, int(num_bytes) // (itemsize * depth)), depth)
+
+    @property
+    def epsilon(self):
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+
+    @property
+    def memory_size(self):
+        """The size of the counters in bytes."""
+        return self.width * self.depth * self._rows[0].itemsize
+
+    @property
+    def error_bound(self):
+        """The bound for the overestimate of any count."""
+        return self.epsilon * self.total
+
+    def _cells(self, key):
+        # Double hashing: the row hashes are h1 + i * h2
+        (h1, h2) = struct.unpack(
+            str('<II'), hashlib.sha1(key.encode('utf-8')).digest()[:8])
+        h2 |= 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def __getitem__(self, key):
+        return min(row[cell]
+                   for (row, cell) in zip(self._rows, self._cells(key)))
+
+    def __setitem__(self, key, value):
+        """Raises the estimate of the key to at least value.
+        Estimates can not be decreased."""
+        cells = self._cells(key)
+        estimate = min(row[cell] for (row, cell) in zip(self._rows, cells))
+        if value <= estimate:
+            return
+        for (row, cell) in zip(self._rows, cells):
+            if row[cell] < value:
+                row[cell] = value
+        self.total += value - estimate
+
+    def __contains__(self, key):
+        return self[key] > 0
+
+    def clear(self):
+        self._rows = [array.array(str('I'), [0]) * self.width
+                      for _ in range(self.depth)]
+        self.total = 0
+
+    def __repr__(self):
+        return ('CountMinSketch({}x{}, {}, total {}, '
+                'error bound {:.1f} with probability {:.3f})').format(
+                    self.depth, self.width,
+                    _format_memory_size(self.memory_size), self.total,
+                    self.error_bound, 1 - self.delta)
+
+
+PipelineStats = collections.namedtuple('PipelineStats',
+                                       ['items', 'busy', 'waiting'])
+
+# The function applied by the worker processes of a Pipeline,
+# inherited when the workers are forked.
+_pipeline_job = None
+
+# Marker for the end of the items passed between pipeline stages
+_END = object()
+
+
+class _StageError(object):
+    """Passes an exception raised in a stage on to the next stage."""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _pipeline_chunk(chunk):
+    start = time.time()
+    results = [_pipeline_job(item) for item in chunk]
+    return (time.time() - start, results)
+
+
+class Pipeline(object):
+    """Processes a stream of items in three concurrent stages:
+    a reader thread iterating over the source, a processing stage
+    applying process_func to each item, and a writer thread consuming
+    the results. I/O, decompression and compression in the reader
+    and writer overlap with the processing.
+
+    The items are passed between the stages in chunks, through
+    bounded queues, so that a slow stage blocks the stages before it
+    instead of letting the queued items grow without bound.
+    With more than one process, the chunks are processed in
+    forked worker processes, and the results are written in the
+    order of the source unless ordered is False.
+
+    The number of items and the time each stage spent working and
+    waiting for the other stages are stored in stats.
+    """
+
+    STAGES = ('read', 'process', 'write')
+
+    def __init__(self, process_func, num_processes=1, chunk_size=1000,
+                 queue_chunks=4, ordered=True):
+        """Arguments:
+            process_func :  Function applied to each item.
+                            With several processes, the results must be
+                            picklable.
+            num_processes :  Number of worker processes. With 1,
+                             the items are processed in the calling
+                             thread.
+            chunk_size :  Number of items passed between the stages
+                          at a time.
+            queue_chunks :  Maximum number of chunks waiting in each
+                            queue between the stages.
+            ordered :  If False, results are written as soon as they
+                       are ready, instead of in the order of the source.
+        """
+        self.process_func = process_func
+        self.num_processes = num_processes
+        self.chunk_size = chunk_size
+        self.queue_chunks = queue_chunks
+        self.ordered = ordered
+        self.stats = collections.OrderedDict()
+        self._stop = threading.Event()
+        self._errors = []
+
+    def run(self, source, sink):
+        """Runs all items of the source through the pipeline.
+
+        Arguments:
+            source :  Iterable of items, iterated in the reader thread.
+            sink :  Function called in the writer thread, with an
+                    iterator over the results as argument.
+        """
+        global _pipeline_job
+        self.stats.clear()
+        self._stop.clear()
+        self._errors = []
+        in_queue = queue.Queue(self.queue_chunks)
+        out_queue = queue.Queue(self.queue_chunks)
+        pool = None
+        start = time.time()
+        if self.num_processes > 1:
+            try:
+                context = multiprocessing.get_context('fork')
+            except AttributeError:
+                # Python 2 always forks on posix
+                context = multiprocessing
+            # The pool is forked before the threads are started
+            _pipeline_job = self.process_func
+            pool = context.Pool(self.num_processes)
+        reader = threading.Thread(target=self._read,
+                                  args=(source, in_queue))
+        writer = threading.Thread(target=self._write,
+                                  args=(sink, out_queue))
+        for thread in (reader, writer):
+            thread.daemon = True
+            thread.start()
+        try:
+            self._process(in_queue, out_queue, pool)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                _pipeline_job = None
+            self._put(out_queue, _END)
+            writer.join()
+            self._stop.set()
+            reader.join()
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        self._log_stats(time.time() - start)
+
+    def _read(self, source, in_queue):
+        start = time.time()
+        waiting = 0.
+        num_items = 0
+        try:
+            chunk = []
+            for item in source:
+                if self._stop.is_set():
+                    return
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    num_items += len(chunk)
+                    waiting += self._put(in_queue, chunk)
+                    chunk = []
+            num_items += len(chunk)
+            if len(chunk) > 0:
+                waiting += self._put(in_queue, chunk)
+            waiting += self._put(in_queue, _END)
+        except BaseException as e:
+            self._put(in_queue, _StageError(e))
+        self._add_stats('read', num_items,
+                        time.time() - start - waiting, waiting)
+
+    def _process(self, in_queue, out_queue, pool):
+        start = time.time()
+        waiting = 0.
+        busy = 0.
+        num_items = 0
+        pending = collections.deque()
+        # At most two chunks per process are in flight,
+        # to bound the memory used for the pending chunks
+        max_pending = 2 * max(1, self.num_processes)
+        reading = True
+        while not self._stop.is_set():
+            while reading and len(pending) < max_pending:
+                (chunk, waited) = self._get(in_queue)
+                waiting += waited
+                if chunk is _END:
+                    reading = False
+                elif isinstance(chunk, _StageError):
+                    raise chunk.exception
+                elif pool is None:
+                    # Processed one chunk at a time
+                    results = [self.process_func(item) for item in chunk]
+                    num_items += len(results)
+                    waiting += self._put(out_queue, results)
+                else:
+                    pending.append(pool.apply_async(_pipeline_chunk,
+                                                    (chunk,)))
+            if len(pending) == 0:
+                break
+            (elapsed, results) = self._next_result(pending)
+            busy += elapsed
+            num_items += len(results)
+            waiting += self._put(out_queue, results)
+        if pool is not None:
+            # Worker time is summed over the processes
+            self._add_stats('process', num_items, busy, waiting)
+        else:
+            self._add_stats('process', num_items,
+                            time.time() - start - waiting, waiting)
+
+    def _next_result(self, pending):
+        if self.ordered:
+            return pending.popleft().get()
+        while True:
+            for (i, result) in enumerate(pending):
+                if result.ready():
+                    del pending[i]
+                    return result.get()
+            pending[0].wait(0.01)
+
+    def _write(self, sink, out_queue):
+        start = time.time()
+        counts = {'items': 0, 'waiting': 0.}
+
+        def results():
+            while True:
+                (chunk, waited) = self._get(out_queue)
+                counts['waiting'] += waited
+                if chunk is _END:
+                    return
+                counts['items'] += len(chunk)
+                for result in chunk:
+                    yield result
+
+        try:
+            sink(results())
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            # Nothing is consumed after the sink returns
+            self._stop.set()
+        self._add_stats('write', counts['items'],
+                        time.time() - start - counts['waiting'],
+                        counts['waiting'])
+
+    def _put(self, to_queue, item):
+        """Puts an item in a queue, unless the pipeline is stopped.
+        Returns the time spent waiting."""
+        start = time.time()
+        while not self._stop.is_set():
+            try:
+                to_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.time() - start
+
+    def _get(self, from_queue):
+        """Returns the next item from a queue and the time spent waiting.
+        Returns the end marker if the pipeline is stopped."""
+        start = time.time()
+        while not self._stop.is_set():
+            try:
+                return (from_queue.get(timeout=0.1), time.time() - start)
+            except queue.Empty:
+                continue
+        return (_END, time.time() - start)
+
+    def _fail(self, exception):
+        self._errors.append(exception)
+        self._stop.set()
+
+    def _add_stats(self, stage, num_items, busy, waiting):
+        self.stats[stage] = PipelineStats(num_items, busy, waiting)
+
+    def _log_stats(self, elapsed):
+        _logger.info('Pipeline finished in {:.1f}s'.format(elapsed))
+        for stage in self.STAGES:
+            if stage not in self.stats:
+                continue
+            stats = self.stats[stage]
+            workers = ''
+            if stage == 'process' and self.num_processes > 1:
+                workers = ' in {} processes'.format(self.num_processes)
+            _logger.info(
+                'Stage {}: {} items, {:.1f}s busy{} ({:.0f} items/s), '
+                '{:.1f}s waiting'.format(
+                    stage, stats.items, stats.busy, workers,
+                    stats.items / max(stats.busy, 1e-6),
+                    stats.waiting))
+
+
+class Prefetcher(object):
+    """Iterates over a source in a background thread, keeping up to
+    queue_chunks chunks of chunk_size items ready for the consumer.
+    Reading, decoding and waiting for input overlap with processing
+    the items.
+
+    Exceptions raised by the source are re-raised to the consumer.
+    The time the consumer spent waiting for items is stored in
+    waiting.
+    """
+
+    def __init__(self, source, chunk_size=100, queue_chunks=8):
+        """Arguments:
+            source :  Iterable of items, iterated in the background
+                      thread.
+            chunk_size :  Number of items passed to the consumer
+                          at a time.
+            queue_chunks :  Maximum number of chunks read ahead.
+        """
+        self.chunk_size = chunk_size
+        self.waiting = 0.
+        self._queue = queue.Queue(queue_chunks)
+        self._chunk = collections.deque()
+        self._done = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read, args=(source,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._chunk) == 0:
+            if self._done:
+                raise StopIteration
+            start = time.time()
+            chunk = self._queue.get()
+            self.waiting += time.time() - start
+            if chunk is _END:
+                self._done = True
+            elif isinstance(chunk, _StageError):
+                self._done = True
+                raise chunk.exception
+            else:
+                self._chunk.extend(chunk)
+        return self._chunk.popleft()
+
+    next = __next__     # Python 2
+
+    def close(self, timeout=1.):
+        """Stops reading ahead. The remaining items are discarded.
+
+        Waits at most timeout seconds for the reading thread to stop.
+        A thread blocked in the source, e.g. waiting for input, is
+        left behind: it is a daemon thread, and stops at the next
+        item it reads.
+        """
+        self._stop.set()
+        self._done = True
+        self._chunk.clear()
+        # Make space for the reading thread, if it is waiting to put
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join(timeout)
+
+    def _read(self, source):
+        try:
+            chunk = []
+            for item in source:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    if not self._put(chunk):
+                        return
+                    chunk = []
+            if len(chunk) > 0 and not self._put(chunk):
+                return
+            self._put(_END)
+        except BaseException as e:
+            self._put(_StageError(e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class BackgroundWriter(object):
+    """Calls func in a background thread with the arguments given to
+    write, in order, so that slow output does not stall the caller.
+    The calls are passed to the thread in chunks of chunk_size,
+    through a queue of at most queue_chunks chunks, which blocks the
+    caller if the output falls too far behind.
+
+    An exception raised by func is re-raised by the next call to
+    write or close, after which nothing more is written. The time
+    the caller spent waiting for space in the queue is stored in
+    waiting.
+    """
+
+    def __init__(self, func, chunk_size=100, queue_chunks=8):
+        """Arguments:
+            func :  Function called with the arguments of each write.
+            chunk_size :  Number of calls passed to the thread
+                          at a time.
+            queue_chunks :  Maximum number of chunks waiting.
+        """
+        self.func = func
+        self.chunk_size = chunk_size
+        self.waiting = 0.
+        self._queue = queue.Queue(queue_chunks)
+        self._chunk = []
+        self._errors = []
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, *args):
+        self._check()
+        self._chunk.append(args)
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Passes the buffered calls on to the background thread."""
+        if len(self._chunk) == 0:
+            return
+        chunk = self._chunk
+        self._chunk = []
+        self._put(chunk)
+
+    def close(self):
+        """Waits until all calls have been made."""
+        if self._thread.is_alive():
+            self.flush()
+            self._put(_END)
+            self._thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _check(self):
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def _put(self, item):
+        start = time.time()
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.waiting += time.time() - start
+        self._check()
+
+    def _write(self):
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is _END:
+                    return
+                for args in chunk:
+                    self.func(*args)
+        except BaseException as e:
+            self._errors.append(e)
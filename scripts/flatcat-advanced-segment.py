@@ -57,7 +57,7 @@ Morfessor FlatCat advanced segmentation
     add_arg = parser.add_argument
 
     add_arg('model', metavar='<flatcat model>',
-            help='A FlatCat model (tarball or binary)')
+            help='A FlatCat model (tarball, binary or packed)')
     add_arg('infile', metavar='<infile>',
             help='The input file. The type will be sniffed automatically, '
                  'or can be specified manually.')
@@ -68,6 +68,20 @@ Morfessor FlatCat advanced segmentation
     add_arg('-e', '--encoding', dest='encoding', metavar='<encoding>',
             help='Encoding of input and output files (if none is given, '
                  'both the local encoding and UTF-8 are tried).')
+    add_arg('--memory-budget', dest='memory_budget',
+            type=utils.parse_memory_size, default=None, metavar='<size>',
+            help='Approximate number of bytes to use for caching '
+                 'segmentations and emission probabilities of the model. '
+                 'With several processes, the budget is divided between '
+                 'them. Accepts the suffixes K, M and G '
+                 '(default: cache at most 1000000 words).')
+    add_arg('--processes', dest='num_processes', type=int,
+            default=1, metavar='<int>',
+            help='Number of segmentation worker processes. With more '
+                 'than one, reading, segmentation and writing run '
+                 'concurrently, each process has its own cache, and '
+                 'the output is written in blocks of tokens '
+                 '(default %(default)s).')
 
     add_arg('--output-format', dest='output_format', type=str,
             default=None, metavar='<id>',
@@ -232,8 +246,14 @@ def postprocess(fmt, morphs):
         assert False, 'unknown output format {}'.format(fmt)
 
 
+# Proportions of --memory-budget given to the caches of the model
+# and to the cache of segmentations
+MEMORY_BUDGET_SHARES = {'model': 0.25, 'segmentations': 0.75}
+
+
 class SegmentationCache(object):
-    def __init__(self, seg_func, passthrough=None, limit=1000000):
+    def __init__(self, seg_func, passthrough=None, limit=1000000,
+                 memory_budget=None):
         self.seg_func = seg_func
         if passthrough is not None:
             self.passthrough = passthrough
@@ -241,6 +261,10 @@ class SegmentationCache(object):
             self.passthrough = []
         self.limit = limit
         self._cache = {}
+        # If a MemoryBudget is given, the limit is set after
+        # measuring the size of the first entries
+        self.memory_budget = memory_budget
+        self._measure_after = 100
         self.seg_count = 0
         self.unseg_count = 0
 
@@ -253,6 +277,9 @@ class SegmentationCache(object):
             self._cache = {}
         if word not in self._cache:
             self._cache[word] = self.seg_func(word)
+            if (self.memory_budget is not None and
+                    len(self._cache) == self._measure_after):
+                self._set_limit_from_budget()
         seg = self._cache[word]
         if len(seg) > 1:
             self.seg_count += 1
@@ -264,8 +291,16 @@ class SegmentationCache(object):
         for word in pipe:
             yield self.segment(word)
 
+    def _set_limit_from_budget(self):
+        self.limit = self.memory_budget.dict_entries(
+            'segmentations', self._cache, minimum=self._measure_after)
+        self._measure_after = None
+
 
 def load_model(io, modelfile):
+    if modelfile.endswith('.packed'):
+        # packed models are ready to use without initialization
+        return io.read_packed_model_file(modelfile)
     init_is_pickle = (modelfile.endswith('.pickled') or
                       modelfile.endswith('.pickle') or
                       modelfile.endswith('.bin'))
@@ -274,7 +309,7 @@ def load_model(io, modelfile):
                        modelfile.endswith('.tgz'))
     if not init_is_pickle and not init_is_tarball:
         raise ArgumentException(
-            'This tool can only load tarball and binary models')
+            'This tool can only load tarball, binary and packed models')
 
     if init_is_pickle:
         model = io.read_binary_model_file(modelfile)
@@ -293,25 +328,68 @@ def main(args):
             passthrough.append(
                 re.compile(line))
     model = load_model(io, args.model)
+    num_processes = max(1, args.num_processes)
+    budget = None
+    if args.memory_budget is not None:
+        # Each worker process fills caches of its own
+        budget = utils.MemoryBudget(args.memory_budget // num_processes,
+                                    MEMORY_BUDGET_SHARES)
+        model.set_memory_budget(budget.share('model'))
     model_wrapper = FlatcatWrapper(
         model,
         remove_nonmorphemes=(not args.no_rm_nonmorph))
-    cache = SegmentationCache(model_wrapper.segment, passthrough)
-
-    with io._open_text_file_write(args.outfile) as fobj:
-        pipe = corpus_reader(io, args.infile)
-        pipe = utils._generator_progress(pipe, 10000)
-        pipe = cache.segment_from(pipe)
+    cache = SegmentationCache(model_wrapper.segment, passthrough,
+                              memory_budget=budget)
+
+    def segment_token(token):
+        # The counts and the cache limit in a worker process are
+        # returned with each token
+        seg_count = cache.seg_count
+        unseg_count = cache.unseg_count
+        morphs = cache.segment(token)
         # FIXME: transformations (joining/filtering) here
-        pipe = (postprocess(args.output_format, morphs)
-                for morphs in pipe)
+        return (postprocess(args.output_format, morphs),
+                cache.seg_count - seg_count,
+                cache.unseg_count - unseg_count,
+                cache.limit)
+
+    counts = collections.Counter()
+    cache_limits = set()
+
+    def write_tokens(results):
+        with io._open_text_file_write(args.outfile) as fobj:
+            for (token, seg_count, unseg_count, limit) in results:
+                fobj.write(token)
+                counts['segmented'] += seg_count
+                counts['unsegmented'] += unseg_count
+                cache_limits.add(limit)
+
+    pipe = corpus_reader(io, args.infile)
+    pipe = utils._generator_progress(pipe, 10000)
+    if num_processes > 1:
+        pipeline = utils.Pipeline(segment_token, num_processes)
+        pipeline.run(pipe, write_tokens)
+    else:
+        # Each token is written before the next is read,
+        # as needed for interactive use
+        write_tokens(segment_token(token) for token in pipe)
 
-        for token in pipe:
-            fobj.write(token)
-    tot_count = cache.seg_count + cache.unseg_count
-    seg_prop = float(cache.seg_count) / float(tot_count)
+    tot_count = counts['segmented'] + counts['unsegmented']
+    seg_prop = float(counts['segmented']) / float(tot_count)
     print('{} segmented ({}), {} unsegmented, {} total'.format(
-        cache.seg_count, seg_prop, cache.unseg_count, tot_count))
+        counts['segmented'], seg_prop, counts['unsegmented'], tot_count))
+    if args.memory_budget is not None:
+        if num_processes > 1:
+            # The workers have exited, only their peak can be known
+            print('Cache limit {} words in each of {} processes, '
+                  'peak resident memory {} per process'.format(
+                      max(cache_limits), num_processes,
+                      utils._format_memory_size(
+                          utils._peak_memory(children=True))))
+        else:
+            print('Cache limit {} words, resident memory {}'.format(
+                cache.limit,
+                utils._format_memory_size(utils._process_memory())))
 
 
 if __name__ == "__main__":
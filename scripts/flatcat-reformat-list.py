@@ -75,12 +75,19 @@ Morfessor FlatCat advanced segmentation and reformatting
             help='The output file. The type is defined by preset '
                  'or can be specified manually.')
     add_arg('-m', '--model', dest='model', metavar='<flatcat model>',
-            help='A FlatCat model (tarball or binary), '
+            help='A FlatCat model (tarball, binary or packed), '
                  'for the operations that require a model to work.')
 
     add_arg('-e', '--encoding', dest='encoding', metavar='<encoding>',
             help='Encoding of input and output files (if none is given, '
                  'both the local encoding and UTF-8 are tried).')
+    add_arg('--memory-budget', dest='memory_budget',
+            type=utils.parse_memory_size, default=None, metavar='<size>',
+            help='Approximate number of bytes to use for caching '
+                 'segmentations and emission probabilities of the model. '
+                 'With several processes, the budget is divided between '
+                 'them. Accepts the suffixes K, M and G '
+                 '(default: cache at most 1000000 words).')
 
     add_arg('--input-column-separator', dest='cseparator', type=str,
             default=None, metavar='<regexp>',
@@ -127,6 +134,13 @@ Morfessor FlatCat advanced segmentation and reformatting
             action='store_true',
             help='Use a cache for segmentations. Useful for corpora (tokens) '
                  'but wasteful for lists (types).')
+    add_arg('--processes', dest='num_processes', type=int,
+            default=1, metavar='<int>',
+            help='Number of worker processes for segmenting and '
+                 'formatting. With more than one, reading, processing '
+                 'and writing run concurrently, each process has its '
+                 'own cache, and the output is written in blocks of '
+                 'items (default %(default)s).')
 
     return parser
 
@@ -242,12 +256,22 @@ def restitch(word):
         word.clogp)
 
 
+# Proportions of --memory-budget given to the caches of the model
+# and to the cache of segmentations
+MEMORY_BUDGET_SHARES = {'model': 0.25, 'segmentations': 0.75}
+
+
 # FIXME: has nothing specificly with segmentation to do: rename
 class SegmentationCache(object):
-    def __init__(self, seg_func, limit=1000000):
+    def __init__(self, seg_func, limit=1000000,
+                 memory_budget=None):
         self.seg_func = seg_func
         self.limit = limit
         self._cache = {}
+        # If a MemoryBudget is given, the limit is set after
+        # measuring the size of the first entries
+        self.memory_budget = memory_budget
+        self._measure_after = 100
 
     def segment(self, word):
         if len(self._cache) > self.limit:
@@ -255,10 +279,21 @@ class SegmentationCache(object):
             self._cache = {}
         if word not in self._cache:
             self._cache[word] = self.seg_func(word)
+            if (self.memory_budget is not None and
+                    len(self._cache) == self._measure_after):
+                self._set_limit_from_budget()
         return self._cache[word]
 
+    def _set_limit_from_budget(self):
+        self.limit = self.memory_budget.dict_entries(
+            'segmentations', self._cache, minimum=self._measure_after)
+        self._measure_after = None
+
 
 def load_model(io, modelfile):
+    if modelfile.endswith('.packed'):
+        # packed models are ready to use without initialization
+        return io.read_packed_model_file(modelfile)
     init_is_pickle = (modelfile.endswith('.pickled') or
                       modelfile.endswith('.pickle') or
                       modelfile.endswith('.bin'))
@@ -267,7 +302,7 @@ def load_model(io, modelfile):
                        modelfile.endswith('.tgz'))
     if not init_is_pickle and not init_is_tarball:
         raise ArgumentException(
-            'This tool can only load tarball and binary models')
+            'This tool can only load tarball, binary and packed models')
 
     if init_is_pickle:
         model = io.read_binary_model_file(modelfile)
@@ -326,6 +361,14 @@ def main(args):
     model = None
     if args.model is not None:
         model = load_model(io, args.model)
+    num_processes = max(1, args.num_processes)
+    budget = None
+    if args.memory_budget is not None:
+        # Each worker process fills caches of its own
+        budget = utils.MemoryBudget(args.memory_budget // num_processes,
+                                    MEMORY_BUDGET_SHARES)
+        if model is not None:
+            model.set_memory_budget(budget.share('model'))
 
     outformat = args.outputformat
     csep = args.outputconseparator
@@ -390,33 +433,46 @@ def main(args):
             item = func(item)
         return item
 
-    cache = SegmentationCache(process_item)
-
-    with io._open_text_file_write(args.outfile) as fobj:
-        if args.preset == 'restitch':    # FIXME
-            pipe = segmented_corpus_reader(
-                io, args.infile,
-                {re.compile(r'\+ \+'):      '+',   # FIXME
-                 re.compile(r'(?<!\+) \+'): ' ',   # FIXME
-                 re.compile(r'\+ (?!\+)'):  ' '},  # FIXME
-                args.input_not_tagged
-            )
-        else:
-            pipe = dummy_reader(io, args.infile)
-        pipe = utils._generator_progress(pipe)
-        for item in pipe:
-            if len(item.analysis) == 0:
-                # is a corpus newline marker
-                if outputnewlines:
-                    fobj.write("\n")
-                continue
-            item = cache.segment(item)
-            fobj.write(outformat.format(
-                       count=item.count,
-                       compound=item.word,
-                       analysis=item.analysis,
-                       logprob=item.logp,
-                       clogprob=item.clogp))
+    cache = SegmentationCache(process_item,
+                              memory_budget=budget)
+
+    def format_item(item):
+        if len(item.analysis) == 0:
+            # is a corpus newline marker
+            if outputnewlines:
+                return '\n'
+            return ''
+        item = cache.segment(item)
+        return outformat.format(
+            count=item.count,
+            compound=item.word,
+            analysis=item.analysis,
+            logprob=item.logp,
+            clogprob=item.clogp)
+
+    def write_lines(lines):
+        with io._open_text_file_write(args.outfile) as fobj:
+            for line in lines:
+                fobj.write(line)
+
+    if args.preset == 'restitch':    # FIXME
+        pipe = segmented_corpus_reader(
+            io, args.infile,
+            {re.compile(r'\+ \+'):      '+',   # FIXME
+             re.compile(r'(?<!\+) \+'): ' ',   # FIXME
+             re.compile(r'\+ (?!\+)'):  ' '},  # FIXME
+            args.input_not_tagged
+        )
+    else:
+        pipe = dummy_reader(io, args.infile)
+    pipe = utils._generator_progress(pipe)
+    if num_processes > 1:
+        pipeline = utils.Pipeline(format_item, num_processes)
+        pipeline.run(pipe, write_lines)
+    else:
+        # Each item is written before the next is read,
+        # as needed for interactive use
+        write_lines(format_item(item) for item in pipe)
 
 
 if __name__ == "__main__":
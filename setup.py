@@ -33,6 +33,7 @@ setup(name='Morfessor FlatCat',
                'scripts/flatcat-train',
                'scripts/flatcat-segment',
                'scripts/flatcat-evaluate',
+               'scripts/flatcat-serve',
                'scripts/flatcat-advanced-segment.py',
                'scripts/flatcat-compare-models.py',
                'scripts/flatcat-reformat-list.py',